@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import dataclasses
+import json
+import logging
+import os
+import time
+from typing import IO, Any, AsyncGenerator, Deque, Dict, List, Optional
+
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+)
+from src.philipwilcox.lib.openai.request_key import digest_of, request_key
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteMissError(Exception):
+    """A replayed request that isn't in the cassette, and there's no transport to fall back on."""
+
+
+@dataclasses.dataclass
+class CassetteEntry:
+    # The request_key of the model, temperature and messages, so any change to the request is a miss
+    key: str
+    model: str
+    chunks: List[str]
+    # Seconds from sending the request to receiving each chunk
+    chunk_times_s: List[float]
+    # Only there to make the file readable
+    last_message: str = ""
+
+    @staticmethod
+    def key_for_request(messages: List[Dict[str, str]], **kwargs: Any) -> str:
+        return request_key(
+            kwargs.get("model", "gpt-4"),
+            kwargs.get("temperature", 1.0),
+            digest_of(messages),
+        )
+
+
+class Cassette:
+    """Recorded completions, one JSON line per request, in the order they were made.
+
+    Identical requests can come up more than once (e.g. the same conversation in many sessions), so each key keeps
+    every recording of it, to be replayed in order; once they run out the last one is replayed again.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: Dict[str, Deque[CassetteEntry]] = collections.defaultdict(
+            collections.deque
+        )
+        self.file: Optional[IO[str]] = None
+        if os.path.exists(path):
+            self.load()
+
+    def load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    logger.warning(
+                        f"Ignoring a partially written entry at the end of {self.path}"
+                    )
+                    break
+                entry = CassetteEntry(**json.loads(line))
+                self.entries[entry.key].append(entry)
+
+    def __len__(self) -> int:
+        return sum(len(e) for e in self.entries.values())
+
+    def next_entry(self, key: str) -> Optional[CassetteEntry]:
+        entries = self.entries.get(key)
+        if not entries:
+            return None
+        if len(entries) > 1:
+            return entries.popleft()
+        return entries[0]
+
+    def append(self, entry: CassetteEntry) -> None:
+        """Add a recording, written out straight away so an interrupted session keeps everything before it."""
+        self.entries[entry.key].append(entry)
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps(dataclasses.asdict(entry)) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class RecordingTransport(ChatCompletionTransport):
+    """Passes every request to `transport` and records the streamed chunks, and when each arrived, to `cassette`.
+
+    Only completed responses are recorded; one that fails or is cancelled partway is left out.
+    """
+
+    def __init__(self, transport: ChatCompletionTransport, cassette: Cassette) -> None:
+        self.transport = transport
+        self.cassette = cassette
+        self.needs_api_key = transport.needs_api_key
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        started = time.perf_counter()
+        chunks: List[str] = []
+        chunk_times_s: List[float] = []
+        async for chunk in self.transport.stream_chat_completion(messages, **kwargs):
+            chunks.append(chunk)
+            chunk_times_s.append(time.perf_counter() - started)
+            yield chunk
+        self.cassette.append(
+            CassetteEntry(
+                CassetteEntry.key_for_request(messages, **kwargs),
+                kwargs.get("model", "gpt-4"),
+                chunks,
+                chunk_times_s,
+                messages[-1]["content"] if messages else "",
+            )
+        )
+
+    async def close(self) -> None:
+        self.cassette.close()
+        await self.transport.close()
+
+
+class ReplayTransport(ChatCompletionTransport):
+    """Streams recorded responses back with their recorded chunks and timing, without touching the network.
+
+    `speed` scales the timing: 2.0 replays twice as fast, and 0 as fast as possible (still yielding to the event loop
+    between chunks, as a live stream would). A request that isn't in the cassette goes to `on_miss` if there is one,
+    e.g. a RecordingTransport onto the same cassette to fill it in; otherwise it raises CassetteMissError.
+    """
+
+    needs_api_key = False
+
+    def __init__(
+        self,
+        cassette: Cassette,
+        speed: float = 1.0,
+        on_miss: Optional[ChatCompletionTransport] = None,
+    ) -> None:
+        self.cassette = cassette
+        self.speed = speed
+        self.on_miss = on_miss
+        if on_miss is not None:
+            self.needs_api_key = on_miss.needs_api_key
+        self.hits = 0
+        self.misses = 0
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        entry = self.cassette.next_entry(
+            CassetteEntry.key_for_request(messages, **kwargs)
+        )
+        if entry is None:
+            self.misses += 1
+            if self.on_miss is None:
+                raise CassetteMissError(
+                    f"No recording in {self.cassette.path} for a {kwargs.get('model', 'gpt-4')} request ending "
+                    f"{messages[-1]['content'][:80] if messages else ''!r}"
+                )
+            async for chunk in self.on_miss.stream_chat_completion(messages, **kwargs):
+                yield chunk
+            return
+        self.hits += 1
+        started = time.perf_counter()
+        for chunk, at_s in zip(entry.chunks, entry.chunk_times_s):
+            delay_s = (
+                at_s / self.speed - (time.perf_counter() - started)
+                if self.speed > 0
+                else 0
+            )
+            await asyncio.sleep(max(delay_s, 0))
+            yield chunk
+
+    async def close(self) -> None:
+        if self.on_miss is not None:
+            await self.on_miss.close()
+        self.cassette.close()
@@ -0,0 +1,112 @@
+import abc
+import functools
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, List, Optional, Tuple, Type
+
+from src.philipwilcox.lib.openai.rate_limiter import RATE_LIMITER, RateLimiter
+
+if TYPE_CHECKING:
+    from openai.error import RateLimitError
+
+# `openai` and `aiohttp` take most of a second to import, so they're only imported once a request is made (or fails)
+
+
+class ChatCompletionTransport(metaclass=abc.ABCMeta):
+    """A transport takes already-serialized chat messages and streams back the content deltas of the completion.
+
+    OpenAIWrapper delegates to one of these so the HTTP side (connection pooling, concurrency limits, fakes for
+    benchmarking) can be swapped out without touching PersonaMessenger.
+    """
+
+    # Whether OpenAIWrapper has to load the OpenAI API key for this transport; fakes that never call OpenAI don't
+    needs_api_key = True
+
+    @abc.abstractmethod
+    def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        pass
+
+    async def close(self) -> None:
+        """Release any pooled resources; the default transport has none."""
+
+
+class OpenAILibraryTransport(ChatCompletionTransport):
+    """The original behavior: one module-global `openai.ChatCompletion.acreate` call per request.
+
+    The library doesn't hand back response headers, so each request runs on an aiohttp session of ours (the library
+    would open a fresh one per request anyway) that passes every response's `x-ratelimit-*` headers to the shared
+    RateLimiter. If a session has been set on `openai.aiosession` it's used as-is, and limits aren't learned from it.
+    """
+
+    def __init__(
+        self,
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        self.api_base = api_base
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RATE_LIMITER
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        if self.api_base:
+            kwargs.setdefault("api_base", self.api_base)
+        if self.api_key:
+            kwargs.setdefault("api_key", self.api_key)
+        import aiohttp
+        import openai
+
+        model = kwargs.get("model")
+        if openai.aiosession.get() is not None or model is None:
+            response = await openai.ChatCompletion.acreate(messages=messages, **kwargs)
+            async for r in self.content_deltas(response):
+                yield r
+            return
+
+        async def on_request_end(
+            session: aiohttp.ClientSession,
+            context: Any,
+            params: aiohttp.TraceRequestEndParams,
+        ) -> None:
+            self.rate_limiter.update_from_headers(model, params.response.headers)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_end.append(on_request_end)
+        async with aiohttp.ClientSession(trace_configs=[trace_config]) as session:
+            # Only set around the call that sends the request, so it never leaks into the caller between chunks
+            token = openai.aiosession.set(session)
+            try:
+                response = await openai.ChatCompletion.acreate(
+                    messages=messages, **kwargs
+                )
+            finally:
+                openai.aiosession.reset(token)
+            async for r in self.content_deltas(response):
+                yield r
+
+    @staticmethod
+    async def content_deltas(response: Any) -> AsyncGenerator[str, None]:
+        async for chunk in response:
+            # TODO: look at other stuff in here
+            r = chunk["choices"][0]["delta"].get("content")
+            if r:
+                # last chunk is None
+                yield r
+
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[Type[Exception], ...]:
+    """Errors from a transport that are worth retrying the request for."""
+    from aiohttp import ClientPayloadError
+    from openai.error import APIError, RateLimitError, ServiceUnavailableError
+
+    return (RateLimitError, ServiceUnavailableError, APIError, ClientPayloadError)
+
+
+@functools.lru_cache(maxsize=None)
+def rate_limit_error() -> Type["RateLimitError"]:
+    from openai.error import RateLimitError
+
+    return RateLimitError
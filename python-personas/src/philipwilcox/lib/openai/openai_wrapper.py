@@ -1,15 +1,25 @@
 import json
 import os
-from typing import List, Any, AsyncGenerator
-
-import openai
+from typing import List, Any, AsyncGenerator, Optional, Dict
 
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+    OpenAILibraryTransport,
+)
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 
 
 class OpenAIWrapper:
 
-    def __init__(self):
+    def __init__(self, transport: Optional[ChatCompletionTransport] = None):
+        # Pass a PooledHttpTransport here to share connections and concurrency limits between every persona using
+        # this wrapper, or a SyntheticTransport or ReplayTransport to run without OpenAI at all
+        self.transport = transport if transport is not None else OpenAILibraryTransport()
+        # Read on the first request rather than here, so that creating a wrapper (e.g. OPENAIWRAPPER, on import) is
+        # cheap and works without the secrets file
+        self.api_key_loaded = not self.transport.needs_api_key
+
+    def load_api_key(self) -> None:
         # TODO: move this out if/when we have other secrets
         # Load secret key from .env.secret.json
         # TODO: make this not be brittle against moving this file
@@ -17,20 +27,28 @@ class OpenAIWrapper:
 
         with open(root_dir + '/.env.secret.json', 'r') as f:
             secrets = json.load(f)
+            import openai
+
             # override default `openai` library attempt to load from env key or "path" env key
             openai.api_key = secrets["OPENAI_API_KEY"]
+        self.api_key_loaded = True
 
     async def stream_chat_completion(self, messages: List[PersonaMessage], **kwargs: Any) -> AsyncGenerator[str, None]:
-        messages_as_dicts = [m.as_dict() for m in messages]
+        async for r in self.stream_serialized_chat_completion([m.as_dict() for m in messages], **kwargs):
+            yield r
+
+    async def stream_serialized_chat_completion(
+        self, messages_as_dicts: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        if not self.api_key_loaded:
+            self.load_api_key()
         kwargs.setdefault("model", "gpt-4")
         kwargs["stream"] = True
-        response = await openai.ChatCompletion.acreate(messages=messages_as_dicts, **kwargs)
-        async for chunk in response:
-            # TODO: look at other stuff in here
-            r = chunk["choices"][0]["delta"].get("content")
-            if r:
-                # last chunk is None
-                yield r
+        async for r in self.transport.stream_chat_completion(messages_as_dicts, **kwargs):
+            yield r
+
+    async def close(self) -> None:
+        await self.transport.close()
 
 
 
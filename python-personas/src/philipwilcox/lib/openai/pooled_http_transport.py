@@ -0,0 +1,222 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional
+
+import aiohttp
+import openai
+from openai.error import (
+    APIError,
+    AuthenticationError,
+    InvalidRequestError,
+    OpenAIError,
+    RateLimitError,
+    ServiceUnavailableError,
+)
+
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+)
+from src.philipwilcox.lib.openai.rate_limiter import RATE_LIMITER, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class FairSemaphore:
+    """A semaphore that hands out slots strictly in arrival order.
+
+    `asyncio.Semaphore` lets a newly-arriving task grab a slot that was just released before a long-waiting one wakes
+    up, so one chatty persona can starve the rest of a fleet. Here a released slot is passed directly to the oldest
+    waiter instead.
+    """
+
+    def __init__(self, value: int) -> None:
+        if value < 1:
+            raise ValueError(f"FairSemaphore needs at least one slot, got {value}")
+        self._value = value
+        self._waiters: Deque[asyncio.Future[None]] = deque()
+
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> None:
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        fut: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were handed a slot right as we got cancelled; pass it along to the next in line
+                self.release()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._value += 1
+
+
+class PooledHttpTransport(ChatCompletionTransport):
+    """Streams chat completions over a single shared keep-alive `aiohttp` session.
+
+    Requests are gated first by a per-model FairSemaphore (so e.g. gpt-4 and gpt-3.5-turbo quotas don't block each
+    other) and then by a global in-flight limit; the TCP connector bounds the number of open sockets and keeps them
+    alive between requests instead of opening a new one for every persona message.
+    """
+
+    def __init__(
+        self,
+        api_base: str = "https://api.openai.com/v1",
+        api_key: Optional[str] = None,
+        max_connections: int = 100,
+        max_in_flight: int = 64,
+        per_model_concurrency: Optional[Dict[str, int]] = None,
+        default_model_concurrency: int = 16,
+        keepalive_timeout_s: float = 30.0,
+        request_timeout_s: float = 600.0,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        self.api_base = api_base.rstrip("/")
+        # If not given we fall back to whatever OpenAIWrapper loaded into the `openai` module at request time
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.keepalive_timeout_s = keepalive_timeout_s
+        self.request_timeout_s = request_timeout_s
+        self.per_model_concurrency = per_model_concurrency or {}
+        self.default_model_concurrency = default_model_concurrency
+        self.in_flight = FairSemaphore(max_in_flight)
+        self.model_semaphores: Dict[str, FairSemaphore] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.session_loop: Optional[asyncio.AbstractEventLoop] = None
+        # Every response's `x-ratelimit-*` headers are fed back here so the shared limiter learns our real quota
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RATE_LIMITER
+
+    def semaphore_for_model(self, model: str) -> FairSemaphore:
+        if model not in self.model_semaphores:
+            self.model_semaphores[model] = FairSemaphore(
+                self.per_model_concurrency.get(model, self.default_model_concurrency)
+            )
+        return self.model_semaphores[model]
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        # Sessions are bound to the loop they were created on, so a new `asyncio.run` gets a new pool
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop != loop:
+            await self.close_stale_session()
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout_s,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout_s),
+            )
+            self.session_loop = loop
+        return self.session
+
+    async def close_stale_session(self) -> None:
+        """Close a session left over from another event loop, so its connector and sockets aren't leaked."""
+        session, loop = self.session, self.session_loop
+        self.session = None
+        self.session_loop = None
+        if session is None or session.closed or loop is None:
+            return
+        if loop.is_closed():
+            # Nothing can run on its loop any more, so this just releases the session and connector
+            await session.close()
+        else:
+            # Its transports belong to that loop (e.g. in another thread), so close them there
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        kwargs.setdefault("model", "gpt-4")
+        kwargs["stream"] = True
+        model_semaphore = self.semaphore_for_model(kwargs["model"])
+        await model_semaphore.acquire()
+        try:
+            await self.in_flight.acquire()
+            try:
+                async for r in self._stream(messages, kwargs):
+                    yield r
+            finally:
+                self.in_flight.release()
+        finally:
+            model_semaphore.release()
+
+    async def _stream(
+        self, messages: List[Dict[str, str]], kwargs: Dict[str, Any]
+    ) -> AsyncGenerator[str, None]:
+        headers = {"Authorization": f"Bearer {self.api_key or openai.api_key}"}
+        session = await self.get_session()
+        async with session.post(
+            f"{self.api_base}/chat/completions",
+            json={"messages": messages, **kwargs},
+            headers=headers,
+        ) as response:
+            self.rate_limiter.update_from_headers(kwargs["model"], response.headers)
+            if response.status != 200:
+                raise self.error_for_response(
+                    response.status, await response.text(), dict(response.headers)
+                )
+            async for line in response.content:
+                # Server-sent events: we only care about `data: {...}` lines
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:") :].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                r = chunk["choices"][0]["delta"].get("content")
+                if r:
+                    yield r
+
+    @staticmethod
+    def error_for_response(
+        status: int, body: str, headers: Dict[str, str]
+    ) -> OpenAIError:
+        """Map HTTP failures onto the same `openai.error` types the library raises, so callers retry the same way."""
+        try:
+            json_body = json.loads(body)
+        except ValueError:
+            json_body = None
+        message = body
+        if isinstance(json_body, dict):
+            error = json_body.get("error")
+            if isinstance(error, dict):
+                message = error.get("message", body)
+        error_kwargs: Dict[str, Any] = {
+            "http_body": body,
+            "http_status": status,
+            "json_body": json_body,
+            "headers": headers,
+        }
+        if status == 429:
+            return RateLimitError(message, **error_kwargs)
+        elif status == 503:
+            return ServiceUnavailableError(message, **error_kwargs)
+        elif status == 401:
+            return AuthenticationError(message, **error_kwargs)
+        elif status in (400, 404):
+            return InvalidRequestError(message, None, **error_kwargs)
+        return APIError(message, **error_kwargs)
+
+    async def close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.session_loop = None
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from typing import Dict, List, Mapping, Optional
+
+from src.philipwilcox.lib.openai.token_counter import get_default_token_counter
+
+logger = logging.getLogger(__name__)
+
+# OpenAI reports resets like "1s", "6m0s" or "120ms"
+RESET_DURATION_PATTERN = re.compile(r"(?P<value>\d+(?:\.\d+)?)(?P<unit>ms|h|m|s)")
+RESET_UNIT_SECONDS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: str) -> Optional[float]:
+    matches = list(RESET_DURATION_PATTERN.finditer(value))
+    if not matches:
+        return None
+    return sum(
+        float(m.group("value")) * RESET_UNIT_SECONDS[m.group("unit")] for m in matches
+    )
+
+
+def estimate_message_tokens(message: Dict[str, str]) -> int:
+    return get_default_token_counter().count_message(message)
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    return get_default_token_counter().count_messages(messages)
+
+
+class TokenBucket:
+    """A per-minute budget that refills continuously; a `None` capacity means we don't know the limit yet."""
+
+    def __init__(self, capacity_per_minute: Optional[float] = None) -> None:
+        self.capacity = capacity_per_minute
+        self.available = capacity_per_minute or 0.0
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.capacity is None:
+            return
+        elapsed = now - self.updated
+        self.available = min(
+            self.capacity, self.available + elapsed * self.capacity / 60.0
+        )
+        self.updated = now
+
+    def seconds_until_available(self, amount: float, now: float) -> float:
+        if self.capacity is None:
+            return 0.0
+        self.refill(now)
+        # Never wait on a request bigger than the whole bucket; it would never fit
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60.0 / self.capacity
+
+    def consume(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.available -= amount
+
+    def set_capacity(self, capacity_per_minute: float, now: float) -> None:
+        if self.capacity is None:
+            self.available = capacity_per_minute
+        self.refill(now)
+        self.capacity = capacity_per_minute
+        self.available = min(self.available, capacity_per_minute)
+
+    def set_remaining(self, remaining: float, now: float) -> None:
+        if self.capacity is not None:
+            self.available = min(self.available, remaining)
+            self.updated = now
+
+
+class ModelRateLimitState:
+    def __init__(
+        self, requests_per_minute: Optional[float], tokens_per_minute: Optional[float]
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+
+
+class RateLimiter:
+    """Process-wide requests-per-minute and tokens-per-minute limiter, shared by every PersonaMessenger.
+
+    Limits can be configured up front or learned from `x-ratelimit-*` response headers, which OpenAILibraryTransport
+    (the default) and PooledHttpTransport both feed back on every response; any other transport only teaches it
+    limits through the headers of the 429s it raises, so configure limits for those. Until a model's limits are
+    known, `acquire` doesn't wait. `headroom` keeps us slightly under the advertised quota so a fleet of personas
+    doesn't bounce off it; on a 429 every messenger on that model pauses together instead of each one retrying on its
+    own schedule.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[Dict[str, float]] = None,
+        tokens_per_minute: Optional[Dict[str, float]] = None,
+        headroom: float = 0.95,
+        max_backoff_s: float = 60.0,
+    ) -> None:
+        self.configured_requests_per_minute = requests_per_minute or {}
+        self.configured_tokens_per_minute = tokens_per_minute or {}
+        self.headroom = headroom
+        self.max_backoff_s = max_backoff_s
+        self.models: Dict[str, ModelRateLimitState] = {}
+
+    def set_limits(
+        self,
+        model: str,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        """Configure `model`'s limits, which then take precedence over any learned from response headers."""
+        state = self.state_for_model(model)
+        now = time.monotonic()
+        if requests_per_minute:
+            self.configured_requests_per_minute[model] = requests_per_minute
+            state.requests.set_capacity(requests_per_minute * self.headroom, now)
+        if tokens_per_minute:
+            self.configured_tokens_per_minute[model] = tokens_per_minute
+            state.tokens.set_capacity(tokens_per_minute * self.headroom, now)
+
+    def state_for_model(self, model: str) -> ModelRateLimitState:
+        if model not in self.models:
+            rpm = self.configured_requests_per_minute.get(model)
+            tpm = self.configured_tokens_per_minute.get(model)
+            self.models[model] = ModelRateLimitState(
+                rpm * self.headroom if rpm else None,
+                tpm * self.headroom if tpm else None,
+            )
+        return self.models[model]
+
+    async def acquire(self, model: str, estimated_tokens: int) -> float:
+        """Wait until `model` has budget for one request of `estimated_tokens`; returns seconds spent waiting."""
+        state = self.state_for_model(model)
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            wait_s = max(
+                state.paused_until - now,
+                state.requests.seconds_until_available(1, now),
+                state.tokens.seconds_until_available(estimated_tokens, now),
+            )
+            if wait_s <= 0:
+                state.requests.consume(1)
+                state.tokens.consume(estimated_tokens)
+                return waited
+            # A little jitter so everybody waiting on the same bucket doesn't wake up on the same tick
+            wait_s += random.uniform(0, min(wait_s, 1.0) * 0.1)
+            await asyncio.sleep(wait_s)
+            waited += wait_s
+
+    def update_from_headers(
+        self, model: str, headers: Optional[Mapping[str, str]]
+    ) -> None:
+        if not headers:
+            return
+        headers = {k.lower(): v for k, v in headers.items()}
+        state = self.state_for_model(model)
+        now = time.monotonic()
+        for bucket, kind in ((state.requests, "requests"), (state.tokens, "tokens")):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            if limit is not None and model not in self.configured_limits(kind):
+                try:
+                    bucket.set_capacity(float(limit) * self.headroom, now)
+                except ValueError:
+                    pass
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is not None:
+                try:
+                    bucket.set_remaining(float(remaining), now)
+                except ValueError:
+                    pass
+
+    def configured_limits(self, kind: str) -> Dict[str, float]:
+        if kind == "requests":
+            return self.configured_requests_per_minute
+        return self.configured_tokens_per_minute
+
+    def on_rate_limited(
+        self, model: str, headers: Optional[Mapping[str, str]], attempt: int
+    ) -> float:
+        """Pause every request for `model` after a 429; returns the pause applied, in seconds."""
+        self.update_from_headers(model, headers)
+        pause_s: Optional[float] = None
+        if headers:
+            lowered = {k.lower(): v for k, v in headers.items()}
+            if "retry-after" in lowered:
+                try:
+                    pause_s = float(lowered["retry-after"])
+                except ValueError:
+                    pause_s = None
+            if pause_s is None:
+                resets = [
+                    parse_reset_duration(lowered[h])
+                    for h in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+                    if h in lowered
+                ]
+                known_resets = [r for r in resets if r is not None]
+                if known_resets:
+                    pause_s = max(known_resets)
+        if pause_s is None:
+            pause_s = self.backoff_seconds(attempt, 1.0)
+        state = self.state_for_model(model)
+        state.paused_until = max(state.paused_until, time.monotonic() + pause_s)
+        return pause_s
+
+    def backoff_seconds(self, attempt: int, base_s: float) -> float:
+        """Full-jitter exponential backoff: uniform in [0, base * 2^(attempt - 1)], capped at `max_backoff_s`."""
+        return random.uniform(0, min(self.max_backoff_s, base_s * 2 ** (attempt - 1)))
+
+
+RATE_LIMITER = RateLimiter()
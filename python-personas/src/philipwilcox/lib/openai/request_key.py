@@ -0,0 +1,26 @@
+import hashlib
+import json
+from typing import Dict, List
+
+
+def message_fragment(message_dict: Dict[str, str]) -> bytes:
+    return (
+        json.dumps(message_dict, ensure_ascii=False, separators=(",", ":")) + "\n"
+    ).encode("utf-8")
+
+
+def digest_of(messages: List[Dict[str, str]]) -> str:
+    """The digest of a request's messages, hashing each one's `message_fragment` in order.
+
+    Hashing fragment by fragment lets a growing conversation keep a running hash and extend it a message at a time.
+    """
+    h = hashlib.sha256()
+    for d in messages:
+        h.update(message_fragment(d))
+    return h.hexdigest()
+
+
+def request_key(model: str, temperature: float, messages_digest: str) -> str:
+    """Identifies a chat completion request, for looking up a recorded or cached response to it."""
+    payload = json.dumps([model, temperature, messages_digest])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import re
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Sequence
+
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+)
+
+# Part of DelegatingPersona's response format instructions, so a coordinator's prompt carries it
+RESPONSE_FORMAT_MARKER = 'header of "Recipient"'
+# How `format_for_prompt` lists each persona a coordinator can delegate to
+RECIPIENT_NAME_PATTERN = re.compile(r'^\s*"name": "((?:[^"\\]|\\.)*)"', re.MULTILINE)
+# Starts every message a synthetic coordinator delegates
+DELEGATION_PREFIX = "[synthetic delegation]"
+
+FILLER_WORDS = (
+    "the quick brown fox jumps over a lazy dog while a cautious cat watches from "
+    "the warm sill and hums an old tune about rain on tin roofs"
+).split()
+
+
+def has_response_format_instructions(messages: List[Dict[str, str]]) -> bool:
+    return any(RESPONSE_FORMAT_MARKER in m["content"] for m in messages[:2])
+
+
+def is_not_delegated(messages: List[Dict[str, str]]) -> bool:
+    """For delegating personas whose coordinator prompt doesn't carry the format instructions: anything that isn't
+    talking to a synthetic coordinator's delegation must be the coordinator itself. Only right when delegates are
+    never called other than by a coordinator, i.e. Agent delegation, not Linear.
+    """
+    return not any(
+        m["role"] == "user" and m["content"].startswith(DELEGATION_PREFIX)
+        for m in messages
+    )
+
+
+class SyntheticTransport(ChatCompletionTransport):
+    """Makes up well-formed responses locally, streamed at a configurable rate, for load testing the persona stack.
+
+    A coordinator (by default, any request whose prompt has the response format instructions) delegates
+    `delegations_per_request` times per inbound message, to each recipient in turn, then gives a final response: a
+    Markdown Reasoning/Message/Recipient reply in either block order, whichever the prompt asks for. Everyone else
+    replies with a JSON code block. Final and JSON responses are `json_response`, with every None value filled with
+    `response_words` words. Recipients are the persona names listed in the coordinator's prompt, unless given.
+
+    Responses depend only on the request, so a run is repeatable, and a restored or rolled back persona carries on
+    where its history says it is. Chunks of `chars_per_chunk` stand in for tokens: the first arrives after
+    `time_to_first_token_s`, then `tokens_per_second` of them (or as fast as possible for None).
+    """
+
+    needs_api_key = False
+
+    def __init__(
+        self,
+        tokens_per_second: Optional[float] = 50.0,
+        time_to_first_token_s: float = 0.3,
+        chars_per_chunk: int = 4,
+        delegations_per_request: int = 2,
+        response_words: int = 20,
+        json_response: Optional[Dict[str, Any]] = None,
+        recipients: Optional[Sequence[str]] = None,
+        is_coordinator: Callable[
+            [List[Dict[str, str]]], bool
+        ] = has_response_format_instructions,
+    ) -> None:
+        self.tokens_per_second = tokens_per_second
+        self.time_to_first_token_s = time_to_first_token_s
+        self.chars_per_chunk = chars_per_chunk
+        self.delegations_per_request = delegations_per_request
+        self.response_words = response_words
+        self.json_response = (
+            json_response
+            if json_response is not None
+            else {"name": "", "line": None, "mood": "calm"}
+        )
+        self.recipients = recipients
+        self.is_coordinator = is_coordinator
+        self.requests = 0
+        self.coordinator_requests = 0
+        self.chunks_sent = 0
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        self.requests += 1
+        if self.is_coordinator(messages):
+            self.coordinator_requests += 1
+            text = self.coordinator_response(messages)
+        else:
+            text = f"```\n{self.json_text(messages)}\n```"
+        chunk_delay_s = (
+            1 / self.tokens_per_second if self.tokens_per_second is not None else 0
+        )
+        await asyncio.sleep(self.time_to_first_token_s)
+        for i in range(0, len(text), self.chars_per_chunk):
+            if i > 0:
+                await asyncio.sleep(chunk_delay_s)
+            self.chunks_sent += 1
+            yield text[i : i + self.chars_per_chunk]
+
+    def coordinator_response(self, messages: List[Dict[str, str]]) -> str:
+        # Every inbound message gets the same number of coordinator replies, so where we are follows from the history
+        replies = sum(1 for m in messages if m["role"] == "assistant")
+        step = replies % (self.delegations_per_request + 1)
+        recipients = self.recipients_for(messages)
+        if step < self.delegations_per_request and recipients:
+            recipient = recipients[step % len(recipients)]
+            message = f"{DELEGATION_PREFIX} {self.words(replies)}"
+        else:
+            recipient = "null"
+            message = self.json_text(messages)
+        blocks = {
+            "Reasoning": f"Step {step}: {self.words(replies + 1)}",
+            "Message": message,
+            "Recipient": recipient,
+        }
+        order = ["Reasoning", "Message", "Recipient"]
+        prompt = "".join(m["content"] for m in messages[:2])
+        if 'The first one should follow a header of "Recipient"' in prompt:
+            order = ["Recipient", "Message", "Reasoning"]
+        return "\n\n".join(f"## {b}\n```\n{blocks[b]}\n```" for b in order) + "\n"
+
+    def recipients_for(self, messages: List[Dict[str, str]]) -> Sequence[str]:
+        if self.recipients is not None:
+            return self.recipients
+        return [
+            json.loads(f'"{name}"')
+            for m in messages[:2]
+            for name in RECIPIENT_NAME_PATTERN.findall(m["content"])
+        ]
+
+    def json_text(self, messages: List[Dict[str, str]]) -> str:
+        return json.dumps(
+            {
+                k: v if v is not None else self.words(len(messages))
+                for k, v in self.json_response.items()
+            }
+        )
+
+    def words(self, offset: int) -> str:
+        return " ".join(
+            FILLER_WORDS[(offset + i) % len(FILLER_WORDS)]
+            for i in range(self.response_words)
+        )
@@ -0,0 +1,105 @@
+import abc
+import logging
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Chat-format framing: every message is wrapped in a few special tokens, and every request primes the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY_PRIMING = 3
+
+# A rough version of the cl100k pre-tokenizer: contractions, words with their leading space, runs of up to three
+# digits, punctuation runs, and whitespace
+PRETOKEN_PATTERN = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+"
+)
+# Common words are a single token; longer ones get split into roughly this many characters per token
+CHARS_PER_WORD_TOKEN = 6
+
+# USD per 1,000 (prompt, completion) tokens
+MODEL_PRICES_PER_1K_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """0.0 for models we don't have prices for, rather than failing the call that's being recorded."""
+    prices = MODEL_PRICES_PER_1K_TOKENS.get(model)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+
+class TokenCounter(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def count_text(self, text: str) -> int:
+        pass
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.count_text(message["content"]) + TOKENS_PER_MESSAGE
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count_message(m) for m in messages) + TOKENS_PER_REPLY_PRIMING
+
+
+class HeuristicTokenCounter(TokenCounter):
+    """Approximates cl100k token counts with a regex; needs no network access or extra packages.
+
+    Close enough for budgeting and for finding the expensive prompts; use TiktokenTokenCounter for exact numbers.
+    """
+
+    def count_text(self, text: str) -> int:
+        count = 0
+        for piece in PRETOKEN_PATTERN.findall(text):
+            stripped = piece.lstrip(" ")
+            if stripped and not stripped[0].isspace():
+                count += max(1, math.ceil(len(stripped) / CHARS_PER_WORD_TOKEN))
+            else:
+                count += 1
+        return count
+
+
+class TiktokenTokenCounter(TokenCounter):
+    """Exact counts via `tiktoken`, if it's installed and its encoding files are already cached locally.
+
+    tiktoken downloads encodings on first use; point TIKTOKEN_CACHE_DIR at a pre-populated directory to run offline.
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base") -> None:
+        if tiktoken is None:
+            raise ImportError("tiktoken is not installed")
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def count_text(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+DEFAULT_TOKEN_COUNTER: TokenCounter = HeuristicTokenCounter()
+
+
+def set_default_token_counter(counter: TokenCounter) -> None:
+    global DEFAULT_TOKEN_COUNTER
+    DEFAULT_TOKEN_COUNTER = counter
+
+
+def get_default_token_counter() -> TokenCounter:
+    return DEFAULT_TOKEN_COUNTER
+
+
+def try_tiktoken_token_counter() -> Optional[TokenCounter]:
+    """A TiktokenTokenCounter if one can be built without erroring (e.g. offline with no cached encoding), else None."""
+    try:
+        return TiktokenTokenCounter()
+    except Exception as e:
+        logger.info(f"Not using tiktoken for token counts: {e}")
+        return None
@@ -1,8 +1,13 @@
-from typing import Dict, Any, Optional, List
+import asyncio
+import copy
+from typing import Dict, Any, Optional, List, Callable, AsyncIterator
 
 from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
 from src.philipwilcox.personas.api.model.llm_facing_info import LlmFacingInfo
 from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    PersonaHistoryListener,
+)
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
     PersonaModelInitPromptTemplate,
@@ -13,8 +18,14 @@ from src.philipwilcox.personas.api.model.proposed_persona_response import (
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.persona_context_strategy import (
+    PersonaContextStrategy,
+)
+from src.philipwilcox.personas.api.persona_deadline import persona_deadline
 from src.philipwilcox.personas.api.persona_messenger import PersonaMessenger
 from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+from src.philipwilcox.personas.api.util.persona_tracing import span
 
 
 class BasicPersona(ResponseDrivenPersona):
@@ -29,32 +40,85 @@ class BasicPersona(ResponseDrivenPersona):
         llm_facing_info: Optional[LlmFacingInfo] = None,
         resend_conversation_history: bool = True,
         streaming_console_mode: bool = False,
+        llm_model: str = "gpt-4",
+        context_strategy: Optional[PersonaContextStrategy] = None,
+        timeout_s: Optional[float] = None,
     ):
         # TODO: document that template_kwargs are what is PASSED IN to this agent's LLM prompt; LLM-facing-info is used to tell a PARENT COORDINATING LLM how to use this agent
         self.name = name
         self.llm_facing_info = llm_facing_info
+        self.timeout_s = timeout_s
         self.messenger = PersonaMessenger(
             init_prompt_template,
             template_kwargs,
             open_ai,
             resend_conversation_history=resend_conversation_history,
             streaming_console_mode=streaming_console_mode,
+            llm_model=llm_model,
+            context_strategy=context_strategy,
         )
 
     def get_name(self) -> str:
         # TODO: can I put name in the abstract base one and avoid this boilerplate every time?
         return self.name
 
-    async def send_message(self, message: str) -> ProposedPersonaResponse:
-        r = await self.messenger.send(PersonaMessage.create_user_message(message))
+    async def send_message(
+        self, message: str, on_chunk: Optional[Callable[[str], None]] = None
+    ) -> ProposedPersonaResponse:
+        with span("BasicPersona.send_message", persona=self.name):
+            async with persona_deadline(self.timeout_s):
+                r = await self.messenger.send(
+                    PersonaMessage.create_user_message(message), on_chunk=on_chunk
+                )
         return ProposedPersonaResponse(r.content)
 
+    async def stream_message(self, message: str) -> AsyncIterator[str]:
+        """Send `message`, yielding the response's chunks as they arrive rather than once it's complete.
+
+        As with `on_chunk`, a retried request streams again from the start; once iteration ends the complete
+        response is `get_last_assistant_response()`. Errors from the send are raised from the iterator. Closing it
+        early (break out inside `contextlib.aclosing` to close it straight away) or cancelling it cancels the send,
+        which rolls `message` back out of the history.
+        """
+        chunks: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+        async def send() -> None:
+            try:
+                await self.send_message(message, on_chunk=chunks.put_nowait)
+            finally:
+                chunks.put_nowait(None)
+
+        task = asyncio.create_task(send())
+        try:
+            while (chunk := await chunks.get()) is not None:
+                yield chunk
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+    def add_chunk_listener(self, on_chunk: Callable[[str], None]) -> None:
+        """Have `on_chunk` see every chunk this persona streams from now on, from any caller's send.
+
+        It's called on the event loop for each chunk, so it mustn't block; an exception from it fails the send.
+        """
+        self.messenger.chunk_listeners.append(on_chunk)
+
+    def remove_chunk_listener(self, on_chunk: Callable[[str], None]) -> None:
+        self.messenger.chunk_listeners.remove(on_chunk)
+
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
         if len(history.subhistories) > 0:
             raise PersonaException(
                 "A BasicPersona without delegation cannot be instantiated from history that includes sub-persona histories"
             )
-        self.messenger.history = history.messages
+        with span(
+            "BasicPersona.set_history",
+            persona=self.name,
+            messages=len(history.messages),
+        ):
+            self.messenger.history = history.messages
 
     def get_history(self) -> ResponseDrivenPersonaHistory:
         # For a non-delegating agent "history" vs "final history" is the same
@@ -62,6 +126,17 @@ class BasicPersona(ResponseDrivenPersona):
             self.messenger.history, self.messenger.history, {}
         )
 
+    def total_usage(self) -> TokenUsage:
+        return self.messenger.usage
+
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        self.messenger.history_listeners.add(listener)
+
+    def clone(self) -> "BasicPersona":
+        clone = copy.copy(self)
+        clone.messenger = self.messenger.clone()
+        return clone
+
     async def send_message_and_process_autonomously(self, message: str) -> str:
         return (await self.send_message(message)).message
 
@@ -0,0 +1,35 @@
+from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
+from src.philipwilcox.personas.api.basic_persona import BasicPersona
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
+    PersonaModelInitPromptTemplate,
+)
+
+CONTEXT_SUMMARIZER_INIT_MESSAGES = PersonaModelInitPromptTemplate(
+    [
+        PersonaMessage.create_system_message(
+            "You summarize conversations so they can be continued without the full transcript."
+        ),
+        PersonaMessage.create_user_message(
+            """Each message to you will contain conversation messages, one per paragraph, prefixed with the role of the speaker, and may start with a summary of the conversation so far.
+
+Reply with an updated summary of the whole conversation in at most {{ max_words }} words. Keep names, decisions, open questions and any facts that later messages may depend on; leave out pleasantries. Reply with only the summary text."""
+        ),
+    ],
+    keep_compiled=True,
+)
+
+
+def create_context_summarizer_persona(
+    open_ai: OpenAIWrapper, llm_model: str = "gpt-3.5-turbo", max_words: int = 300
+) -> BasicPersona:
+    """A persona for RollingSummaryContextStrategy; every request carries the previous summary, so no history is
+    resent."""
+    return BasicPersona(
+        CONTEXT_SUMMARIZER_INIT_MESSAGES,
+        {"max_words": max_words},
+        open_ai,
+        name="Context Summarizer",
+        resend_conversation_history=False,
+        llm_model=llm_model,
+    )
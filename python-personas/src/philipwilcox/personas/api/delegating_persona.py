@@ -1,23 +1,32 @@
 import abc
-from typing import Any, Optional
+import copy
+from typing import TYPE_CHECKING, Any, Optional
 
 from src.philipwilcox.personas.api.model.llm_facing_info import LlmFacingInfo
 from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    PersonaHistoryListener,
+)
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 from src.philipwilcox.personas.api.persona_message_delegator import (
     PersonaMessageDelegator,
 )
 from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
 
+if TYPE_CHECKING:
+    from src.philipwilcox.personas.api.model.persona_timeline import PersonaTimeline
+
 
 class DelegatingPersona(ResponseDrivenPersona):
     def __init__(self, delegator: PersonaMessageDelegator):
         self.delegator = delegator
+        self.timeline: Optional["PersonaTimeline"] = None
 
     @abc.abstractmethod
     def get_name(self) -> str:
@@ -61,33 +70,68 @@ class DelegatingPersona(ResponseDrivenPersona):
             'have the name of the recipient persona to which you\'re delegating.\n\nHere are some examples:\n"""\n## Reasoning\n```\nThe reasoning for this step reasoning goes here.\n```\n\n## Message\n```\nThis is a sample message to the next subpersona.\n```\n\n## Recipient\n```\nExample Persona (Equation Processor)\n```\n"""\n\n"""\n## Reasoning\n```\nWe need to hand this off to the goal evaluator persona.\n```\n\n## Message\n```\nDid this message align with our goals: Pizza is awesome!.\n```\n\n## Recipient\n```\nExample Persona (Goal Evaluator)\n```\n"""\n'
         )
 
+    def get_speculative_response_format_instructions(self) -> str:
+        """Like `get_response_format_instructions`, but with the Recipient and Message blocks first.
+
+        With speculative delegation the delegate is called as soon as both have streamed in, so the Reasoning block
+        streams while the delegate is already working. The trade-off is that the model commits to a delegation before
+        writing down its reasoning.
+        """
+        return (
+            "You should respond with three consecutive Markdown multi-line code "
+            'blocks. The first one should follow a header of "Recipient" and should have the name of the recipient '
+            "persona to which you're delegating. The second one should follow a header of "
+            '"Message" and should contain just the string text of the message you wish to send to the next '
+            'persona. The third one should follow a header of "Reasoning" and describe '
+            'your reasoning for the selection.\n\nHere are some examples:\n"""\n## Recipient\n```\nExample Persona (Equation Processor)\n```\n\n## Message\n```\nThis is a sample message to the next subpersona.\n```\n\n## Reasoning\n```\nThe reasoning for this step reasoning goes here.\n```\n"""\n\n"""\n## Recipient\n```\nExample Persona (Goal Evaluator)\n```\n\n## Message\n```\nDid this message align with our goals: Pizza is awesome!.\n```\n\n## Reasoning\n```\nWe need to hand this off to the goal evaluator persona.\n```\n"""\n'
+        )
+
+    @property
+    def timeout_s(self) -> Optional[float]:
+        """Applies to each step of the delegator, i.e. each send_message or process_proposed_response."""
+        return self.delegator.timeout_s
+
+    @timeout_s.setter
+    def timeout_s(self, timeout_s: Optional[float]) -> None:
+        self.delegator.timeout_s = timeout_s
+
     def get_subpersona_by_name(self, name: str) -> ResponseDrivenPersona:
         return self.delegator.get_subpersona_by_name(name)
 
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        self.delegator.add_history_listener(listener)
+
+    def total_usage(self) -> TokenUsage:
+        return self.delegator.total_usage()
+
     def get_llm_facing_info(self) -> LlmFacingInfo:
         raise PersonaException(
             "LLM-facing info not implemented for this Persona, please implement this to return a dict of strings for use in prompting a coordinating persona's LLM if desired."
         )
 
-    def get_last_assistant_response(self) -> Optional[ProposedPersonaResponse]:
-        # Local import to prevent circular dep vs shoving these into one file. :(
-        from src.philipwilcox.personas.api.model.response_driven_persona_flat_history import (
-            ResponseDrivenPersonaFlatHistory,
-        )
+    def clone(self) -> "DelegatingPersona":
+        clone = copy.copy(self)
+        clone.timeline = None
+        DelegatingPersona.__init__(clone, self.delegator.clone(clone))
+        return clone
 
-        flat_history = ResponseDrivenPersonaFlatHistory.from_nested_history(
-            self.get_history(), self
-        )
-        assistant_messages = [
-            m
-            for m in flat_history.messages
-            if isinstance(m.message, AssistantPersonaMessage)
-        ]
-        if len(assistant_messages) == 0:
+    def get_timeline(self) -> "PersonaTimeline":
+        """Every message in this persona's delegation tree in time order, maintained as the persona runs."""
+        if self.timeline is None:
+            # Local import to prevent circular dep vs shoving these into one file. :(
+            from src.philipwilcox.personas.api.model.persona_timeline import (
+                PersonaTimeline,
+            )
+
+            self.timeline = PersonaTimeline(self)
+        return self.timeline
+
+    def get_last_assistant_response(self) -> Optional[ProposedPersonaResponse]:
+        last_message = self.get_timeline().last_assistant_message()
+        if last_message is None:
             return None
         else:
-            last_message = assistant_messages[-1]
-            if len(last_message.stack) > 0:
+            if last_message.stack[-1] is not self:
                 # go directly to the source
                 last_agent = last_message.stack[-1]
                 return last_agent.get_last_assistant_response()
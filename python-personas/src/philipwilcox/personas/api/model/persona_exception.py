@@ -1,2 +1,6 @@
 class PersonaException(Exception):
     pass
+
+
+class PersonaDeadlineExceeded(PersonaException, TimeoutError):
+    """A persona ran out of the time it was given; see persona_deadline. The step it was on was rolled back."""
@@ -0,0 +1,138 @@
+import abc
+import functools
+from enum import Enum
+from typing import (
+    Any,
+    Callable,
+    Concatenate,
+    Coroutine,
+    List,
+    ParamSpec,
+    Protocol,
+    Tuple,
+    TypeVar,
+)
+
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+
+# Names of the subpersonas leading from the persona a listener was added to down to where something happened
+HistoryPath = Tuple[str, ...]
+
+
+class HistoryRecordKind(Enum):
+    # Only in ResponseDrivenPersonaHistory.messages
+    MESSAGE = "m"
+    # Only in ResponseDrivenPersonaHistory.final_messages
+    FINAL_MESSAGE = "f"
+    # In both, for personas whose messages and final messages are the same list
+    MESSAGE_AND_FINAL_MESSAGE = "b"
+
+
+class PersonaHistoryListener(metaclass=abc.ABCMeta):
+    """Told about every change to a persona's history as it happens, e.g. to persist it incrementally.
+
+    Added with `ResponseDrivenPersona.add_history_listener`; a delegating persona passes events up from its
+    subpersonas with their names prepended to `path`.
+    """
+
+    @abc.abstractmethod
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        """The message may still be re-timed until the current step finishes; don't rely on its timestamp before."""
+
+    @abc.abstractmethod
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        """The history at `path` was replaced or rolled back wholesale rather than appended to."""
+
+    @abc.abstractmethod
+    def on_step_finished(self, path: HistoryPath) -> None:
+        """The persona at `path` finished handling a send or a proposed response."""
+
+
+class SubpersonaHistoryListener(PersonaHistoryListener):
+    """Relays a subpersona's events to its delegating persona's listener, under the subpersona's name."""
+
+    def __init__(self, listener: PersonaHistoryListener, name: str) -> None:
+        self.listener = listener
+        self.name = name
+
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        self.listener.on_message_appended((self.name,) + path, kind, message)
+
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        self.listener.on_history_replaced((self.name,) + path)
+
+    def on_step_finished(self, path: HistoryPath) -> None:
+        self.listener.on_step_finished((self.name,) + path)
+
+
+class CoordinatorHistoryListener(PersonaHistoryListener):
+    """Relays a coordinating persona's events as its delegating persona's own `messages`.
+
+    The coordinator finishing a step is only part of the delegating persona's step, so those events are dropped.
+    """
+
+    def __init__(self, listener: PersonaHistoryListener) -> None:
+        self.listener = listener
+
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        self.listener.on_message_appended(path, HistoryRecordKind.MESSAGE, message)
+
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        self.listener.on_history_replaced(path)
+
+    def on_step_finished(self, path: HistoryPath) -> None:
+        pass
+
+
+class HistoryListeners:
+    """The listeners added to one persona (or messenger or delegator), notified in the order they were added."""
+
+    def __init__(self) -> None:
+        self.listeners: List[PersonaHistoryListener] = []
+
+    def add(self, listener: PersonaHistoryListener) -> None:
+        self.listeners.append(listener)
+
+    def message_appended(
+        self, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        for listener in self.listeners:
+            listener.on_message_appended((), kind, message)
+
+    def history_replaced(self) -> None:
+        for listener in self.listeners:
+            listener.on_history_replaced(())
+
+    def step_finished(self) -> None:
+        for listener in self.listeners:
+            listener.on_step_finished(())
+
+
+class HasHistoryListeners(Protocol):
+    history_listeners: HistoryListeners
+
+
+S = TypeVar("S", bound=HasHistoryListeners)
+P = ParamSpec("P")
+T = TypeVar("T")
+
+
+def notifies_step_finished(
+    method: Callable[Concatenate[S, P], Coroutine[Any, Any, T]]
+) -> Callable[Concatenate[S, P], Coroutine[Any, Any, T]]:
+    """For a delegator's step methods: tell its `history_listeners` the step finished, however it returns."""
+
+    @functools.wraps(method)
+    async def wrapper(self: S, *args: P.args, **kwargs: P.kwargs) -> T:
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            self.history_listeners.step_finished()
+
+    return wrapper
@@ -1,8 +1,10 @@
 import datetime
+import time
 from enum import Enum
 from typing import Optional, Dict
 
 from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 
 
 class MessageRole(Enum):
@@ -11,13 +13,51 @@ class MessageRole(Enum):
     ASSISTANT = "assistant"
 
 
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def datetime_to_epoch_ns(timestamp: datetime.datetime) -> int:
+    """Naive datetimes are taken to be UTC."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def epoch_ns_to_datetime(timestamp_ns: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=timestamp_ns // 1000)
+
+
+def now_epoch_ns() -> int:
+    # Microsecond precision, like the datetimes this replaced, so every history format round-trips it exactly
+    return time.time_ns() // 1000 * 1000
+
+
 # TODO: rename this to "LlmMessage"?
 class PersonaMessage:
+    """Slotted and stored as plain ints and strings, since sessions keep hundreds of thousands of these live.
+
+    The timestamp is kept as UTC nanoseconds since the epoch (`timestamp_ns`), and only turned into a datetime when
+    `timestamp` is read; sort and compare on `timestamp_ns`.
+    """
+
+    __slots__ = (
+        "role",
+        "content",
+        "timestamp_ns",
+        "token_count",
+        "usage",
+        "inbound_usage",
+    )
+
     def __init__(
         self,
         role: str | MessageRole,
         content: str,
         timestamp: Optional[datetime.datetime] = None,
+        token_count: Optional[int] = None,
+        usage: Optional[TokenUsage] = None,
+        inbound_usage: Optional[TokenUsage] = None,
+        timestamp_ns: Optional[int] = None,
     ):
         if type(role) == str:
             if role not in MessageRole.__members__:
@@ -28,10 +68,28 @@ class PersonaMessage:
         else:
             self.role = role
         self.content = content
-        if timestamp is not None:
-            self.timestamp = timestamp
+        if timestamp_ns is not None:
+            self.timestamp_ns = timestamp_ns
+        elif timestamp is not None:
+            self.timestamp_ns = datetime_to_epoch_ns(timestamp)
         else:
-            self.timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+            self.timestamp_ns = now_epoch_ns()
+        # Size of this message as part of a request, filled in by the messenger that sends or receives it
+        self.token_count = token_count
+        # Only on assistant messages: what the call that produced this message cost, plus any calls made to fit its
+        # request into the context window (e.g. summarizing older messages)
+        self.usage = usage
+        # Only on a delegating persona's final messages: everything its delegation tree spent answering the inbound
+        # message, broken down per subpersona
+        self.inbound_usage = inbound_usage
+
+    @property
+    def timestamp(self) -> datetime.datetime:
+        return epoch_ns_to_datetime(self.timestamp_ns)
+
+    @timestamp.setter
+    def timestamp(self, value: datetime.datetime) -> None:
+        self.timestamp_ns = datetime_to_epoch_ns(value)
 
     def create_system_message(content: str,
                               timestamp: Optional[datetime.datetime] = None,) -> "PersonaMessage":
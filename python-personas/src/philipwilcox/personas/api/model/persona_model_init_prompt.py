@@ -1,17 +1,148 @@
+import collections
 import dataclasses
-from typing import Any, Dict, List
-
-from jinja2 import Template
+import hashlib
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
+
+logger = logging.getLogger(__name__)
+
+# Every prompt template is compiled in this one environment; its defaults are the ones `jinja2.Template` uses. Made
+# on first use, so that importing personas (and their prompts) doesn't import Jinja.
+PROMPT_ENVIRONMENT: Optional["Environment"] = None
+
+
+def get_prompt_environment() -> "Environment":
+    global PROMPT_ENVIRONMENT
+    if PROMPT_ENVIRONMENT is None:
+        from jinja2 import Environment
+
+        PROMPT_ENVIRONMENT = Environment()
+    return PROMPT_ENVIRONMENT
+
+
+@dataclasses.dataclass
+class PromptTemplateStats:
+    renders: int = 0
+    render_seconds: float = 0.0
+    compiles: int = 0
+    compile_seconds: float = 0.0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def reset(self) -> None:
+        self.renders = 0
+        self.render_seconds = 0.0
+        self.compiles = 0
+        self.compile_seconds = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+PROMPT_TEMPLATE_STATS = PromptTemplateStats()
+
+
+class CompiledTemplateCache:
+    """Compiled templates, least recently used first, keyed by a digest of their source.
+
+    Factories build a new PersonaModelInitPromptTemplate for every persona they create, but from the same few
+    sources, so each source is normally parsed and compiled once per process. Bounded in case prompts ever get
+    generated per persona.
+    """
+
+    def __init__(
+        self,
+        environment: Optional["Environment"] = None,
+        max_entries: int = 256,
+        stats: Optional[PromptTemplateStats] = None,
+    ) -> None:
+        self.environment = environment
+        self.max_entries = max_entries
+        self.stats = stats if stats is not None else PromptTemplateStats()
+        self.entries: collections.OrderedDict[
+            str, "Template"
+        ] = collections.OrderedDict()
+
+    @staticmethod
+    def key_for(source: str) -> str:
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    def get(self, source: str) -> "Template":
+        key = self.key_for(source)
+        template = self.entries.get(key)
+        if template is not None:
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return template
+        self.stats.misses += 1
+        started = time.perf_counter()
+        environment = (
+            self.environment
+            if self.environment is not None
+            else get_prompt_environment()
+        )
+        template = environment.from_string(source)
+        self.stats.compiles += 1
+        self.stats.compile_seconds += time.perf_counter() - started
+        self.entries[key] = template
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats.evictions += 1
+            logger.debug("Evicted a compiled prompt template")
+        return template
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+# In PROMPT_ENVIRONMENT
+COMPILED_TEMPLATES = CompiledTemplateCache(stats=PROMPT_TEMPLATE_STATS)
+
+
+def compiled_template(source: str) -> "Template":
+    return COMPILED_TEMPLATES.get(source)
+
 
 @dataclasses.dataclass
 class PersonaModelInitPromptTemplate:
     messages: List[PersonaMessage]
+    # Hold on to the compiled messages once the template is first rendered (or `compile` is called), so later renders
+    # skip the cache lookup too; meant for module and class level templates. Later changes to `messages` aren't seen
+    # until `compiled` is reset to None.
+    keep_compiled: bool = False
+    compiled: Optional[List["Template"]] = dataclasses.field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def compile(self) -> List["Template"]:
+        if self.compiled is None:
+            self.compiled = [compiled_template(m.content) for m in self.messages]
+        return self.compiled
 
     def render(self, keyword_args: Dict[str, Any]) -> List[PersonaMessage]:
-        return [
-            PersonaMessage(m.role, Template(m.content).render(keyword_args))
-            for m in self.messages
+        started = time.perf_counter()
+        if self.compiled is not None:
+            templates = self.compiled
+        elif self.keep_compiled:
+            templates = self.compile()
+        else:
+            templates = [compiled_template(m.content) for m in self.messages]
+        rendered = [
+            PersonaMessage(m.role, t.render(keyword_args))
+            for m, t in zip(self.messages, templates)
         ]
+        PROMPT_TEMPLATE_STATS.renders += 1
+        PROMPT_TEMPLATE_STATS.render_seconds += time.perf_counter() - started
+        return rendered
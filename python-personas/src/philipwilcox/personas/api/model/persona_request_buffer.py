@@ -0,0 +1,80 @@
+import copy
+import hashlib
+from typing import Dict, List, Optional
+
+from src.philipwilcox.lib.openai.rate_limiter import estimate_message_tokens
+from src.philipwilcox.lib.openai.request_key import message_fragment
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+
+
+class PersonaRequestBuffer:
+    """Append-only, already-serialized view of the prompt plus conversation history that a messenger sends.
+
+    Its digest is `request_key.digest_of` its `dicts`, kept up to date a message at a time.
+
+    Every turn only serializes, hashes and estimates the size of the newly added message; the request dicts of
+    earlier turns (and their running digest and token estimate) are kept, so building a request doesn't get slower as
+    the history grows.
+    """
+
+    def __init__(self, prompt_messages: List[PersonaMessage]) -> None:
+        self.prompt_dicts = [m.as_dict() for m in prompt_messages]
+        self.prompt_hash = hashlib.sha256()
+        for d in self.prompt_dicts:
+            self.prompt_hash.update(message_fragment(d))
+        self.prompt_message_tokens = [
+            estimate_message_tokens(d) for d in self.prompt_dicts
+        ]
+        self.prompt_tokens = sum(self.prompt_message_tokens)
+        self.reset([])
+
+    def reset(self, history: List[PersonaMessage]) -> None:
+        # `dicts` is prompt + history in one list so it can be handed to the transport as-is, without concatenating
+        self.dicts: List[Dict[str, str]] = list(self.prompt_dicts)
+        self.hash = self.prompt_hash.copy()
+        self.history_tokens: List[int] = []
+        self.estimated_tokens = self.prompt_tokens
+        self.last_message: Optional[PersonaMessage] = None
+        self.history_length = 0
+        for m in history:
+            self.append(m)
+
+    def clone_empty(self) -> "PersonaRequestBuffer":
+        """A buffer for the same prompt with no history; shares the serialized prompt instead of rebuilding it."""
+        clone = copy.copy(self)
+        clone.reset([])
+        return clone
+
+    def append(self, m: PersonaMessage) -> None:
+        d = m.as_dict()
+        self.dicts.append(d)
+        self.hash.update(message_fragment(d))
+        if m.token_count is None:
+            m.token_count = estimate_message_tokens(d)
+        tokens = m.token_count
+        self.history_tokens.append(tokens)
+        self.estimated_tokens += tokens
+        self.last_message = m
+        self.history_length += 1
+
+    def message_tokens(self, index: int) -> int:
+        """Estimated size of `dicts[index]`, whether that's a prompt or a history message."""
+        prompt_count = len(self.prompt_dicts)
+        if index < prompt_count:
+            return self.prompt_message_tokens[index]
+        return self.history_tokens[index - prompt_count]
+
+    def is_in_sync_with(self, history: List[PersonaMessage]) -> bool:
+        """O(1) check that nobody edited the history list behind our back (e.g. popping a dangling user message)."""
+        if len(history) != self.history_length:
+            return False
+        return self.history_length == 0 or history[-1] is self.last_message
+
+    def digest(self) -> str:
+        return self.hash.hexdigest()
+
+    def digest_with(self, m: PersonaMessage) -> str:
+        """Digest of the prompt plus just `m`, for personas that don't resend their history."""
+        h = self.prompt_hash.copy()
+        h.update(message_fragment(m.as_dict()))
+        return h.hexdigest()
@@ -0,0 +1,169 @@
+import bisect
+import datetime
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryPath,
+    HistoryRecordKind,
+    PersonaHistoryListener,
+)
+from src.philipwilcox.personas.api.model.persona_message import (
+    PersonaMessage,
+    datetime_to_epoch_ns,
+)
+from src.philipwilcox.personas.api.model.response_driven_persona_flat_history import (
+    PersonaMessageWithStack,
+    merge_history_timeline,
+    timeline_key,
+)
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+
+logger = logging.getLogger(__name__)
+
+
+class TimelineIndex:
+    """Messages with their stacks, kept sorted by timestamp, with a parallel list of timestamps to bisect."""
+
+    def __init__(self, entries: Optional[List[PersonaMessageWithStack]] = None):
+        self.entries = entries if entries is not None else []
+        self.keys = [timeline_key(e) for e in self.entries]
+
+    def insert(self, entry: PersonaMessageWithStack, key: int) -> None:
+        """After any entries with the same timestamp; O(1) for the usual case of a message newer than all others."""
+        if not self.keys or key >= self.keys[-1]:
+            self.keys.append(key)
+            self.entries.append(entry)
+        else:
+            i = bisect.bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.entries.insert(i, entry)
+
+    def remove(self, entry: PersonaMessageWithStack, key: int) -> None:
+        i = bisect.bisect_left(self.keys, key)
+        while self.entries[i] is not entry:
+            i += 1
+        del self.keys[i]
+        del self.entries[i]
+
+    def last(self) -> Optional[PersonaMessageWithStack]:
+        return self.entries[-1] if self.entries else None
+
+    def between(self, start_ns: int, end_ns: int) -> List[PersonaMessageWithStack]:
+        return self.entries[
+            bisect.bisect_left(self.keys, start_ns) : bisect.bisect_left(
+                self.keys, end_ns
+            )
+        ]
+
+
+class PersonaTimeline(PersonaHistoryListener):
+    """Every message in a delegating persona's tree in time order, kept up to date as the persona runs.
+
+    Built once as a merge of each subpersona's history, then maintained from history listener events instead of
+    being re-flattened and re-sorted on every call. The latest message and the latest assistant message are O(1),
+    time ranges O(log n). Messages appended during a step may be re-timed before it ends, so those are re-indexed
+    when the root persona's step finishes; a replaced or rolled back history rebuilds the timeline on the next query.
+
+    Get one with `DelegatingPersona.get_timeline`.
+    """
+
+    def __init__(self, root_persona: DelegatingPersona):
+        self.root_persona = root_persona
+        self.stacks: Dict[HistoryPath, List[ResponseDrivenPersona]] = {}
+        self.index = TimelineIndex()
+        self.assistant_index = TimelineIndex()
+        # Indexed during the current step, with the timestamp they were indexed under
+        self.step_entries: List[Tuple[PersonaMessageWithStack, int]] = []
+        self.stale = True
+        try:
+            root_persona.add_history_listener(self)
+            self.maintained = True
+        except PersonaException:
+            # Some subpersona can't report its changes, so there's nothing to maintain; rebuild for every query
+            logger.warning(
+                f"{root_persona.get_name()} doesn't support history listeners; its timeline is rebuilt on every query"
+            )
+            self.maintained = False
+
+    def rebuild(self) -> None:
+        self.stacks = {}
+        entries = merge_history_timeline(
+            self.root_persona.get_history(), self.root_persona, self.stacks
+        )
+        self.index = TimelineIndex(entries)
+        self.assistant_index = TimelineIndex(
+            [e for e in entries if e.message.is_assistant_message()]
+        )
+        self.step_entries = []
+        self.stale = not self.maintained
+
+    def current(self) -> TimelineIndex:
+        if self.stale:
+            self.rebuild()
+        return self.index
+
+    def stack_for(self, path: HistoryPath) -> List[ResponseDrivenPersona]:
+        stack = self.stacks.get(path)
+        if stack is None:
+            parent = self.stack_for(path[:-1])
+            agent = parent[-1]
+            assert isinstance(agent, DelegatingPersona)
+            stack = parent + [agent.get_subpersona_by_name(path[-1])]
+            self.stacks[path] = stack
+        return stack
+
+    def messages(self) -> List[PersonaMessageWithStack]:
+        """The whole timeline, oldest first; don't modify it."""
+        return self.current().entries
+
+    def last_message(self) -> Optional[PersonaMessageWithStack]:
+        return self.current().last()
+
+    def last_assistant_message(self) -> Optional[PersonaMessageWithStack]:
+        self.current()
+        return self.assistant_index.last()
+
+    def between(
+        self, start: datetime.datetime, end: datetime.datetime
+    ) -> List[PersonaMessageWithStack]:
+        """Messages stamped at or after `start` and before `end`, oldest first."""
+        return self.current().between(
+            datetime_to_epoch_ns(start), datetime_to_epoch_ns(end)
+        )
+
+    def __len__(self) -> int:
+        return len(self.current().entries)
+
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        # The timeline is made of messages only; final messages are copies of some of them
+        if self.stale or kind == HistoryRecordKind.FINAL_MESSAGE:
+            return
+        entry = PersonaMessageWithStack(self.stack_for(path), message)
+        key = message.timestamp_ns
+        self.index.insert(entry, key)
+        if message.is_assistant_message():
+            self.assistant_index.insert(entry, key)
+        self.step_entries.append((entry, key))
+
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        self.stale = True
+
+    def on_step_finished(self, path: HistoryPath) -> None:
+        if path or self.stale:
+            return
+        for entry, key in self.step_entries:
+            if entry.message.timestamp_ns != key:
+                self.reindex(entry, key)
+        self.step_entries = []
+
+    def reindex(self, entry: PersonaMessageWithStack, old_key: int) -> None:
+        self.index.remove(entry, old_key)
+        self.index.insert(entry, entry.message.timestamp_ns)
+        if entry.message.is_assistant_message():
+            self.assistant_index.remove(entry, old_key)
+            self.assistant_index.insert(entry, entry.message.timestamp_ns)
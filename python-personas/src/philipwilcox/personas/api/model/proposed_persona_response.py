@@ -1,5 +1,8 @@
 import dataclasses
-from typing import Optional
+from typing import List, Optional, Set
+
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.util.persona_tracing import span
 
 
 @dataclasses.dataclass
@@ -29,37 +32,100 @@ class ProposedPersonaResponse:
         Phil (Goals)
         ```
         """
-        substrings = [s for s in response.split(r"```") if s.strip() != ""]
-        reasoning: Optional[str] = None
-        message = ""
-        recipient: Optional[str] = None
-        next_block = ""
-        for s in substrings:
-            if next_block == "reasoning":
-                if s.strip() != "null" and s.strip() != "":
-                    reasoning = s.strip()
-                next_block = ""
-            elif next_block == "recipient":
-                if s.strip() != "null" and s.strip() != "":
-                    recipient = s.strip()
-                next_block = ""
-            elif next_block == "message":
-                message = s.strip()
-                next_block = ""
-            else:
-                if "reasoning" in s.strip().lower():
-                    next_block = "reasoning"
-                    continue
-                elif "recipient" in s.strip().lower():
-                    next_block = "recipient"
-                    continue
-                elif "message" in s.strip().lower():
-                    next_block = "message"
-                    continue
-        if message == "":
-            raise PersonaException(f"No message found in response: {response}")
-        pr = ProposedPersonaResponse(message, recipient, reasoning)
-        return pr
+        with span("from_markdown_response", chars=len(response)):
+            parser = ProposedPersonaResponseParser()
+            parser.feed(response)
+            return parser.close()
+
+
+@dataclasses.dataclass
+class ProposedPersonaResponseBlock:
+    # "reasoning", "message" or "recipient"
+    name: str
+    # None for a "null" or empty reasoning or recipient
+    value: Optional[str]
+
+
+class ProposedPersonaResponseParser:
+    """Push parser for the Markdown format of `ProposedPersonaResponse.from_markdown_response`.
+
+    Feed it chunks as they stream in; each `feed` returns the blocks whose closing fence arrived in that chunk, so
+    callers can act on a Message or Recipient before generation finishes. Every character is scanned once, and a
+    fence split across chunks is still recognized. Parses exactly like splitting the whole response on fences would.
+    """
+
+    FENCE = "```"
+
+    def __init__(self) -> None:
+        self.reasoning: Optional[str] = None
+        self.message = ""
+        self.recipient: Optional[str] = None
+        # Which blocks have been closed so far
+        self.completed: Set[str] = set()
+        self.consumed_length = 0
+        self.next_block = ""
+        self.segment: List[str] = []
+        # Up to two trailing backticks held back in case the next chunk completes a fence
+        self.carry = ""
+
+    def feed(self, chunk: str) -> List[ProposedPersonaResponseBlock]:
+        self.consumed_length += len(chunk)
+        text = self.carry + chunk
+        blocks: List[ProposedPersonaResponseBlock] = []
+        start = 0
+        while True:
+            fence = text.find(self.FENCE, start)
+            if fence == -1:
+                break
+            self.segment.append(text[start:fence])
+            self.finish_segment(blocks)
+            start = fence + len(self.FENCE)
+        rest = text[start:]
+        held = len(rest) - len(rest.rstrip("`"))
+        self.segment.append(rest[: len(rest) - held])
+        self.carry = rest[len(rest) - held :]
+        return blocks
+
+    def close(self) -> "ProposedPersonaResponse":
+        """Parse whatever trails the last fence (an unclosed block still counts, as before) and build the response."""
+        blocks: List[ProposedPersonaResponseBlock] = []
+        self.segment.append(self.carry)
+        self.carry = ""
+        self.finish_segment(blocks)
+        if self.message == "":
+            raise PersonaException(
+                f"No message found in response of {self.consumed_length} characters"
+            )
+        return ProposedPersonaResponse(self.message, self.recipient, self.reasoning)
+
+    def finish_segment(self, blocks: List[ProposedPersonaResponseBlock]) -> None:
+        s = "".join(self.segment)
+        self.segment = []
+        stripped = s.strip()
+        if stripped == "":
+            return
+        if self.next_block == "reasoning":
+            if stripped != "null":
+                self.reasoning = stripped
+            blocks.append(ProposedPersonaResponseBlock("reasoning", self.reasoning))
+        elif self.next_block == "recipient":
+            if stripped != "null":
+                self.recipient = stripped
+            blocks.append(ProposedPersonaResponseBlock("recipient", self.recipient))
+        elif self.next_block == "message":
+            self.message = stripped
+            blocks.append(ProposedPersonaResponseBlock("message", self.message))
+        else:
+            lowered = stripped.lower()
+            if "reasoning" in lowered:
+                self.next_block = "reasoning"
+            elif "recipient" in lowered:
+                self.next_block = "recipient"
+            elif "message" in lowered:
+                self.next_block = "message"
+            return
+        self.completed.add(self.next_block)
+        self.next_block = ""
 
 
 if __name__ == "__main__":
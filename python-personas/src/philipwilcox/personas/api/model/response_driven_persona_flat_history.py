@@ -1,7 +1,10 @@
+import collections
 import dataclasses
-from typing import List
+import heapq
+from typing import Deque, Dict, List, Optional, Tuple
 
 from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
+from src.philipwilcox.personas.api.model.persona_history_listener import HistoryPath
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
@@ -9,12 +12,58 @@ from src.philipwilcox.personas.api.model.response_driven_persona_history import
 from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class PersonaMessageWithStack:
     stack: List[ResponseDrivenPersona]
     message: PersonaMessage
 
 
+def timeline_key(m: PersonaMessageWithStack) -> int:
+    return m.message.timestamp_ns
+
+
+def merge_history_timeline(
+    h: ResponseDrivenPersonaHistory,
+    root_persona: DelegatingPersona,
+    stacks: Optional[Dict[HistoryPath, List[ResponseDrivenPersona]]] = None,
+) -> List[PersonaMessageWithStack]:
+    """Every message in `h`'s tree, oldest first, each with the stack of personas leading to the one that holds it.
+
+    Each persona's messages are already in time order, so this is a k-way merge of those logs rather than a sort of
+    everything; ties keep breadth-first persona order, as the sort this replaced did. Messages of one persona share
+    one stack list. If given, `stacks` is filled in with each subhistory's stack, by path.
+    """
+    logs = []
+    remaining_histories: Deque[
+        Tuple[HistoryPath, List[ResponseDrivenPersona], ResponseDrivenPersonaHistory]
+    ] = collections.deque([((), [root_persona], h)])
+    while remaining_histories:
+        path, stack, history = remaining_histories.popleft()
+        if stacks is not None:
+            stacks[path] = stack
+        log = [PersonaMessageWithStack(stack, m) for m in history.messages]
+        if any(
+            log[i].message.timestamp_ns > log[i + 1].message.timestamp_ns
+            for i in range(len(log) - 1)
+        ):
+            log.sort(key=timeline_key)
+        logs.append(log)
+        if history.subhistories:
+            current_agent = stack[-1]
+            assert isinstance(current_agent, DelegatingPersona)
+            for name, subhistory in history.subhistories.items():
+                remaining_histories.append(
+                    (
+                        path + (name,),
+                        stack + [current_agent.get_subpersona_by_name(name)],
+                        subhistory,
+                    )
+                )
+    if len(logs) == 1:
+        return logs[0]
+    return list(heapq.merge(*logs, key=timeline_key))
+
+
 @dataclasses.dataclass
 class ResponseDrivenPersonaFlatHistory:
     messages: List[PersonaMessageWithStack]
@@ -23,29 +72,7 @@ class ResponseDrivenPersonaFlatHistory:
     def from_nested_history(
         h: ResponseDrivenPersonaHistory, root_persona: DelegatingPersona
     ) -> "ResponseDrivenPersonaFlatHistory":
-        all_messages = [PersonaMessageWithStack([root_persona], m) for m in h.messages]
-        # TODO: make a recursive "all messages" iterator on ResponseDrivenPersonaHistory that I can use here + in hydration methods?
         # TODO: at least make CodeWriterAndRunnerPersona hydrator a library thing
-        remaining_histories = [
-            ([root_persona, root_persona.get_subpersona_by_name(k)], v)
-            for k, v in h.subhistories.items()
-        ]
-        while remaining_histories:
-            next_history = remaining_histories.pop(0)
-            current_stack = next_history[0]
-            current_agent = current_stack[-1]
-            messages = next_history[1].messages
-            all_messages += [
-                PersonaMessageWithStack(current_stack, m) for m in messages
-            ]
-            if len(next_history[1].subhistories.items()) > 0:
-                assert isinstance(current_agent, DelegatingPersona)
-                child_histories = [
-                    (current_stack + [current_agent.get_subpersona_by_name(k)], v)
-                    for k, v in next_history[1].subhistories.items()
-                ]
-                remaining_histories += child_histories
-        all_messages.sort(key=lambda x: x.message.timestamp)
-        return ResponseDrivenPersonaFlatHistory(all_messages)
+        return ResponseDrivenPersonaFlatHistory(merge_history_timeline(h, root_persona))
 
     # TODO: create a method to go the other way
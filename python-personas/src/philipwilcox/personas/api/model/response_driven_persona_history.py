@@ -1,12 +1,77 @@
 import dataclasses
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class ResponseDrivenPersonaHistory:
     messages: List[PersonaMessage]
     # Final Messages is distinct from Messages in that it will only contain source input messages from the user and final response messages from the persona, dropping any conversational "delegation" proposals/responses from an LLM-driven persona
     final_messages: List[PersonaMessage]
     subhistories: Dict[str, "ResponseDrivenPersonaHistory"]
+
+    def own_usage(self) -> TokenUsage:
+        """Calls made by this persona itself (for a delegating persona, its coordinator), excluding subpersonas."""
+        usage = TokenUsage()
+        for m in self.messages:
+            if m.usage is not None:
+                usage += m.usage
+        return usage
+
+    def total_usage(self) -> TokenUsage:
+        """Everything spent in this delegation tree, with `by_persona` broken down per subpersona.
+
+        This walks every message; a live persona's `total_usage()` gives the same from running totals.
+        """
+        return rollup_usage(
+            self.own_usage(),
+            {name: h.total_usage() for name, h in self.subhistories.items()},
+        )
+
+
+def rollup_usage(
+    own_usage: TokenUsage, subpersona_usage: Dict[str, TokenUsage]
+) -> TokenUsage:
+    """A persona's own usage plus its subpersonas', with `by_persona` broken down per subpersona."""
+    usage = dataclasses.replace(own_usage, by_persona={})
+    for sub_usage in subpersona_usage.values():
+        usage += dataclasses.replace(sub_usage, by_persona={})
+    usage.by_persona = subpersona_usage
+    return usage
+
+
+# Message and final message counts per subhistory, by path of subpersona names
+HistoryShape = Dict[Tuple[str, ...], Tuple[int, int]]
+
+
+def history_shape(
+    history: ResponseDrivenPersonaHistory, path: Tuple[str, ...] = ()
+) -> HistoryShape:
+    """Cheap to take and compare, even for very long histories."""
+    shape = {path: (len(history.messages), len(history.final_messages))}
+    for name, subhistory in history.subhistories.items():
+        shape.update(history_shape(subhistory, path + (name,)))
+    return shape
+
+
+def truncate_history(
+    history: ResponseDrivenPersonaHistory,
+    shape: HistoryShape,
+    path: Tuple[str, ...] = (),
+) -> ResponseDrivenPersonaHistory:
+    """`history` as it was when it had `shape`, given that it has only been appended to since."""
+    message_count, final_message_count = shape.get(path, (0, 0))
+    messages = history.messages[:message_count]
+    return ResponseDrivenPersonaHistory(
+        messages,
+        # Keep one list for personas whose messages are their final messages
+        messages
+        if history.final_messages is history.messages
+        else history.final_messages[:final_message_count],
+        {
+            name: truncate_history(subhistory, shape, path + (name,))
+            for name, subhistory in history.subhistories.items()
+        },
+    )
@@ -0,0 +1,76 @@
+import dataclasses
+from typing import Dict, List
+
+from src.philipwilcox.lib.openai.token_counter import cost_usd
+
+
+@dataclasses.dataclass(slots=True)
+class TokenUsage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    calls: int = 0
+    # Responses replayed from the ResponseCache; these cost nothing, so they carry no tokens
+    cached_calls: int = 0
+    cost_usd: float = 0.0
+    # Per-subpersona breakdown (recursively) when this is a rollup over a delegation tree; already included above
+    by_persona: Dict[str, "TokenUsage"] = dataclasses.field(default_factory=dict)
+
+    @staticmethod
+    def for_call(
+        model: str, prompt_tokens: int, completion_tokens: int
+    ) -> "TokenUsage":
+        return TokenUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            calls=1,
+            cost_usd=cost_usd(model, prompt_tokens, completion_tokens),
+        )
+
+    @staticmethod
+    def for_cache_hit() -> "TokenUsage":
+        return TokenUsage(cached_calls=1)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def __add__(self, other: "TokenUsage") -> "TokenUsage":
+        by_persona = dict(self.by_persona)
+        for name, usage in other.by_persona.items():
+            by_persona[name] = by_persona[name] + usage if name in by_persona else usage
+        return TokenUsage(
+            self.prompt_tokens + other.prompt_tokens,
+            self.completion_tokens + other.completion_tokens,
+            self.calls + other.calls,
+            self.cached_calls + other.cached_calls,
+            self.cost_usd + other.cost_usd,
+            by_persona,
+        )
+
+    def __sub__(self, other: "TokenUsage") -> "TokenUsage":
+        """What was spent since `other`, an earlier snapshot of the same rollup."""
+        by_persona = {
+            name: usage - other.by_persona[name] if name in other.by_persona else usage
+            for name, usage in self.by_persona.items()
+        }
+        return TokenUsage(
+            self.prompt_tokens - other.prompt_tokens,
+            self.completion_tokens - other.completion_tokens,
+            self.calls - other.calls,
+            self.cached_calls - other.cached_calls,
+            self.cost_usd - other.cost_usd,
+            by_persona,
+        )
+
+    def format_tree(self, name: str, indent: int = 0) -> List[str]:
+        """One line per persona, most expensive subpersonas first, for spotting the prompts worth trimming."""
+        lines = [
+            f"{'  ' * indent}{name}: {self.total_tokens} tokens "
+            f"({self.prompt_tokens} prompt / {self.completion_tokens} completion) over {self.calls} calls"
+            f"{f' (+{self.cached_calls} cached)' if self.cached_calls else ''}, ${self.cost_usd:.4f}"
+        ]
+        for sub_name, usage in sorted(
+            self.by_persona.items(), key=lambda kv: kv[1].total_tokens, reverse=True
+        ):
+            lines += usage.format_tree(sub_name, indent + 1)
+        return lines
@@ -0,0 +1,222 @@
+import abc
+import copy
+import dataclasses
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from src.philipwilcox.lib.openai.rate_limiter import estimate_message_tokens
+from src.philipwilcox.personas.api.model.persona_request_buffer import (
+    PersonaRequestBuffer,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.response_driven_persona import (
+    ResponseDrivenPersona,
+)
+
+logger = logging.getLogger(__name__)
+
+# Total context window (prompt + completion) per model, in tokens
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+}
+
+
+def context_budget_for_model(
+    model: str, response_reserve_tokens: int = 1024
+) -> Optional[int]:
+    """How many tokens of request we can send to `model` and still leave room for a reply; None if we don't know."""
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model)
+    if context_tokens is None:
+        return None
+    return context_tokens - response_reserve_tokens
+
+
+@dataclasses.dataclass
+class PersonaContextWindow:
+    messages: List[Dict[str, str]]
+    estimated_tokens: int
+    # How many messages were left out (or folded into a summary) for this request
+    dropped_messages: int
+    # LLM calls made to build the window (e.g. summarizing); the messenger counts them in the response's usage
+    usage: TokenUsage = dataclasses.field(default_factory=TokenUsage)
+
+
+def newest_fitting_start(
+    buffer: PersonaRequestBuffer, budget_tokens: int, lowest_index: int
+) -> Tuple[int, int]:
+    """Walk back from the newest message in `buffer.dicts`, no further than `lowest_index`, while messages still fit.
+
+    Returns the index the window starts at plus the tokens it uses. The newest message is always included even if it
+    alone is over budget, and the window never opens on an assistant reply whose question got cut off.
+    """
+    end = len(buffer.dicts)
+    start = end
+    used = 0
+    while start > lowest_index:
+        tokens = buffer.message_tokens(start - 1)
+        if used + tokens > budget_tokens and start < end:
+            break
+        used += tokens
+        start -= 1
+    while start < end - 1 and buffer.dicts[start]["role"] == "assistant":
+        used -= buffer.message_tokens(start)
+        start += 1
+    return start, used
+
+
+class PersonaContextStrategy(metaclass=abc.ABCMeta):
+    """Decides what part of an over-budget conversation a PersonaMessenger actually sends.
+
+    Strategies only shape the request: the messenger's history (and so ResponseDrivenPersonaHistory) always keeps
+    every message. Some strategies carry state between turns, so give each persona its own instance.
+    """
+
+    @abc.abstractmethod
+    async def build_window(
+        self, buffer: PersonaRequestBuffer, budget_tokens: int
+    ) -> PersonaContextWindow:
+        pass
+
+    def reset(self) -> None:
+        """Called when the messenger's history is replaced, e.g. when resuming from saved history."""
+
+    def clone(self) -> "PersonaContextStrategy":
+        """This strategy's configuration without its state, for a cloned persona."""
+        clone = copy.copy(self)
+        clone.reset()
+        return clone
+
+
+class SlidingWindowContextStrategy(PersonaContextStrategy):
+    """Send only the newest messages that fit. Nothing is pinned, so even the init prompt eventually scrolls away;
+    only suitable for personas that restate their instructions in every message."""
+
+    async def build_window(
+        self, buffer: PersonaRequestBuffer, budget_tokens: int
+    ) -> PersonaContextWindow:
+        start, used = newest_fitting_start(buffer, budget_tokens, 0)
+        return PersonaContextWindow(buffer.dicts[start:], used, start)
+
+
+class PinnedSystemPromptContextStrategy(PersonaContextStrategy):
+    """Always send the rendered init prompt (and optionally the first few history messages, which often state the
+    task), then as many of the newest messages as fit."""
+
+    def __init__(self, pinned_history_messages: int = 0) -> None:
+        self.pinned_history_messages = pinned_history_messages
+
+    async def build_window(
+        self, buffer: PersonaRequestBuffer, budget_tokens: int
+    ) -> PersonaContextWindow:
+        pinned_history = min(self.pinned_history_messages, buffer.history_length)
+        pinned_end = len(buffer.prompt_dicts) + pinned_history
+        pinned_tokens = buffer.prompt_tokens + sum(
+            buffer.history_tokens[:pinned_history]
+        )
+        start, used = newest_fitting_start(
+            buffer, budget_tokens - pinned_tokens, pinned_end
+        )
+        return PersonaContextWindow(
+            buffer.dicts[:pinned_end] + buffer.dicts[start:],
+            pinned_tokens + used,
+            start - pinned_end,
+        )
+
+
+class RollingSummaryContextStrategy(PersonaContextStrategy):
+    """Pin the init prompt, send the newest messages that fit, and replace everything older with a running summary.
+
+    The summary is written by `summarizer`, usually a persona on a cheaper model (see
+    `create_context_summarizer_persona`). It is only extended with messages as they fall out of the window, so each
+    message gets summarized once rather than the whole backlog being re-summarized every turn.
+    """
+
+    def __init__(
+        self,
+        summarizer: ResponseDrivenPersona,
+        summary_budget_tokens: int = 512,
+        summarizer_input_budget_tokens: int = 2048,
+        summarize_ahead_fraction: float = 0.5,
+    ) -> None:
+        self.summarizer = summarizer
+        self.summary_budget_tokens = summary_budget_tokens
+        self.summarizer_input_budget_tokens = summarizer_input_budget_tokens
+        # When the recent messages overflow, fold in enough extra to free this share of their budget, so the
+        # summarizer runs every few turns instead of on every turn once the conversation is long
+        self.summarize_ahead_fraction = summarize_ahead_fraction
+        self.reset()
+
+    def reset(self) -> None:
+        self.summary: Optional[str] = None
+        # Number of history messages already folded into `summary`
+        self.summarized_through = 0
+
+    def clone(self) -> "PersonaContextStrategy":
+        clone = copy.copy(self)
+        clone.summarizer = self.summarizer.clone()
+        clone.reset()
+        return clone
+
+    async def build_window(
+        self, buffer: PersonaRequestBuffer, budget_tokens: int
+    ) -> PersonaContextWindow:
+        prompt_count = len(buffer.prompt_dicts)
+        lowest_index = prompt_count + self.summarized_through
+        recent_budget = (
+            budget_tokens - buffer.prompt_tokens - self.summary_budget_tokens
+        )
+        start, used = newest_fitting_start(buffer, recent_budget, lowest_index)
+        usage = TokenUsage()
+        if start > lowest_index:
+            start, used = newest_fitting_start(
+                buffer,
+                int(recent_budget * (1 - self.summarize_ahead_fraction)),
+                lowest_index,
+            )
+            usage = await self.summarize(buffer, start - prompt_count)
+        messages = list(buffer.prompt_dicts)
+        estimated_tokens = buffer.prompt_tokens + used
+        if self.summary is not None:
+            summary_message = {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{self.summary}",
+            }
+            messages.append(summary_message)
+            estimated_tokens += estimate_message_tokens(summary_message)
+        messages += buffer.dicts[start:]
+        return PersonaContextWindow(
+            messages, estimated_tokens, start - prompt_count, usage
+        )
+
+    async def summarize(
+        self, buffer: PersonaRequestBuffer, evicted_through: int
+    ) -> TokenUsage:
+        """Returns what the summarizer spent doing it."""
+        usage_before = self.summarizer.total_usage()
+        prompt_count = len(buffer.prompt_dicts)
+        # Feed the summarizer in batches so catching up on a long resumed history doesn't overflow its own context
+        while self.summarized_through < evicted_through:
+            batch: List[str] = []
+            batch_tokens = 0
+            while self.summarized_through < evicted_through:
+                tokens = buffer.history_tokens[self.summarized_through]
+                if (
+                    batch
+                    and batch_tokens + tokens > self.summarizer_input_budget_tokens
+                ):
+                    break
+                d = buffer.dicts[prompt_count + self.summarized_through]
+                batch.append(f"{d['role']}: {d['content']}")
+                batch_tokens += tokens
+                self.summarized_through += 1
+            logger.info(
+                f"Summarizing {len(batch)} messages that no longer fit in the context window"
+            )
+            request = "\n\n".join(batch)
+            if self.summary is not None:
+                request = f"Summary so far:\n{self.summary}\n\nNew messages:\n{request}"
+            self.summary = (await self.summarizer.send_message(request)).message
+        return self.summarizer.total_usage() - usage_before
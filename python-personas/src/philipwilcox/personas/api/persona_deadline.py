@@ -0,0 +1,57 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+from typing import AsyncIterator, Optional
+
+from src.philipwilcox.personas.api.model.persona_exception import (
+    PersonaDeadlineExceeded,
+)
+
+logger = logging.getLogger(__name__)
+
+# When the work in progress has to be done by, in event loop time; None for no deadline. Context-local, so it follows
+# a request from the root persona down through every delegate and messenger it awaits, including delegates run in
+# tasks of their own, without being threaded through every call.
+DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "persona_deadline", default=None
+)
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left before the current deadline; None if there isn't one."""
+    deadline = DEADLINE.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+
+@contextlib.asynccontextmanager
+async def persona_deadline(timeout_s: Optional[float]) -> AsyncIterator[None]:
+    """Give the block at most `timeout_s` seconds, or less if an enclosing deadline is sooner.
+
+    When time runs out, whatever the block is awaiting is cancelled (so personas roll back the step in progress) and
+    PersonaDeadlineExceeded is raised here. A None `timeout_s` leaves any enclosing deadline as it is.
+    """
+    if timeout_s is None:
+        yield
+        return
+    deadline = asyncio.get_running_loop().time() + timeout_s
+    enclosing = DEADLINE.get()
+    if enclosing is not None and enclosing <= deadline:
+        # The enclosing deadline will cancel this block anyway
+        yield
+        return
+    token = DEADLINE.set(deadline)
+    try:
+        async with asyncio.timeout_at(deadline) as timeout:
+            yield
+    except TimeoutError as e:
+        if not timeout.expired():
+            raise
+        logger.warning(f"Gave up after the {timeout_s}s deadline passed")
+        raise PersonaDeadlineExceeded(
+            f"Did not finish within the {timeout_s}s deadline"
+        ) from e
+    finally:
+        DEADLINE.reset(token)
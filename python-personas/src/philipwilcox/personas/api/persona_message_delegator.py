@@ -1,17 +1,33 @@
 import abc
+import asyncio
+import contextlib
 import logging
-from typing import Optional
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional
 
+from src.philipwilcox.personas.api.model.persona_exception import (
+    PersonaDeadlineExceeded,
+    PersonaException,
+)
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    PersonaHistoryListener,
+)
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
+    history_shape,
+    truncate_history,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.persona_deadline import persona_deadline
 from src.philipwilcox.personas.api.response_driven_persona import (
     ResponseDrivenPersona,
 )
+from src.philipwilcox.personas.api.util.persona_tracing import span
 
+if TYPE_CHECKING:
+    from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
 
 logger = logging.getLogger(
     __name__
@@ -19,6 +35,9 @@ logger = logging.getLogger(
 
 
 class PersonaMessageDelegator(metaclass=abc.ABCMeta):
+    # Most any one step may take, on top of any deadline the caller set; see persona_deadline
+    timeout_s: Optional[float] = None
+
     def __init__(self) -> None:
         # Note: this dummy init is the least-annoying way I can find to make mypy know all instances of this should have this property
         self.current_delegate: Optional[ResponseDrivenPersona] = None
@@ -48,3 +67,46 @@ class PersonaMessageDelegator(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def get_subpersona_by_name(self, name: str) -> ResponseDrivenPersona:
         pass
+
+    @abc.abstractmethod
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        pass
+
+    def total_usage(self) -> TokenUsage:
+        """The same as `get_history().total_usage()`; override it to roll up subpersonas' running totals instead."""
+        return self.get_history().total_usage()
+
+    def clone(self, root_persona: "DelegatingPersona") -> "PersonaMessageDelegator":
+        """A delegator for `root_persona`, a clone of this one's root persona, with every subpersona cloned."""
+        raise PersonaException(
+            "Cloning not implemented for this delegator; its persona has to build a new one from cloned subpersonas."
+        )
+
+    def save_step_state(self) -> Any:
+        """Whatever `restore_step_state` needs to put this delegator back the way it was before a step."""
+        return None
+
+    async def restore_step_state(self, state: Any) -> None:
+        pass
+
+    @contextlib.asynccontextmanager
+    async def step(self) -> AsyncIterator[None]:
+        """Run one step within `timeout_s`, undoing it entirely if it's cancelled or runs out of time.
+
+        The messengers drop the messages they were waiting on, and the delegator restores its own state, so the
+        persona can carry on (or be saved and resumed) as if the step was never started.
+        """
+        shape = history_shape(self.get_history())
+        state = self.save_step_state()
+        try:
+            with span(f"{type(self).__name__}.step"):
+                async with persona_deadline(self.timeout_s):
+                    yield
+        except (asyncio.CancelledError, PersonaDeadlineExceeded):
+            await self.restore_step_state(state)
+            history = self.get_history()
+            if history_shape(history) != shape:
+                # Some subpersona finished its part before the step was stopped
+                self.set_history(truncate_history(history, shape))
+                await self.restore_step_state(state)
+            raise
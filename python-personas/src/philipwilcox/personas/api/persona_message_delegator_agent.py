@@ -1,25 +1,38 @@
+import asyncio
+import contextlib
 import dataclasses
+import datetime
 import json
 import logging
-from typing import Optional, Sequence, List
+from typing import Any, Optional, Sequence, List, Tuple
 
+from src.philipwilcox.personas.api.basic_persona import BasicPersona
 from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    CoordinatorHistoryListener,
+    HistoryListeners,
+    HistoryRecordKind,
+    PersonaHistoryListener,
+    SubpersonaHistoryListener,
+    notifies_step_finished,
+)
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
-)
-from src.philipwilcox.personas.api.model.response_driven_persona_flat_history import (
-    ResponseDrivenPersonaFlatHistory,
+    ProposedPersonaResponseParser,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
+    rollup_usage,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 from src.philipwilcox.personas.api.persona_message_delegator import (
     PersonaMessageDelegator,
 )
 from src.philipwilcox.personas.api.response_driven_persona import (
     ResponseDrivenPersona,
 )
+from src.philipwilcox.personas.api.util.persona_tracing import span
 
 
 logger = logging.getLogger(
@@ -32,6 +45,9 @@ class PersonaDelegationInfoAgent:
     delegate_personas: Sequence[ResponseDrivenPersona]
     coordinating_persona: ResponseDrivenPersona
     root_persona: DelegatingPersona
+    # Start calling the delegate as soon as the coordinator's streamed response names it, instead of after the
+    # coordinator is done; only used when the coordinator and delegate are BasicPersonas
+    speculative_delegation: bool = False
 
     def __post_init__(self) -> None:
         self.delegate_personas_by_name = {}
@@ -39,31 +55,61 @@ class PersonaDelegationInfoAgent:
             self.delegate_personas_by_name[p.get_name()] = p
 
 
+@dataclasses.dataclass
+class SpeculativeDelegation:
+    recipient: str
+    message: str
+    delegate: BasicPersona
+    # Length of the delegate's history before the speculative call, to roll back to if it's thrown away
+    history_length: int
+    task: "asyncio.Task[ProposedPersonaResponse]"
+    # Taken just before the call, so earlier than any message it adds to the delegate's history
+    started_at: datetime.datetime
+
+
 class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
     def __init__(self, delegation_info: PersonaDelegationInfoAgent):
         self.delegation_info = delegation_info
         self.current_delegate: Optional[ResponseDrivenPersona] = None
         self.current_inbound_message: Optional[str] = None
         self.final_history: List[PersonaMessage] = []
+        # Snapshot of the tree's usage when the current inbound message arrived, to roll up what answering it cost
+        self.inbound_usage_start: Optional[TokenUsage] = None
+        self.speculation: Optional[SpeculativeDelegation] = None
+        self.coordinator_parser = ProposedPersonaResponseParser()
+        self.history_listeners = HistoryListeners()
 
+    @notifies_step_finished
     async def send_message(self, message: str) -> ProposedPersonaResponse:
+        async with self.step():
+            return await self.step_send_message(message)
+
+    async def step_send_message(self, message: str) -> ProposedPersonaResponse:
         if self.current_delegate is None:
             self.current_inbound_message = message
-            self.final_history.append(PersonaMessage.create_user_message(message))
-            coordinator_response = (
-                await self.delegation_info.coordinating_persona.send_message(message)
+            self.inbound_usage_start = self.total_usage()
+            inbound = PersonaMessage.create_user_message(message)
+            self.final_history.append(inbound)
+            self.history_listeners.message_appended(
+                HistoryRecordKind.FINAL_MESSAGE, inbound
             )
             # TODO: might still need to make this safer
             # TODO: fix this for history restore too
-            return ProposedPersonaResponse.from_markdown_response(
-                coordinator_response.message
-            )
+            with span("coordinator"):
+                return await self.send_to_coordinator(message)
         else:
             delegated_response = await self.current_delegate.send_message(message)
             return delegated_response
 
+    @notifies_step_finished
     async def process_proposed_response(
         self, pr: ProposedPersonaResponse
+    ) -> ProposedPersonaResponse:
+        async with self.step():
+            return await self.step_process_proposed_response(pr)
+
+    async def step_process_proposed_response(
+        self, pr: ProposedPersonaResponse
     ) -> ProposedPersonaResponse:
         if self.current_delegate is None:
             new_delegate_name = pr.recipient
@@ -73,7 +119,14 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
                 new_delegate_name
             ]
             self.current_delegate = new_delegate
-            return await self.current_delegate.send_message(pr.message)
+            with span("delegate", recipient=new_delegate_name) as delegate_span:
+                speculative_response = await self.take_speculation(
+                    new_delegate_name, pr.message
+                )
+                if speculative_response is not None:
+                    delegate_span.set(speculative=True)
+                    return speculative_response
+                return await self.current_delegate.send_message(pr.message)
         else:
             # TODO: this structure wouldn't allow us to close out multi-layer delegation...
             # TODO: for multi-layer delegation we'd need to check if CHILD was delegating too; we'd need an interface for that
@@ -83,28 +136,138 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
                 f"The response from {last_delgate.get_name()} was:\n\n{pr.message}"
             )
             logger.warning(f"SENDING COORDINATOR: {coordinating_message}")
-            coordinator_response = (
-                await self.delegation_info.coordinating_persona.send_message(
-                    coordinating_message
-                )
-            )
-            logger.warning(
-                f"Got {coordinator_response.message} after passing response from {last_delgate.get_name()}"
-            )
             # TODO: is this going to work correctly for nested delegation as-is?
-            new_pr = ProposedPersonaResponse.from_markdown_response(
-                coordinator_response.message
+            with span("coordinator"):
+                new_pr = await self.send_to_coordinator(coordinating_message)
+            logger.warning(
+                f"Got {new_pr} after passing response from {last_delgate.get_name()}"
             )
             # TODO: get rid of this after restructuring how we return ProposedPersonaResponse entirely
             if isinstance(new_pr.message, dict):
                 new_pr.message = json.dumps(new_pr.message)
             if not new_pr.recipient:
                 self.current_inbound_message = None
-                self.final_history.append(
-                    PersonaMessage.create_assistant_message(new_pr.message)
+                final_message = PersonaMessage.create_assistant_message(new_pr.message)
+                if self.inbound_usage_start is not None:
+                    final_message.inbound_usage = (
+                        self.total_usage() - self.inbound_usage_start
+                    )
+                    self.inbound_usage_start = None
+                self.final_history.append(final_message)
+                self.history_listeners.message_appended(
+                    HistoryRecordKind.FINAL_MESSAGE, final_message
                 )
             return new_pr
 
+    async def send_to_coordinator(self, message: str) -> ProposedPersonaResponse:
+        """Send the coordinator a message and parse its Markdown reply, as it streams in if it's a BasicPersona."""
+        await self.discard_speculation()
+        coordinator = self.delegation_info.coordinating_persona
+        if not isinstance(coordinator, BasicPersona):
+            response = await coordinator.send_message(message)
+            return ProposedPersonaResponse.from_markdown_response(response.message)
+        self.coordinator_parser = ProposedPersonaResponseParser()
+        response = await coordinator.send_message(
+            message, on_chunk=self.on_coordinator_chunk
+        )
+        if self.speculation is not None:
+            # The delegate was called before this response finished streaming; date the response to just before
+            # that call, so the flat history reads (and restores) as if the calls had been made in order. Moving
+            # the coordinator's newest message rather than the delegate's keeps every re-timing inside this step.
+            history = coordinator.messenger.history
+            stamp = self.speculation.started_at - datetime.timedelta(microseconds=1)
+            if len(history) > 1:
+                stamp = max(
+                    stamp, history[-2].timestamp + datetime.timedelta(microseconds=1)
+                )
+            history[-1].timestamp = stamp
+        if self.coordinator_parser.consumed_length == len(response.message):
+            return self.coordinator_parser.close()
+        # A retry restarted the stream partway through, so the parser saw more than the final response
+        return ProposedPersonaResponse.from_markdown_response(response.message)
+
+    def on_coordinator_chunk(self, chunk: str) -> None:
+        parser = self.coordinator_parser
+        blocks = parser.feed(chunk)
+        if (
+            not blocks
+            or not self.delegation_info.speculative_delegation
+            or self.speculation is not None
+        ):
+            return
+        # With the default format both are known after the third block; with
+        # `get_speculative_response_format_instructions`, after the second
+        if "message" not in parser.completed or parser.recipient is None:
+            return
+        delegate = self.delegation_info.delegate_personas_by_name.get(parser.recipient)
+        # Streaming delegates would print into the middle of the coordinator's output, so leave those alone
+        if (
+            not isinstance(delegate, BasicPersona)
+            or delegate.messenger.streaming_console_mode
+        ):
+            return
+        logger.info(f"Speculatively delegating to {parser.recipient}")
+        started_at = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.speculation = SpeculativeDelegation(
+            parser.recipient,
+            parser.message,
+            delegate,
+            len(delegate.messenger.history),
+            asyncio.ensure_future(delegate.send_message(parser.message)),
+            started_at,
+        )
+
+    async def take_speculation(
+        self, recipient: str, message: str
+    ) -> Optional[ProposedPersonaResponse]:
+        """The speculative call's response if it was for exactly this delegation, else None (and it's discarded)."""
+        speculation = self.speculation
+        if speculation is None:
+            return None
+        if speculation.recipient != recipient or speculation.message != message:
+            logger.info(
+                f"Final delegation to {recipient} doesn't match the speculative one to {speculation.recipient}"
+            )
+            await self.discard_speculation()
+            return None
+        self.speculation = None
+        return await speculation.task
+
+    async def discard_speculation(self) -> None:
+        speculation = self.speculation
+        if speculation is None:
+            return
+        self.speculation = None
+        speculation.task.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await speculation.task
+        messenger = speculation.delegate.messenger
+        messenger.history = messenger.history[: speculation.history_length]
+
+    def save_step_state(
+        self,
+    ) -> Tuple[
+        Optional[ResponseDrivenPersona], Optional[str], Optional[TokenUsage], int
+    ]:
+        return (
+            self.current_delegate,
+            self.current_inbound_message,
+            self.inbound_usage_start,
+            len(self.final_history),
+        )
+
+    async def restore_step_state(self, state: Any) -> None:
+        await self.discard_speculation()
+        (
+            self.current_delegate,
+            self.current_inbound_message,
+            self.inbound_usage_start,
+            final_history_length,
+        ) = state
+        if len(self.final_history) > final_history_length:
+            self.final_history = self.final_history[:final_history_length]
+            self.history_listeners.history_replaced()
+
     def get_history(self) -> ResponseDrivenPersonaHistory:
         return ResponseDrivenPersonaHistory(
             self.delegation_info.coordinating_persona.get_history().messages,
@@ -115,7 +278,20 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
             },
         )
 
+    def total_usage(self) -> TokenUsage:
+        return rollup_usage(
+            self.delegation_info.coordinating_persona.total_usage(),
+            {
+                name: persona.total_usage()
+                for name, persona in self.delegation_info.delegate_personas_by_name.items()
+            },
+        )
+
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
+        if self.speculation is not None:
+            # The delegate's history is about to be replaced anyway, so there's nothing to roll back
+            self.speculation.task.cancel()
+            self.speculation = None
         bare_history = ResponseDrivenPersonaHistory(
             messages=history.messages,
             final_messages=history.final_messages,
@@ -123,13 +299,15 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
         )
         self.delegation_info.coordinating_persona.set_history(bare_history)
         self.final_history = history.final_messages
+        self.history_listeners.history_replaced()
+        # TODO: if we're resuming mid-message, the final response won't get a usage rollup since we don't know where it started
+        self.inbound_usage_start = None
         for n, h in history.subhistories.items():
             self.delegation_info.delegate_personas_by_name[n].set_history(h)
-        flat_history = ResponseDrivenPersonaFlatHistory.from_nested_history(
-            history, self.delegation_info.root_persona
-        )
-        if len(flat_history.messages) > 0:
-            last_message = flat_history.messages[-1]
+        timeline = self.delegation_info.root_persona.get_timeline()
+        last_message = timeline.last_message()
+        last_assistant_message = timeline.last_assistant_message()
+        if last_message is not None:
             if last_message.message.is_user_message():
                 # If we have a user message as our last message, that means we saved before getting the most recent response
                 # for that one, so let's discard it with a warning so the user can re-send
@@ -148,12 +326,8 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
 
             # TODO: should we rethink our outer state history structure? This is getting rough - but also need to support both Agent and Linear?
             # Now let's find and set our current delegate appropriately
-            assistant_messages = [
-                m for m in flat_history.messages if m.message.is_assistant_message()
-            ]
-            if len(assistant_messages) > 0:
+            if last_assistant_message is not None:
                 # TODO: when we do nested personas we'll need to test/debug this extensively
-                last_assistant_message = assistant_messages[-1]
                 last_stack = last_assistant_message.stack
                 last_was_self = False
                 for potential_agent in last_stack:
@@ -163,6 +337,24 @@ class PersonaMessageDelegatorAgent(PersonaMessageDelegator):
                     elif potential_agent == self.delegation_info.root_persona:
                         last_was_self = True
 
+    def clone(self, root_persona: DelegatingPersona) -> "PersonaMessageDelegatorAgent":
+        return PersonaMessageDelegatorAgent(
+            PersonaDelegationInfoAgent(
+                [p.clone() for p in self.delegation_info.delegate_personas],
+                self.delegation_info.coordinating_persona.clone(),
+                root_persona,
+                speculative_delegation=self.delegation_info.speculative_delegation,
+            )
+        )
+
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        self.history_listeners.add(listener)
+        self.delegation_info.coordinating_persona.add_history_listener(
+            CoordinatorHistoryListener(listener)
+        )
+        for name, persona in self.delegation_info.delegate_personas_by_name.items():
+            persona.add_history_listener(SubpersonaHistoryListener(listener, name))
+
     def is_in_processing_loop(self) -> bool:
         return self.current_inbound_message is not None
 
@@ -1,19 +1,45 @@
+import asyncio
 import dataclasses
-from typing import Optional, Callable, Sequence, List
+import datetime
+from typing import Any, Optional, Callable, Sequence, List, Dict, Tuple
 
-from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryListeners,
+    HistoryRecordKind,
+    PersonaHistoryListener,
+    SubpersonaHistoryListener,
+    notifies_step_finished,
+)
+from src.philipwilcox.personas.api.model.persona_message import (
+    PersonaMessage,
+    datetime_to_epoch_ns,
+)
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
+    rollup_usage,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 from src.philipwilcox.personas.api.persona_message_delegator import (
     PersonaMessageDelegator,
 )
 from src.philipwilcox.personas.api.response_driven_persona import (
     ResponseDrivenPersona,
 )
+from src.philipwilcox.personas.api.util.persona_tracing import span
+
+
+@dataclasses.dataclass
+class PersonaDelegationStep:
+    persona: ResponseDrivenPersona
+    # Names of the personas whose responses this step needs; steps with no inputs only see the inbound message
+    inputs: Sequence[str] = ()
+    # Called with the inbound message and the responses of `inputs` (by persona name) to build this step's message.
+    # Without one, the step gets the response of its last input, or the inbound message if it has no inputs.
+    message_builder: Optional[Callable[[str, Dict[str, str]], str]] = None
 
 
 @dataclasses.dataclass
@@ -22,11 +48,61 @@ class PersonaDelegationInfoLinear:
     next_message_builder: Optional[
         Callable[[ResponseDrivenPersona, str, str], str]
     ] = None
+    # If set, delegate in DAG mode instead: every step whose inputs are ready is sent its message at once, and the
+    # final response is built from the inbound message plus every step's response
+    steps: Optional[Sequence[PersonaDelegationStep]] = None
+    final_message_builder: Optional[Callable[[str, Dict[str, str]], str]] = None
 
     def __post_init__(self) -> None:
         self.delegate_personas_by_name = {}
         for p in self.delegate_personas:
             self.delegate_personas_by_name[p.get_name()] = p
+        self.waves = (
+            PersonaDelegationInfoLinear.compute_waves(self.steps)
+            if self.steps is not None
+            else []
+        )
+
+    @staticmethod
+    def from_steps(
+        steps: Sequence[PersonaDelegationStep],
+        final_message_builder: Optional[Callable[[str, Dict[str, str]], str]] = None,
+    ) -> "PersonaDelegationInfoLinear":
+        return PersonaDelegationInfoLinear(
+            [s.persona for s in steps],
+            steps=steps,
+            final_message_builder=final_message_builder,
+        )
+
+    @staticmethod
+    def compute_waves(
+        steps: Sequence[PersonaDelegationStep],
+    ) -> List[List[PersonaDelegationStep]]:
+        """Group steps into waves that can run concurrently, each only depending on earlier waves.
+
+        Steps keep their declared order within a wave, so the same graph always runs (and records history) the same
+        way.
+        """
+        names = [s.persona.get_name() for s in steps]
+        for s in steps:
+            unknown = [i for i in s.inputs if i not in names]
+            if unknown:
+                raise PersonaException(
+                    f"Delegation step {s.persona.get_name()} has unknown inputs {unknown}"
+                )
+        done: set[str] = set()
+        remaining = list(steps)
+        waves = []
+        while remaining:
+            wave = [s for s in remaining if all(i in done for i in s.inputs)]
+            if not wave:
+                raise PersonaException(
+                    f"Delegation steps {[s.persona.get_name() for s in remaining]} have circular inputs"
+                )
+            waves.append(wave)
+            done.update(s.persona.get_name() for s in wave)
+            remaining = [s for s in remaining if s not in wave]
+        return waves
 
 
 class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
@@ -36,23 +112,50 @@ class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
         self.current_delegate: Optional[ResponseDrivenPersona] = None
         self.current_inbound_message: Optional[str] = None
         self.history: List[PersonaMessage] = []
+        # DAG mode state for the current inbound message
+        self.next_wave_index: int = 0
+        self.step_responses: Dict[str, str] = {}
+        self.last_restamp: Optional[datetime.datetime] = None
+        # Snapshot of the tree's usage when the current inbound message arrived, to roll up what answering it cost
+        self.inbound_usage_start: Optional[TokenUsage] = None
+        self.history_listeners = HistoryListeners()
 
+    @notifies_step_finished
     async def send_message(self, message: str) -> ProposedPersonaResponse:
+        async with self.step():
+            return await self.step_send_message(message)
+
+    async def step_send_message(self, message: str) -> ProposedPersonaResponse:
         if self.current_delegate is None:
             self.current_inbound_message = message
-            self.history.append(PersonaMessage.create_user_message(message))
+            self.inbound_usage_start = self.total_usage()
+            self.append_history(PersonaMessage.create_user_message(message))
+            if self.delegation_info.steps is not None:
+                self.next_wave_index = 0
+                self.step_responses = {}
+                return await self.run_next_wave()
             next_delegate = self.delegation_info.delegate_personas[
                 self.next_delegate_index
             ]
             self.next_delegate_index += 1
             self.current_delegate = next_delegate
-        return await self.current_delegate.send_message(message)
+        with span("delegate", recipient=self.current_delegate.get_name()):
+            return await self.current_delegate.send_message(message)
 
+    @notifies_step_finished
     async def process_proposed_response(
         self, pr: ProposedPersonaResponse
+    ) -> ProposedPersonaResponse:
+        async with self.step():
+            return await self.step_process_proposed_response(pr)
+
+    async def step_process_proposed_response(
+        self, pr: ProposedPersonaResponse
     ) -> ProposedPersonaResponse:
         assert self.current_delegate
         last_delegate = self.current_delegate
+        if self.delegation_info.steps is not None:
+            return await self.process_wave_response(pr)
 
         # TODO: test on state restoration for this version
         if self.delegation_info.next_message_builder:
@@ -66,7 +169,13 @@ class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
             self.current_inbound_message = None
             self.next_delegate_index = 0
             self.current_delegate = None
-            self.history.append(PersonaMessage.create_assistant_message(next_message))
+            final_message = PersonaMessage.create_assistant_message(next_message)
+            if self.inbound_usage_start is not None:
+                final_message.inbound_usage = (
+                    self.total_usage() - self.inbound_usage_start
+                )
+                self.inbound_usage_start = None
+            self.append_history(final_message)
             return ProposedPersonaResponse(next_message)
         else:
             next_delegate = self.delegation_info.delegate_personas[
@@ -74,7 +183,135 @@ class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
             ]
             self.next_delegate_index += 1
             self.current_delegate = next_delegate
-            return await self.current_delegate.send_message(next_message)
+            with span("delegate", recipient=next_delegate.get_name()):
+                return await self.current_delegate.send_message(next_message)
+
+    async def run_next_wave(self) -> ProposedPersonaResponse:
+        """Send every step of the next wave its message concurrently.
+
+        The response of the wave's last step is returned, like a single delegate's would be, so it can be reviewed or
+        edited before `process_proposed_response` moves on; the others are kept for later steps.
+        """
+        assert self.current_inbound_message is not None
+        wave = self.delegation_info.waves[self.next_wave_index]
+        self.next_wave_index += 1
+        messages = [self.build_step_message(s) for s in wave]
+        wave_start = datetime.datetime.now(tz=datetime.timezone.utc)
+        if self.last_restamp is not None and wave_start <= self.last_restamp:
+            wave_start = self.last_restamp + datetime.timedelta(microseconds=1)
+        tasks = [
+            asyncio.ensure_future(s.persona.send_message(m))
+            for s, m in zip(wave, messages)
+        ]
+        try:
+            with span("wave", index=self.next_wave_index - 1, steps=len(wave)):
+                responses = await asyncio.gather(*tasks)
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            # Let the cancelled steps drop their messages before the step is rolled back
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        self.restamp_wave(wave, wave_start)
+        for s, r in zip(wave[:-1], responses[:-1]):
+            self.step_responses[s.persona.get_name()] = r.message
+        self.current_delegate = wave[-1].persona
+        return responses[-1]
+
+    async def process_wave_response(
+        self, pr: ProposedPersonaResponse
+    ) -> ProposedPersonaResponse:
+        assert self.current_delegate
+        assert self.current_inbound_message is not None
+        self.step_responses[self.current_delegate.get_name()] = pr.message
+        if self.next_wave_index < len(self.delegation_info.waves):
+            return await self.run_next_wave()
+        if self.delegation_info.final_message_builder:
+            final_message = self.delegation_info.final_message_builder(
+                self.current_inbound_message, self.step_responses
+            )
+        else:
+            final_message = pr.message
+        self.current_inbound_message = None
+        self.current_delegate = None
+        self.next_wave_index = 0
+        message = PersonaMessage.create_assistant_message(final_message)
+        if self.inbound_usage_start is not None:
+            message.inbound_usage = self.total_usage() - self.inbound_usage_start
+            self.inbound_usage_start = None
+        self.append_history(message)
+        return ProposedPersonaResponse(final_message)
+
+    def append_history(self, message: PersonaMessage) -> None:
+        self.history.append(message)
+        self.history_listeners.message_appended(
+            HistoryRecordKind.MESSAGE_AND_FINAL_MESSAGE, message
+        )
+
+    def build_step_message(self, step: PersonaDelegationStep) -> str:
+        assert self.current_inbound_message is not None
+        if step.message_builder:
+            return step.message_builder(
+                self.current_inbound_message,
+                {name: self.step_responses[name] for name in step.inputs},
+            )
+        elif step.inputs:
+            return self.step_responses[step.inputs[-1]]
+        else:
+            return self.current_inbound_message
+
+    def restamp_wave(
+        self, wave: List[PersonaDelegationStep], wave_start: datetime.datetime
+    ) -> None:
+        """Re-time the messages a wave created as if its steps had run one after another in declared order.
+
+        Concurrent steps finish in whatever order the network decides, and the flat history is sorted by timestamp;
+        this keeps it identical from run to run so it can be replayed.
+        """
+        stamp = wave_start
+        for s in wave:
+            for m in messages_since(s.persona.get_history(), wave_start):
+                m.timestamp = stamp
+                stamp += datetime.timedelta(microseconds=1)
+        self.last_restamp = stamp
+
+    def save_step_state(
+        self,
+    ) -> Tuple[
+        Optional[ResponseDrivenPersona],
+        Optional[str],
+        Optional[TokenUsage],
+        int,
+        int,
+        Dict[str, str],
+        Optional[datetime.datetime],
+        int,
+    ]:
+        return (
+            self.current_delegate,
+            self.current_inbound_message,
+            self.inbound_usage_start,
+            self.next_delegate_index,
+            self.next_wave_index,
+            dict(self.step_responses),
+            self.last_restamp,
+            len(self.history),
+        )
+
+    async def restore_step_state(self, state: Any) -> None:
+        (
+            self.current_delegate,
+            self.current_inbound_message,
+            self.inbound_usage_start,
+            self.next_delegate_index,
+            self.next_wave_index,
+            self.step_responses,
+            self.last_restamp,
+            history_length,
+        ) = state
+        if len(self.history) > history_length:
+            self.history = self.history[:history_length]
+            self.history_listeners.history_replaced()
 
     def get_history(self) -> ResponseDrivenPersonaHistory:
         return ResponseDrivenPersonaHistory(
@@ -86,8 +323,22 @@ class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
             },
         )
 
+    def total_usage(self) -> TokenUsage:
+        # Our own messages are put together from delegates' responses, so only the delegates have usage
+        return rollup_usage(
+            TokenUsage(),
+            {
+                name: persona.total_usage()
+                for name, persona in self.delegation_info.delegate_personas_by_name.items()
+            },
+        )
+
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
         self.history = history.messages
+        self.inbound_usage_start = None
+        self.next_wave_index = 0
+        self.step_responses = {}
+        self.history_listeners.history_replaced()
         for n, h in history.subhistories.items():
             self.delegation_info.delegate_personas_by_name[n].set_history(h)
         # TODO: set current delegate appropriately, set current inbound appropriately
@@ -97,3 +348,29 @@ class PersonaMessageDelegatorLinear(PersonaMessageDelegator):
 
     def get_subpersona_by_name(self, name: str) -> ResponseDrivenPersona:
         return self.delegation_info.delegate_personas_by_name[name]
+
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        self.history_listeners.add(listener)
+        for name, persona in self.delegation_info.delegate_personas_by_name.items():
+            persona.add_history_listener(SubpersonaHistoryListener(listener, name))
+
+
+def messages_since(
+    history: ResponseDrivenPersonaHistory, since: datetime.datetime
+) -> List[PersonaMessage]:
+    """Messages anywhere in `history`'s tree stamped at or after `since`, oldest first.
+
+    Histories are append-only, so each list is only scanned back to its first older message.
+    """
+    since_ns = datetime_to_epoch_ns(since)
+    found: List[PersonaMessage] = []
+    pending = [history]
+    while pending:
+        h = pending.pop()
+        i = len(h.messages)
+        while i > 0 and h.messages[i - 1].timestamp_ns >= since_ns:
+            i -= 1
+        found += h.messages[i:]
+        pending += h.subhistories.values()
+    found.sort(key=lambda m: m.timestamp_ns)
+    return found
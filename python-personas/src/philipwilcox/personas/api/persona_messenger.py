@@ -1,30 +1,138 @@
 import asyncio
+import contextlib
+import contextvars
 import copy
 import logging
-from typing import Dict, Any, List
-
-from aiohttp import ClientPayloadError
-from openai.error import RateLimitError, ServiceUnavailableError, APIError
+from typing import Dict, Any, List, Optional, Callable, Iterator, Sequence
 
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    rate_limit_error,
+    retryable_errors,
+)
 from src.philipwilcox.lib.openai.messages_wrapper import MessagesWrapper
 from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
-from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.lib.openai.rate_limiter import (
+    RATE_LIMITER,
+    RateLimiter,
+)
+from src.philipwilcox.lib.openai.request_key import digest_of
+from src.philipwilcox.lib.openai.token_counter import (
+    TOKENS_PER_REPLY_PRIMING,
+    get_default_token_counter,
+)
+from src.philipwilcox.personas.api.model.persona_exception import (
+    PersonaDeadlineExceeded,
+    PersonaException,
+)
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryListeners,
+    HistoryRecordKind,
+)
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
     PersonaModelInitPromptTemplate,
 )
+from src.philipwilcox.personas.api.model.persona_request_buffer import (
+    PersonaRequestBuffer,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.persona_context_strategy import (
+    PersonaContextStrategy,
+    context_budget_for_model,
+)
+from src.philipwilcox.personas.api.persona_deadline import remaining_time
+from src.philipwilcox.personas.api.util.persona_tracing import span
+from src.philipwilcox.personas.api.util.response_cache import (
+    ResponseCache,
+    get_default_response_cache,
+)
 
 logger = logging.getLogger(__name__)
 
 
 # TODO: less-hacky way to set this; make PersonaMessenger more injectable for testing
-MESSENGER_OVERRIDES = {
+MESSENGER_OVERRIDES: Dict[str, Any] = {
     "temperature": 0.0,
     # "model": "gpt-3.5-turbo",
     "model": "gpt-4",
 }
 
 
+@contextlib.contextmanager
+def messenger_overrides(**overrides: Any) -> Iterator[None]:
+    """Apply MESSENGER_OVERRIDES only to messengers constructed inside this block.
+
+    Messengers read the overrides once, in their constructor, and persona construction never awaits, so jobs
+    running concurrently can each build their personas with different settings.
+    """
+    previous = dict(MESSENGER_OVERRIDES)
+    MESSENGER_OVERRIDES.update(overrides)
+    try:
+        yield
+    finally:
+        MESSENGER_OVERRIDES.clear()
+        MESSENGER_OVERRIDES.update(previous)
+
+
+# Sees every chunk streamed by any messenger sending in the current context, e.g. every persona in a server
+# session's delegation tree, on top of the `on_chunk` passed to `send`. Set it with `streaming_chunks`.
+CHUNK_LISTENER: contextvars.ContextVar[
+    Optional[Callable[[str], None]]
+] = contextvars.ContextVar("CHUNK_LISTENER", default=None)
+
+
+@contextlib.contextmanager
+def streaming_chunks(on_chunk: Callable[[str], None]) -> Iterator[None]:
+    """Have `on_chunk` see everything streamed by messengers sending inside this block.
+
+    Unlike MESSENGER_OVERRIDES this holds across awaits: tasks copy the context they're created in, so concurrent
+    sessions each only see their own personas' chunks.
+    """
+    token = CHUNK_LISTENER.set(on_chunk)
+    try:
+        yield
+    finally:
+        CHUNK_LISTENER.reset(token)
+
+
+def print_chunk(chunk: str) -> None:
+    print(chunk, end="", flush=True)
+
+
+# Where messengers in streaming_console_mode write what they stream; the console points it at a persona's pane
+CONSOLE_CHUNK_WRITER: contextvars.ContextVar[
+    Callable[[str], None]
+] = contextvars.ContextVar("CONSOLE_CHUNK_WRITER", default=print_chunk)
+
+
+@contextlib.contextmanager
+def console_chunk_writer(write: Callable[[str], None]) -> Iterator[None]:
+    token = CONSOLE_CHUNK_WRITER.set(write)
+    try:
+        yield
+    finally:
+        CONSOLE_CHUNK_WRITER.reset(token)
+
+
+def with_chunk_listener(
+    on_chunk: Optional[Callable[[str], None]],
+    listeners: Sequence[Callable[[str], None]] = (),
+) -> Optional[Callable[[str], None]]:
+    """One callback for `on_chunk`, a messenger's own `listeners` and the context's CHUNK_LISTENER, or None if none."""
+    context_listener = CHUNK_LISTENER.get()
+    callbacks = [c for c in (on_chunk, *listeners, context_listener) if c is not None]
+    if not callbacks:
+        return None
+    if len(callbacks) == 1:
+        return callbacks[0]
+
+    def all_of(chunk: str) -> None:
+        for callback in callbacks:
+            callback(chunk)
+
+    return all_of
+
+
 class PersonaMessenger:
     def __init__(
         self,
@@ -37,9 +145,19 @@ class PersonaMessenger:
         initial_delay_ms: int = 750,
         temperature: float = 0.0,
         llm_model: str = "gpt-4",
+        rate_limiter: Optional[RateLimiter] = None,
+        response_cache: Optional[ResponseCache] = None,
+        context_strategy: Optional[PersonaContextStrategy] = None,
+        context_budget_tokens: Optional[int] = None,
     ):
         self.prompt_messages = init_prompt_template.render(keyword_args=template_kwargs)
-        self.history: List[PersonaMessage] = []
+        self.request_buffer = PersonaRequestBuffer(self.prompt_messages)
+        self._history: List[PersonaMessage] = []
+        # Running total of the usage of every response in `history`, so rollups don't have to walk it
+        self.usage = TokenUsage()
+        self.history_listeners = HistoryListeners()
+        # See every chunk this messenger streams, on top of each send's `on_chunk`, e.g. a websocket or a logger
+        self.chunk_listeners: List[Callable[[str], None]] = []
         # TODO: figure out a way to have my cake and eat it too re: prompt messages so that I can preserve them in
         #       "fully logged" history but not mess with things like console view...
         self.openai = open_ai
@@ -47,57 +165,264 @@ class PersonaMessenger:
         self.streaming_console_mode = streaming_console_mode
         self.retry_count = retry_count
         self.initial_delay_ms = initial_delay_ms
+        # Shared by default so every persona in the process draws from, and backs off against, the same quota
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RATE_LIMITER
+        # If None, falls back to the process default cache (if any) at send time
+        self.response_cache = response_cache
+        # As passed in, before MESSENGER_OVERRIDES; clones re-apply the overrides in effect when they're made
+        self.requested_temperature = temperature
+        self.requested_llm_model = llm_model
+        self.requested_context_budget_tokens = context_budget_tokens
+        # Only consulted when a resent conversation outgrows the budget; None means always send everything
+        self.context_strategy = context_strategy
+        self.apply_overrides()
+
+    def apply_overrides(self) -> None:
         if MESSENGER_OVERRIDES["temperature"]:
-            self.temperature = MESSENGER_OVERRIDES["temperature"]
+            self.temperature: float = MESSENGER_OVERRIDES["temperature"]
         else:
-            self.temperature = temperature
+            self.temperature = self.requested_temperature
         if MESSENGER_OVERRIDES["model"]:
-            self.llm_model = MESSENGER_OVERRIDES["model"]
+            self.llm_model: str = MESSENGER_OVERRIDES["model"]
         else:
-            self.llm_model = llm_model
+            self.llm_model = self.requested_llm_model
+        self.context_budget_tokens = (
+            self.requested_context_budget_tokens
+            if self.requested_context_budget_tokens is not None
+            else context_budget_for_model(self.llm_model)
+        )
+
+    def clone(self) -> "PersonaMessenger":
+        """The same persona with an empty history, without re-rendering or re-serializing its prompt.
+
+        The rendered prompt messages and their request dicts, digest and token estimates are shared with this
+        messenger; they're never modified once built. Everything that changes as the conversation goes on is fresh.
+        """
+        clone = copy.copy(self)
+        clone.request_buffer = self.request_buffer.clone_empty()
+        clone._history = []
+        clone.usage = TokenUsage()
+        clone.history_listeners = HistoryListeners()
+        clone.chunk_listeners = []
+        if self.context_strategy is not None:
+            clone.context_strategy = self.context_strategy.clone()
+        clone.apply_overrides()
+        return clone
+
+    @property
+    def history(self) -> List[PersonaMessage]:
+        return self._history
 
-    async def send(self, m: PersonaMessage) -> PersonaMessage:
+    @history.setter
+    def history(self, history: List[PersonaMessage]) -> None:
+        self._history = history
+        self.request_buffer.reset(history)
+        self.recount_usage()
+        if self.context_strategy is not None:
+            self.context_strategy.reset()
+        self.history_listeners.history_replaced()
+
+    def recount_usage(self) -> None:
+        self.usage = TokenUsage()
+        for m in self._history:
+            if m.usage is not None:
+                self.usage += m.usage
+
+    async def send(
+        self, m: PersonaMessage, on_chunk: Optional[Callable[[str], None]] = None
+    ) -> PersonaMessage:
+        """`on_chunk` sees the response as it streams in; note a retried request streams again from the start."""
         assert m.is_user_message()
-        self.history.append(m)
+        on_chunk = with_chunk_listener(on_chunk, self.chunk_listeners)
+        if not self.request_buffer.is_in_sync_with(self._history):
+            # Someone edited our history list in place instead of assigning it; re-serialize once
+            self.request_buffer.reset(self._history)
+            self.recount_usage()
+            if self.context_strategy is not None:
+                self.context_strategy.reset()
+            self.history_listeners.history_replaced()
+        self._history.append(m)
+        self.request_buffer.append(m)
+        self.history_listeners.message_appended(
+            HistoryRecordKind.MESSAGE_AND_FINAL_MESSAGE, m
+        )
+
+        try:
+            with span(
+                "PersonaMessenger.send",
+                model=self.llm_model,
+                history_length=len(self._history),
+            ):
+                response = await self.request_response(m, on_chunk)
+        except (asyncio.CancelledError, PersonaDeadlineExceeded):
+            # Don't leave our message in the history waiting for a response that's never coming
+            if self._history and self._history[-1] is m:
+                self.history = self._history[:-1]
+            raise
+        self._history.append(response)
+        self.request_buffer.append(response)
+        if response.usage is not None:
+            self.usage += response.usage
+        self.history_listeners.message_appended(
+            HistoryRecordKind.MESSAGE_AND_FINAL_MESSAGE, response
+        )
+        self.history_listeners.step_finished()
+        return response
 
-        messages_to_send = copy.copy(self.prompt_messages)
+    async def request_response(
+        self, m: PersonaMessage, on_chunk: Optional[Callable[[str], None]]
+    ) -> PersonaMessage:
+        """The response to `m`, which has just been added to the history."""
+        windowed = False
+        window_usage: Optional[TokenUsage] = None
         if self.resend_conversation_history:
-            messages_to_send += copy.copy(self.history)
+            # Handed to the transport as-is: only the new message was serialized this turn
+            messages_to_send = self.request_buffer.dicts
+            estimated_tokens = self.request_buffer.estimated_tokens
+            if (
+                self.context_strategy is not None
+                and self.context_budget_tokens is not None
+                and estimated_tokens > self.context_budget_tokens
+            ):
+                with span("context window", estimated_tokens=estimated_tokens):
+                    window = await self.context_strategy.build_window(
+                        self.request_buffer, self.context_budget_tokens
+                    )
+                logger.info(
+                    f"History of ~{estimated_tokens} tokens is over the {self.context_budget_tokens} token budget "
+                    f"for {self.llm_model}; sending ~{window.estimated_tokens} tokens, {window.dropped_messages} "
+                    f"messages left out"
+                )
+                messages_to_send = window.messages
+                estimated_tokens = window.estimated_tokens
+                window_usage = window.usage
+                windowed = True
+        else:
+            messages_to_send = self.request_buffer.prompt_dicts + [
+                self.request_buffer.dicts[-1]
+            ]
+            estimated_tokens = (
+                self.request_buffer.prompt_tokens
+                + self.request_buffer.history_tokens[-1]
+            )
+        prompt_tokens = estimated_tokens + TOKENS_PER_REPLY_PRIMING
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"WILL SEND>>> {[str(m) for m in self.history]}")
+        response_cache = (
+            self.response_cache
+            if self.response_cache is not None
+            else get_default_response_cache()
+        )
+        cache_key: Optional[str] = None
+        cached_chunks: Optional[List[str]] = None
+        if response_cache is not None and response_cache.is_cacheable(self.temperature):
+            if windowed:
+                messages_digest = digest_of(messages_to_send)
+            elif self.resend_conversation_history:
+                messages_digest = self.request_buffer.digest()
+            else:
+                messages_digest = self.request_buffer.digest_with(m)
+            cache_key = ResponseCache.key_for(
+                self.llm_model, self.temperature, messages_digest
+            )
+            cached_chunks = response_cache.get(cache_key)
+
+        if cached_chunks is not None:
+            with span("cache hit", chunks=len(cached_chunks)):
+                chunks = await self.replay_cached_chunks(cached_chunks, on_chunk)
+            response = PersonaMessage.create_assistant_message("".join(chunks))
+            response.usage = TokenUsage.for_cache_hit()
         else:
-            messages_to_send.append(m)
+            chunks = await self.stream_with_retries(
+                messages_to_send, prompt_tokens, on_chunk
+            )
+            if response_cache is not None and cache_key is not None:
+                response_cache.put(cache_key, chunks)
+            response = PersonaMessage.create_assistant_message("".join(chunks))
+            # The streaming API doesn't report usage, so count it ourselves, offline
+            response.usage = TokenUsage.for_call(
+                self.llm_model,
+                prompt_tokens,
+                get_default_token_counter().count_text(response.content),
+            )
+        if window_usage is not None:
+            # e.g. a summarizer's calls, made only so this request would fit
+            response.usage += window_usage
+        return response
+
+    async def replay_cached_chunks(
+        self,
+        cached_chunks: List[str],
+        on_chunk: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
+        """Replay a cache hit chunk-by-chunk so streaming consumers see the same thing as a live response."""
+        chunks: List[str] = []
+        for chunk in cached_chunks:
+            chunks.append(chunk)
+            if self.streaming_console_mode:
+                CONSOLE_CHUNK_WRITER.get()(chunk)
+            if on_chunk is not None:
+                on_chunk(chunk)
+            await asyncio.sleep(0)
+        return chunks
 
-        logger.debug(f"WILL SEND>>> {[str(m) for m in self.history]}")
+    async def stream_with_retries(
+        self,
+        messages_to_send: List[Dict[str, str]],
+        estimated_tokens: int,
+        on_chunk: Optional[Callable[[str], None]] = None,
+    ) -> List[str]:
         num_attempts = 1
         chunks: List[str] = []
         while num_attempts < self.retry_count:
             chunks = []
+            with span("rate limiter wait", estimated_tokens=estimated_tokens):
+                await self.rate_limiter.acquire(self.llm_model, estimated_tokens)
             try:
-                async for chunk in self.openai.stream_chat_completion(
-                    messages=messages_to_send,
-                    temperature=self.temperature,
-                    model=self.llm_model,
-                ):
-                    chunks.append(chunk)
-                    if self.streaming_console_mode:
-                        print(chunk, end="")
-            except (
-                RateLimitError,
-                ServiceUnavailableError,
-                APIError,
-                ClientPayloadError,
-            ) as e:
-                delay_ms = num_attempts * self.initial_delay_ms
+                with span("stream", attempt=num_attempts) as stream_span:
+                    async for chunk in self.openai.stream_serialized_chat_completion(
+                        messages_as_dicts=messages_to_send,
+                        temperature=self.temperature,
+                        model=self.llm_model,
+                    ):
+                        if not chunks:
+                            stream_span.mark("time to first token")
+                        chunks.append(chunk)
+                        if self.streaming_console_mode:
+                            CONSOLE_CHUNK_WRITER.get()(chunk)
+                        if on_chunk is not None:
+                            on_chunk(chunk)
+                    stream_span.set(chunks=len(chunks))
+            except Exception as e:
+                if not isinstance(e, retryable_errors()):
+                    raise
+                if isinstance(e, rate_limit_error()):
+                    # Pauses every messenger on this model, not just us, so the fleet doesn't retry in lockstep
+                    self.rate_limiter.on_rate_limited(
+                        self.llm_model, e.headers, num_attempts
+                    )
+                delay_s = self.rate_limiter.backoff_seconds(
+                    num_attempts, self.initial_delay_ms / 1000
+                )
+                remaining_s = remaining_time()
+                if remaining_s is not None and delay_s >= remaining_s:
+                    # No point sleeping until the deadline cancels us anyway
+                    raise PersonaDeadlineExceeded(
+                        f"Got a {type(e)} error from OpenAI on retry attempt {num_attempts}, and the deadline is "
+                        f"{max(remaining_s, 0) * 1000:.0f}ms away"
+                    ) from e
                 logger.warning(
-                    f"Got a {type(e)} error from OpenAI on retry attempt {num_attempts}, retrying after {delay_ms}ms"
+                    f"Got a {type(e)} error from OpenAI on retry attempt {num_attempts}, retrying after {delay_s * 1000:.0f}ms"
                 )
-                await asyncio.sleep(delay_ms / 1000)
+                with span(
+                    "retry backoff", attempt=num_attempts, error=type(e).__name__
+                ):
+                    await asyncio.sleep(delay_s)
                 num_attempts += 1
                 if num_attempts >= self.retry_count:
                     raise e
             else:
                 break
-        # Process and return at top-level instead of in `else` to avoid mypy complaining about missing return
-        # for the `except` case
-        response = PersonaMessage.create_assistant_message("".join(chunks))
-        self.history.append(response)
-        return response
+        # Return at top-level instead of in `else` to avoid mypy complaining about missing return for the `except` case
+        return chunks
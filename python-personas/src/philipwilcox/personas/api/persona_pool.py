@@ -0,0 +1,37 @@
+import logging
+from typing import Callable, Dict, Hashable
+
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+
+logger = logging.getLogger(__name__)
+
+
+class PersonaPool:
+    """Builds each kind of persona once, as a prototype, and hands out clones of it.
+
+    Building a delegating persona renders and serializes the prompt of every persona in its tree; a clone shares all
+    of that with the prototype and only gets a fresh history (see `ResponseDrivenPersona.clone`). Prototypes are
+    never handed out themselves, so they stay empty. Clones pick up the MESSENGER_OVERRIDES in effect when they're
+    made, so one prototype serves every model and temperature.
+    """
+
+    def __init__(self) -> None:
+        self.prototypes: Dict[Hashable, ResponseDrivenPersona] = {}
+        self.builds = 0
+        self.clones = 0
+
+    def get(
+        self, key: Hashable, build: Callable[[], ResponseDrivenPersona]
+    ) -> ResponseDrivenPersona:
+        """A fresh clone of the prototype for `key`, calling `build` to make the prototype the first time."""
+        prototype = self.prototypes.get(key)
+        if prototype is None:
+            prototype = build()
+            self.prototypes[key] = prototype
+            self.builds += 1
+            logger.debug(f"Built persona prototype for {key}")
+        self.clones += 1
+        return prototype.clone()
+
+    def clear(self) -> None:
+        self.prototypes = {}
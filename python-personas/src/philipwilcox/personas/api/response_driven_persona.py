@@ -3,16 +3,23 @@ from typing import Any, Optional
 
 from src.philipwilcox.personas.api.model.llm_facing_info import LlmFacingInfo
 from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    PersonaHistoryListener,
+)
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 
 
 # TODO: GOAL - would be great if I could "chat-gpt" the stuff like "create a data class in a separate file, ProposedPersonaResponse, with..." instead of manually creating the file manually
 class ResponseDrivenPersona(metaclass=abc.ABCMeta):
+    # Most any one call may take, on top of any deadline the caller set; see persona_deadline
+    timeout_s: Optional[float] = None
+
     @abc.abstractmethod
     def get_name(self) -> str:
         pass
@@ -29,6 +36,10 @@ class ResponseDrivenPersona(metaclass=abc.ABCMeta):
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
         pass
 
+    def total_usage(self) -> TokenUsage:
+        """The same as `get_history().total_usage()`; personas that keep running totals override it to skip the walk."""
+        return self.get_history().total_usage()
+
     @abc.abstractmethod
     def get_last_assistant_response(self) -> Optional[ProposedPersonaResponse]:
         """This is needed for resuming from history with a proper ProposedPersonaResponse"""
@@ -38,6 +49,18 @@ class ResponseDrivenPersona(metaclass=abc.ABCMeta):
     async def send_message_and_process_autonomously(self, message: str) -> Any:
         pass
 
+    def add_history_listener(self, listener: PersonaHistoryListener) -> None:
+        """Have `listener` told about every message added to this persona's history, subpersonas included."""
+        raise PersonaException(
+            "History listeners not implemented for this Persona, please implement this to report history changes if you need to persist it incrementally."
+        )
+
+    def clone(self) -> "ResponseDrivenPersona":
+        """The same persona, with its whole delegation tree, and an empty history; see PersonaPool."""
+        raise PersonaException(
+            "Cloning not implemented for this Persona, please implement this to build copies of it without re-rendering its prompts."
+        )
+
     def get_llm_facing_info(self) -> LlmFacingInfo:
         raise PersonaException(
             "LLM-facing info not implemented for this Persona, please implement this to return a dict of strings for use in prompting a coordinating persona's LLM if desired."
@@ -1,6 +1,6 @@
 import datetime
 import json
-from typing import Any
+from typing import Any, Dict
 
 from src.philipwilcox.personas.api.model.persona_exception import (
     PersonaException,
@@ -11,16 +11,52 @@ from src.philipwilcox.personas.api.model.persona_message import (
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
 )
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
 
+LEGACY_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f%Z"
 
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """Parses both our legacy `2023-07-01 12:00:00.123456UTC` format and ISO 8601, always returning an aware datetime.
+
+    Much faster than `strptime`, which matters when loading histories with hundreds of thousands of messages.
+    """
+    if value.endswith("UTC"):
+        value = value[:-3]
+    timestamp = datetime.datetime.fromisoformat(value)
+    # `%Z` wrote "UTC" (or nothing, for naive timestamps), and naive timestamps can't be compared with new messages'
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
+# Builds the whole history tree as dicts before anything is written; prefer `save_persona_history` in
+# persona_history_stream, which streams. Kept so existing callers of `json.dump(..., cls=...)` keep working.
 class PersonaDataJsonEncoder(json.JSONEncoder):
     def default(self, obj: Any) -> Any:
         if isinstance(obj, PersonaMessage):
-            return {
+            encoded: Dict[str, Any] = {
                 "role": obj.role.value,
                 "content": obj.content,
                 "timestamp": obj.timestamp,
             }
+            # Only written when known, so histories saved before token accounting still round-trip unchanged
+            if obj.token_count is not None:
+                encoded["token_count"] = obj.token_count
+            if obj.usage is not None:
+                encoded["usage"] = self.default(obj.usage)
+            if obj.inbound_usage is not None:
+                encoded["inbound_usage"] = self.default(obj.inbound_usage)
+            return encoded
+        elif isinstance(obj, TokenUsage):
+            return {
+                "prompt_tokens": obj.prompt_tokens,
+                "completion_tokens": obj.completion_tokens,
+                "calls": obj.calls,
+                "cached_calls": obj.cached_calls,
+                "cost_usd": obj.cost_usd,
+                "by_persona": {k: self.default(v) for k, v in obj.by_persona.items()},
+            }
         elif isinstance(obj, ResponseDrivenPersonaHistory):
             messages = [self.default(m) for m in obj.messages]
             final_messages = [self.default(m) for m in obj.final_messages]
@@ -31,7 +67,7 @@ class PersonaDataJsonEncoder(json.JSONEncoder):
                 "subhistories": subhistories,
             }
         elif isinstance(obj, datetime.datetime):
-            return obj.strftime("%Y-%m-%d %H:%M:%S.%f%Z")
+            return obj.strftime(LEGACY_TIMESTAMP_FORMAT)
         return super().default(obj)
 
 
@@ -42,41 +78,44 @@ class PersonaDataJsonDecoder(json.JSONDecoder):
     def object_hook(self, dct: Any) -> Any:
         if isinstance(dct, dict):
             if "role" in dct and "content" in dct and "timestamp" in dct:
-                match dct["role"]:
-                    case "assistant":
-                        return PersonaMessage.create_assistant_message(
-                            dct["content"],
-                            datetime.datetime.strptime(
-                                dct["timestamp"], "%Y-%m-%d %H:%M:%S.%f%Z"
-                            ),
-                        )
-                    case "user":
-                        return PersonaMessage.create_user_message(
-                            dct["content"],
-                            datetime.datetime.strptime(
-                                dct["timestamp"], "%Y-%m-%d %H:%M:%S.%f%Z"
-                            ),
-                        )
-                    case "system":
-                        return PersonaMessage.create_system_message(
-                            dct["content"],
-                            datetime.datetime.strptime(
-                                dct["timestamp"], "%Y-%m-%d %H:%M:%S.%f%Z"
-                            ),
-                        )
-                    case _:
-                        raise PersonaException(
-                            f"Invalid role {dct['role']} in json data"
-                        )
+                m = self.decode_message(dct)
+                m.token_count = dct.get("token_count")
+                m.usage = dct.get("usage")
+                m.inbound_usage = dct.get("inbound_usage")
+                return m
+            elif (
+                "prompt_tokens" in dct and "completion_tokens" in dct and "calls" in dct
+            ):
+                # Nested `by_persona` entries were already decoded, since object hooks run innermost-first
+                return TokenUsage(**dct)
             elif (
                 "messages" in dct and "final_messages" in dct and "subhistories" in dct
             ):
-                messages = [self.object_hook(m) for m in dct["messages"]]
-                final_messages = [self.object_hook(m) for m in dct["final_messages"]]
-                subhistories = {
-                    k: self.object_hook(v) for k, v in dct["subhistories"].items()
-                }
+                # Messages and subhistories were already decoded by the hook on the way up
                 return ResponseDrivenPersonaHistory(
-                    messages, final_messages, subhistories
+                    dct["messages"], dct["final_messages"], dct["subhistories"]
                 )
         return dct
+
+    def decode_message(self, dct: Dict[str, Any]) -> PersonaMessage:
+        match dct["role"]:
+            case "assistant":
+                return PersonaMessage.create_assistant_message(
+                    dct["content"],
+                    self.decode_timestamp(dct["timestamp"]),
+                )
+            case "user":
+                return PersonaMessage.create_user_message(
+                    dct["content"],
+                    self.decode_timestamp(dct["timestamp"]),
+                )
+            case "system":
+                return PersonaMessage.create_system_message(
+                    dct["content"],
+                    self.decode_timestamp(dct["timestamp"]),
+                )
+            case _:
+                raise PersonaException(f"Invalid role {dct['role']} in json data")
+
+    def decode_timestamp(self, value: str) -> datetime.datetime:
+        return parse_timestamp(value)
@@ -0,0 +1,320 @@
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_message import (
+    MessageRole,
+    PersonaMessage,
+)
+from src.philipwilcox.personas.api.model.response_driven_persona_history import (
+    ResponseDrivenPersonaHistory,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+
+# A binary history is MAGIC, one byte naming the compression of the rest, then the (possibly compressed) body:
+#
+#   node := list_mode messages [final_messages] subhistory_count (string name, node)*
+#   messages := count message*
+#   message := varint(role | flags << 2) zigzag_varint(microseconds since the previous message's timestamp)
+#              content [varint token_count] [usage] [usage]
+#   content := paragraph_count string*  (the content split on blank lines)
+#   usage := prompt completion calls cached_calls float64(cost_usd) by_persona_count (string name, usage)*
+#   string := varint(0) varint(length) utf8 bytes, defining the next string table entry
+#           | varint(index + 1), repeating an earlier entry
+#
+# Paragraphs rather than whole messages go in the string table because that's the granularity things repeat at: a
+# coordinator's "The response from X was:" followed by, verbatim, a reply already stored in X's own history.
+MAGIC = b"PHB1"
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_LZ4 = 3
+COMPRESSION_NAMES = {
+    None: COMPRESSION_NONE,
+    "zlib": COMPRESSION_ZLIB,
+    "zstd": COMPRESSION_ZSTD,
+    "lz4": COMPRESSION_LZ4,
+}
+# The fastest to load of what's installed; zlib is always available but noticeably slower to decompress
+DEFAULT_COMPRESSION = "zstd" if zstandard else "lz4" if lz4 else None
+
+ROLE_CODES = {
+    MessageRole.USER: 0,
+    MessageRole.SYSTEM: 1,
+    MessageRole.ASSISTANT: 2,
+}
+ROLES_BY_CODE = {code: role for role, code in ROLE_CODES.items()}
+
+FLAG_TOKEN_COUNT = 1
+FLAG_USAGE = 2
+FLAG_INBOUND_USAGE = 4
+
+LIST_MODE_SEPARATE = 0
+# messages and final_messages are the same list, e.g. a BasicPersona's; stored once
+LIST_MODE_SHARED = 1
+
+PARAGRAPH_SEPARATOR = "\n\n"
+_DOUBLE = struct.Struct("<d")
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.out = bytearray()
+        self.strings: Dict[str, int] = {}
+        self.string_references = 0
+        self.previous_timestamp_us = 0
+
+    def varint(self, value: int) -> None:
+        out = self.out
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    def string(self, value: str) -> None:
+        self.string_references += 1
+        index = self.strings.get(value)
+        if index is not None:
+            self.varint(index + 1)
+            return
+        self.strings[value] = len(self.strings)
+        encoded = value.encode("utf-8")
+        self.out.append(0)
+        self.varint(len(encoded))
+        self.out += encoded
+
+    def usage(self, usage: TokenUsage) -> None:
+        self.varint(usage.prompt_tokens)
+        self.varint(usage.completion_tokens)
+        self.varint(usage.calls)
+        self.varint(usage.cached_calls)
+        self.out += _DOUBLE.pack(usage.cost_usd)
+        self.varint(len(usage.by_persona))
+        for name, sub_usage in usage.by_persona.items():
+            self.string(name)
+            self.usage(sub_usage)
+
+    def message(self, m: PersonaMessage) -> None:
+        flags = 0
+        if m.token_count is not None:
+            flags |= FLAG_TOKEN_COUNT
+        if m.usage is not None:
+            flags |= FLAG_USAGE
+        if m.inbound_usage is not None:
+            flags |= FLAG_INBOUND_USAGE
+        self.varint(ROLE_CODES[m.role] | flags << 2)
+        timestamp_us = m.timestamp_ns // 1000
+        delta = timestamp_us - self.previous_timestamp_us
+        # Zigzag, since re-timed messages can be stored after later ones
+        self.varint(delta << 1 if delta >= 0 else (-delta << 1) - 1)
+        self.previous_timestamp_us = timestamp_us
+        paragraphs = m.content.split(PARAGRAPH_SEPARATOR)
+        self.varint(len(paragraphs))
+        for p in paragraphs:
+            self.string(p)
+        if m.token_count is not None:
+            self.varint(m.token_count)
+        if m.usage is not None:
+            self.usage(m.usage)
+        if m.inbound_usage is not None:
+            self.usage(m.inbound_usage)
+
+    def messages(self, messages: List[PersonaMessage]) -> None:
+        self.varint(len(messages))
+        for m in messages:
+            self.message(m)
+
+    def node(self, history: ResponseDrivenPersonaHistory) -> None:
+        if history.messages is history.final_messages:
+            self.varint(LIST_MODE_SHARED)
+            self.messages(history.messages)
+        else:
+            self.varint(LIST_MODE_SEPARATE)
+            self.messages(history.messages)
+            self.messages(history.final_messages)
+        self.varint(len(history.subhistories))
+        for name, subhistory in history.subhistories.items():
+            self.string(name)
+            self.node(subhistory)
+
+
+class _Reader:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.pos = 0
+        self.strings: List[str] = []
+        self.previous_timestamp_us = 0
+
+    def varint(self) -> int:
+        data = self.data
+        pos = self.pos
+        byte = data[pos]
+        pos += 1
+        if byte < 0x80:
+            self.pos = pos
+            return byte
+        value = byte & 0x7F
+        shift = 7
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                self.pos = pos
+                return value
+            shift += 7
+
+    def string(self) -> str:
+        ref = self.varint()
+        if ref:
+            return self.strings[ref - 1]
+        length = self.varint()
+        value = self.data[self.pos : self.pos + length].decode("utf-8")
+        self.pos += length
+        self.strings.append(value)
+        return value
+
+    def usage(self) -> TokenUsage:
+        prompt_tokens = self.varint()
+        completion_tokens = self.varint()
+        calls = self.varint()
+        cached_calls = self.varint()
+        (cost_usd,) = _DOUBLE.unpack_from(self.data, self.pos)
+        self.pos += _DOUBLE.size
+        by_persona = {}
+        for _ in range(self.varint()):
+            name = self.string()
+            by_persona[name] = self.usage()
+        return TokenUsage(
+            prompt_tokens, completion_tokens, calls, cached_calls, cost_usd, by_persona
+        )
+
+    def message(self) -> PersonaMessage:
+        header = self.varint()
+        flags = header >> 2
+        zigzag = self.varint()
+        timestamp_us = self.previous_timestamp_us + (
+            zigzag >> 1 if not zigzag & 1 else -((zigzag + 1) >> 1)
+        )
+        self.previous_timestamp_us = timestamp_us
+        content = PARAGRAPH_SEPARATOR.join(
+            [self.string() for _ in range(self.varint())]
+        )
+        return PersonaMessage(
+            ROLES_BY_CODE[header & 3],
+            content,
+            token_count=self.varint() if flags & FLAG_TOKEN_COUNT else None,
+            usage=self.usage() if flags & FLAG_USAGE else None,
+            inbound_usage=self.usage() if flags & FLAG_INBOUND_USAGE else None,
+            timestamp_ns=timestamp_us * 1000,
+        )
+
+    def messages(self) -> List[PersonaMessage]:
+        return [self.message() for _ in range(self.varint())]
+
+    def node(self) -> ResponseDrivenPersonaHistory:
+        list_mode = self.varint()
+        messages = self.messages()
+        if list_mode == LIST_MODE_SHARED:
+            final_messages = messages
+        else:
+            final_messages = self.messages()
+        subhistories = {}
+        for _ in range(self.varint()):
+            name = self.string()
+            subhistories[name] = self.node()
+        return ResponseDrivenPersonaHistory(messages, final_messages, subhistories)
+
+
+def _compression_code(compression: Optional[str]) -> int:
+    if compression not in COMPRESSION_NAMES:
+        raise PersonaException(f"Unknown history compression {compression}")
+    if compression == "zstd" and zstandard is None:
+        raise PersonaException("zstd compression needs the zstandard package")
+    if compression == "lz4" and lz4 is None:
+        raise PersonaException("lz4 compression needs the lz4 package")
+    return COMPRESSION_NAMES[compression]
+
+
+def encode_persona_history(
+    history: ResponseDrivenPersonaHistory,
+    compression: Optional[str] = DEFAULT_COMPRESSION,
+) -> bytes:
+    """`compression` is None, "zlib", "zstd" (needs zstandard) or "lz4" (needs lz4).
+
+    Timestamps are stored to the microsecond, the precision PersonaMessage keeps them at.
+    """
+    code = _compression_code(compression)
+    writer = _Writer()
+    writer.node(history)
+    body = bytes(writer.out)
+    if code == COMPRESSION_ZLIB:
+        body = zlib.compress(body)
+    elif code == COMPRESSION_ZSTD:
+        body = zstandard.ZstdCompressor().compress(body)
+    elif code == COMPRESSION_LZ4:
+        body = lz4.frame.compress(body)
+    return MAGIC + bytes([code]) + body
+
+
+def decode_persona_history(data: bytes) -> ResponseDrivenPersonaHistory:
+    if data[: len(MAGIC)] != MAGIC:
+        raise PersonaException("Not a binary persona history")
+    code = data[len(MAGIC)]
+    body = data[len(MAGIC) + 1 :]
+    if code == COMPRESSION_ZLIB:
+        body = zlib.decompress(body)
+    elif code == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise PersonaException("This history is zstd compressed; install zstandard")
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif code == COMPRESSION_LZ4:
+        if lz4 is None:
+            raise PersonaException("This history is lz4 compressed; install lz4")
+        body = lz4.frame.decompress(body)
+    elif code != COMPRESSION_NONE:
+        raise PersonaException(f"Unknown history compression code {code}")
+    reader = _Reader(body)
+    history = reader.node()
+    if reader.pos != len(body):
+        raise PersonaException("Trailing data after binary persona history")
+    return history
+
+
+def save_persona_history_binary(
+    history: ResponseDrivenPersonaHistory,
+    path: str,
+    compression: Optional[str] = DEFAULT_COMPRESSION,
+) -> None:
+    data = encode_persona_history(history, compression)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def load_persona_history_binary(path: str) -> ResponseDrivenPersonaHistory:
+    with open(path, "rb") as f:
+        return decode_persona_history(f.read())
+
+
+def is_binary_persona_history(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def string_table_stats(history: ResponseDrivenPersonaHistory) -> Tuple[int, int]:
+    """(distinct strings, string references) in `history`'s encoding: how much repetition the string table removes."""
+    writer = _Writer()
+    writer.node(history)
+    return len(writer.strings), writer.string_references
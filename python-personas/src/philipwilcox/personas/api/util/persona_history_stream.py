@@ -0,0 +1,344 @@
+import dataclasses
+import json
+import logging
+from typing import IO, Any, Dict, Iterator, List, Optional, Sequence
+
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryPath,
+    HistoryRecordKind,
+)
+from src.philipwilcox.personas.api.model.persona_message import (
+    MessageRole,
+    PersonaMessage,
+)
+from src.philipwilcox.personas.api.model.response_driven_persona_history import (
+    ResponseDrivenPersonaHistory,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.util.persona_data_json import (
+    PersonaDataJsonDecoder,
+    parse_timestamp,
+)
+
+logger = logging.getLogger(__name__)
+
+# A history stream is one header line followed by one line per record, depth-first:
+#
+#   <json path of subpersona names>\t<kind>\t<json payload>
+#
+# where kind is HISTORY_RECORD (a history node starts; empty payload) or one of the HistoryRecordKind values for a
+# message. A node's own records are written before its subhistories, so each node's messages are one contiguous run
+# of lines. JSON escapes tabs and newlines inside strings, so neither can appear inside a field.
+STREAM_FORMAT = "persona-history-stream"
+STREAM_VERSION = 1
+HISTORY_RECORD = "h"
+MESSAGE_RECORD = HistoryRecordKind.MESSAGE.value
+FINAL_MESSAGE_RECORD = HistoryRecordKind.FINAL_MESSAGE.value
+MESSAGE_AND_FINAL_MESSAGE_RECORD = HistoryRecordKind.MESSAGE_AND_FINAL_MESSAGE.value
+_HISTORY_RECORD_BYTES = HISTORY_RECORD.encode()
+_MESSAGE_RECORD_BYTES = MESSAGE_RECORD.encode()
+_FINAL_MESSAGE_RECORD_BYTES = FINAL_MESSAGE_RECORD.encode()
+_MESSAGE_AND_FINAL_MESSAGE_RECORD_BYTES = MESSAGE_AND_FINAL_MESSAGE_RECORD.encode()
+
+_COMPACT = (",", ":")
+# `json.loads` re-scans the whole string for surrounding whitespace; payloads never have any, and skipping that is
+# a good share of the decode time for a history with many short messages
+_raw_decode = json.JSONDecoder().raw_decode
+
+
+def usage_to_dict(usage: TokenUsage) -> Dict[str, Any]:
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "calls": usage.calls,
+        "cached_calls": usage.cached_calls,
+        "cost_usd": usage.cost_usd,
+        "by_persona": {k: usage_to_dict(v) for k, v in usage.by_persona.items()},
+    }
+
+
+def usage_from_dict(d: Dict[str, Any]) -> TokenUsage:
+    return TokenUsage(
+        d["prompt_tokens"],
+        d["completion_tokens"],
+        d["calls"],
+        d.get("cached_calls", 0),
+        d.get("cost_usd", 0.0),
+        {k: usage_from_dict(v) for k, v in d.get("by_persona", {}).items()},
+    )
+
+
+def message_to_dict(message: PersonaMessage) -> Dict[str, Any]:
+    encoded: Dict[str, Any] = {
+        "role": message.role.value,
+        "content": message.content,
+        "timestamp": message.timestamp.isoformat(),
+    }
+    if message.token_count is not None:
+        encoded["token_count"] = message.token_count
+    if message.usage is not None:
+        encoded["usage"] = usage_to_dict(message.usage)
+    if message.inbound_usage is not None:
+        encoded["inbound_usage"] = usage_to_dict(message.inbound_usage)
+    return encoded
+
+
+def message_from_dict(d: Dict[str, Any]) -> PersonaMessage:
+    try:
+        role = MessageRole(d["role"])
+    except ValueError:
+        raise PersonaException(f"Invalid role {d['role']} in json data")
+    usage = d.get("usage")
+    inbound_usage = d.get("inbound_usage")
+    return PersonaMessage(
+        role,
+        d["content"],
+        parse_timestamp(d["timestamp"]),
+        d.get("token_count"),
+        usage_from_dict(usage) if usage is not None else None,
+        usage_from_dict(inbound_usage) if inbound_usage is not None else None,
+    )
+
+
+def _header_line() -> str:
+    return json.dumps({"format": STREAM_FORMAT, "version": STREAM_VERSION}) + "\n"
+
+
+def _record_line(path: HistoryPath, kind: str, payload: Dict[str, Any]) -> str:
+    return (
+        f"{json.dumps(list(path), separators=_COMPACT)}\t{kind}\t"
+        f"{json.dumps(payload, separators=_COMPACT)}\n"
+    )
+
+
+def message_record_line(
+    path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+) -> str:
+    return _record_line(path, kind.value, message_to_dict(message))
+
+
+def _history_lines(
+    history: ResponseDrivenPersonaHistory, path: HistoryPath
+) -> Iterator[str]:
+    yield _record_line(path, HISTORY_RECORD, {})
+    if history.messages is history.final_messages:
+        # e.g. a BasicPersona's history; write each message once
+        for m in history.messages:
+            yield _record_line(
+                path, MESSAGE_AND_FINAL_MESSAGE_RECORD, message_to_dict(m)
+            )
+    else:
+        for m in history.messages:
+            yield _record_line(path, MESSAGE_RECORD, message_to_dict(m))
+        for m in history.final_messages:
+            yield _record_line(path, FINAL_MESSAGE_RECORD, message_to_dict(m))
+    for name, subhistory in history.subhistories.items():
+        yield from _history_lines(subhistory, path + (name,))
+
+
+def write_persona_history(history: ResponseDrivenPersonaHistory, file: IO[str]) -> None:
+    """Writes `history` one message at a time, so memory use doesn't grow with the size of the history."""
+    file.write(_header_line())
+    for line in _history_lines(history, ()):
+        file.write(line)
+
+
+def save_persona_history(history: ResponseDrivenPersonaHistory, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        write_persona_history(history, file)
+
+
+class _PathParser:
+    """Record lines repeat the same few paths over and over, so only decode each distinct one once."""
+
+    def __init__(self) -> None:
+        self.paths: Dict[Any, HistoryPath] = {}
+
+    def parse(self, raw: Any) -> HistoryPath:
+        path = self.paths.get(raw)
+        if path is None:
+            path = tuple(json.loads(raw))
+            self.paths[raw] = path
+        return path
+
+
+def _check_header(line: str) -> bool:
+    """Whether `line` is a history stream header, as opposed to the start of a legacy single-document JSON file."""
+    if not line.startswith('{"format"'):
+        return False
+    try:
+        header = json.loads(line)
+    except json.JSONDecodeError:
+        return False
+    if not isinstance(header, dict) or header.get("format") != STREAM_FORMAT:
+        return False
+    if header.get("version") != STREAM_VERSION:
+        raise PersonaException(
+            f"Unsupported persona history stream version {header.get('version')}"
+        )
+    return True
+
+
+def _append_message_record(
+    history: ResponseDrivenPersonaHistory, kind: str, payload: str
+) -> None:
+    message = message_from_dict(_raw_decode(payload)[0])
+    if kind == MESSAGE_RECORD:
+        history.messages.append(message)
+    elif kind == FINAL_MESSAGE_RECORD:
+        history.final_messages.append(message)
+    elif kind == MESSAGE_AND_FINAL_MESSAGE_RECORD:
+        history.messages.append(message)
+        history.final_messages.append(message)
+    else:
+        raise PersonaException(f"Unknown persona history record kind {kind}")
+
+
+class PersonaHistoryBuilder:
+    """Applies record lines to a history tree, e.g. a stream being read, or a log's records on top of a snapshot.
+
+    Subhistories are created the first time a record mentions them, so a log only needs to carry message records.
+    """
+
+    def __init__(self, root: Optional[ResponseDrivenPersonaHistory] = None) -> None:
+        self.root = (
+            root if root is not None else ResponseDrivenPersonaHistory([], [], {})
+        )
+        self.nodes: Dict[HistoryPath, ResponseDrivenPersonaHistory] = {}
+        self._index(self.root, ())
+        self.paths = _PathParser()
+
+    def _index(self, history: ResponseDrivenPersonaHistory, path: HistoryPath) -> None:
+        self.nodes[path] = history
+        for name, subhistory in history.subhistories.items():
+            self._index(subhistory, path + (name,))
+
+    def node(self, path: HistoryPath) -> ResponseDrivenPersonaHistory:
+        node = self.nodes.get(path)
+        if node is None:
+            node = ResponseDrivenPersonaHistory([], [], {})
+            self.node(path[:-1]).subhistories[path[-1]] = node
+            self.nodes[path] = node
+        return node
+
+    def add_line(self, line: str) -> None:
+        raw_path, kind, payload = line.split("\t", 2)
+        node = self.node(self.paths.parse(raw_path))
+        if kind != HISTORY_RECORD:
+            _append_message_record(node, kind, payload)
+
+
+def read_persona_history(file: IO[str]) -> ResponseDrivenPersonaHistory:
+    """Builds the history as records stream in; JSON is only ever decoded a line at a time."""
+    if not _check_header(file.readline()):
+        raise PersonaException("Not a persona history stream")
+    builder = PersonaHistoryBuilder()
+    for line in file:
+        builder.add_line(line)
+    return builder.root
+
+
+def load_persona_history(path: str) -> ResponseDrivenPersonaHistory:
+    """Loads a history stream, or a history saved as one JSON document with PersonaDataJsonEncoder."""
+    with open(path, "r", encoding="utf-8") as file:
+        first_line = file.readline()
+        file.seek(0)
+        if _check_header(first_line):
+            return read_persona_history(file)
+        logger.info(f"{path} is not a history stream; loading it as legacy JSON")
+        history = json.load(file, cls=PersonaDataJsonDecoder)
+    if not isinstance(history, ResponseDrivenPersonaHistory):
+        raise PersonaException(f"{path} does not contain a persona history")
+    return history
+
+
+@dataclasses.dataclass
+class PersonaHistoryIndexEntry:
+    # Byte range of this node's own records; its subhistories' records follow it
+    start: int
+    end: int
+    message_count: int = 0
+    final_message_count: int = 0
+    subhistory_names: List[str] = dataclasses.field(default_factory=list)
+
+
+class LazyPersonaHistoryView:
+    """Opens a history stream without decoding any messages, then decodes only the subhistories asked for.
+
+    Opening scans the file once, reading just the path and kind at the start of each line, to index where every
+    subhistory's messages are. Use it to inspect one subpersona of a large saved session.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.index: Dict[HistoryPath, PersonaHistoryIndexEntry] = {}
+        self._build_index()
+
+    def _build_index(self) -> None:
+        paths = _PathParser()
+        with open(self.path, "rb") as file:
+            header = file.readline()
+            if not _check_header(header.decode("utf-8")):
+                raise PersonaException(f"{self.path} is not a persona history stream")
+            offset = len(header)
+            entry: Optional[PersonaHistoryIndexEntry] = None
+            for line in file:
+                path_end = line.index(b"\t")
+                path = paths.parse(line[:path_end])
+                kind = line[path_end + 1 : path_end + 2]
+                if kind == _HISTORY_RECORD_BYTES:
+                    entry = PersonaHistoryIndexEntry(offset, offset)
+                    self.index[path] = entry
+                    if path:
+                        self.index[path[:-1]].subhistory_names.append(path[-1])
+                elif entry is None:
+                    raise PersonaException("Persona history stream has no root history")
+                elif kind == _MESSAGE_RECORD_BYTES:
+                    entry.message_count += 1
+                elif kind == _FINAL_MESSAGE_RECORD_BYTES:
+                    entry.final_message_count += 1
+                elif kind == _MESSAGE_AND_FINAL_MESSAGE_RECORD_BYTES:
+                    entry.message_count += 1
+                    entry.final_message_count += 1
+                offset += len(line)
+                if entry is not None:
+                    entry.end = offset
+
+    def subhistory_names(self, path: Sequence[str] = ()) -> List[str]:
+        return list(self._entry(path).subhistory_names)
+
+    def message_count(self, path: Sequence[str] = ()) -> int:
+        return self._entry(path).message_count
+
+    def final_message_count(self, path: Sequence[str] = ()) -> int:
+        return self._entry(path).final_message_count
+
+    def load(
+        self, path: Sequence[str] = (), include_subhistories: bool = True
+    ) -> ResponseDrivenPersonaHistory:
+        """Decodes the history at `path` (a sequence of subpersona names; empty for the root)."""
+        with open(self.path, "rb") as file:
+            return self._load(file, tuple(path), include_subhistories)
+
+    def _load(
+        self, file: IO[bytes], path: HistoryPath, include_subhistories: bool
+    ) -> ResponseDrivenPersonaHistory:
+        entry = self._entry(path)
+        file.seek(entry.start)
+        history = ResponseDrivenPersonaHistory([], [], {})
+        records = file.read(entry.end - entry.start).decode("utf-8")
+        for line in records.splitlines():
+            _, kind, payload = line.split("\t", 2)
+            if kind != HISTORY_RECORD:
+                _append_message_record(history, kind, payload)
+        if include_subhistories:
+            for name in entry.subhistory_names:
+                history.subhistories[name] = self._load(file, path + (name,), True)
+        return history
+
+    def _entry(self, path: Sequence[str]) -> PersonaHistoryIndexEntry:
+        entry = self.index.get(tuple(path))
+        if entry is None:
+            raise PersonaException(f"No subhistory at {'/'.join(path)}")
+        return entry
@@ -0,0 +1,204 @@
+import logging
+import os
+import re
+from typing import IO, List, Optional, Tuple
+
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryPath,
+    HistoryRecordKind,
+    PersonaHistoryListener,
+)
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.response_driven_persona_history import (
+    ResponseDrivenPersonaHistory,
+    history_shape,
+)
+from src.philipwilcox.personas.api.response_driven_persona import (
+    ResponseDrivenPersona,
+)
+from src.philipwilcox.personas.api.util.persona_history_stream import (
+    PersonaHistoryBuilder,
+    message_record_line,
+    read_persona_history,
+    write_persona_history,
+)
+
+logger = logging.getLogger(__name__)
+
+GENERATION_FILENAME_PATTERN = re.compile(r"^snapshot-(\d+)\.jsonl$")
+
+
+class PersonaSessionLog(PersonaHistoryListener):
+    """Persists a persona's whole delegation tree after every step, without ever rewriting what's already saved.
+
+    `directory` holds a snapshot (a history stream, see persona_history_stream) plus a log of every message added
+    since, one record line per message, tagged with the path of the subpersona it belongs to. Messages are collected
+    as they're appended and written (and fsynced) when the persona finishes a step, since delegators may re-time a
+    step's messages before it ends; a crash loses at most the step in progress. Every `snapshot_every_records`
+    records, or when some history is rolled back rather than appended to, a new snapshot replaces the old snapshot
+    and log.
+
+    Use `resume` to restore a persona from the directory and keep logging it, or `attach` to start a fresh session.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        snapshot_every_records: int = 10_000,
+        fsync: bool = True,
+    ) -> None:
+        self.directory = directory
+        self.snapshot_every_records = snapshot_every_records
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.persona: Optional[ResponseDrivenPersona] = None
+        self.generation = self.latest_generation()
+        self.log_file: Optional[IO[str]] = None
+        self.pending: List[Tuple[HistoryPath, HistoryRecordKind, PersonaMessage]] = []
+        self.records_since_snapshot = 0
+        self.snapshot_needed = False
+
+    def snapshot_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"snapshot-{generation:08d}.jsonl")
+
+    def log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"log-{generation:08d}.jsonl")
+
+    def latest_generation(self) -> Optional[int]:
+        generations = [
+            int(match.group(1))
+            for match in (
+                GENERATION_FILENAME_PATTERN.match(f) for f in os.listdir(self.directory)
+            )
+            if match
+        ]
+        return max(generations) if generations else None
+
+    def load(self) -> Optional[ResponseDrivenPersonaHistory]:
+        """The logged history, i.e. the latest snapshot plus every complete record after it; None if there's none."""
+        if self.generation is None:
+            return None
+        with open(self.snapshot_path(self.generation), "r", encoding="utf-8") as f:
+            builder = PersonaHistoryBuilder(read_persona_history(f))
+        self.records_since_snapshot = 0
+        log_path = self.log_path(self.generation)
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        logger.warning(
+                            f"Ignoring a partially written record at the end of {log_path}"
+                        )
+                        break
+                    builder.add_line(line)
+                    self.records_since_snapshot += 1
+        return builder.root
+
+    def resume(self, persona: ResponseDrivenPersona) -> bool:
+        """Restore `persona` from this log, if anything was logged, and log everything it does from here on.
+
+        Returns whether there was a history to restore.
+        """
+        history = self.load()
+        if history is None:
+            self.attach(persona)
+            return False
+        expected_shape = history_shape(history)
+        persona.set_history(history)
+        self.persona = persona
+        persona.add_history_listener(self)
+        if history_shape(persona.get_history()) != expected_shape:
+            # Restoring dropped something, e.g. a message that was still waiting for its response
+            self.snapshot()
+        else:
+            assert self.generation is not None
+            self.open_log(self.generation)
+        return True
+
+    def attach(self, persona: ResponseDrivenPersona) -> None:
+        """Log `persona` from here on, starting from a snapshot of its current history."""
+        self.persona = persona
+        persona.add_history_listener(self)
+        self.snapshot()
+
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        if self.persona is not None:
+            self.pending.append((path, kind, message))
+
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        self.snapshot_needed = True
+
+    def on_step_finished(self, path: HistoryPath) -> None:
+        # Subpersonas finishing their part doesn't end the root persona's step
+        if not path and self.persona is not None:
+            self.flush()
+
+    def flush(self) -> None:
+        if (
+            self.snapshot_needed
+            or self.records_since_snapshot + len(self.pending)
+            >= self.snapshot_every_records
+        ):
+            self.snapshot()
+            return
+        if not self.pending:
+            return
+        assert self.log_file is not None
+        self.log_file.write(
+            "".join(message_record_line(p, k, m) for p, k, m in self.pending)
+        )
+        self.sync(self.log_file)
+        self.records_since_snapshot += len(self.pending)
+        self.pending = []
+
+    def snapshot(self) -> None:
+        """Write the persona's whole current history as a new snapshot, then drop the previous snapshot and log."""
+        assert self.persona is not None
+        previous = self.generation
+        generation = previous + 1 if previous is not None else 1
+        path = self.snapshot_path(generation)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            write_persona_history(self.persona.get_history(), f)
+            self.sync(f)
+        # Only the rename makes the new generation visible, so a crash mid-write leaves the previous one in charge
+        os.replace(f"{path}.tmp", path)
+        self.generation = generation
+        self.open_log(generation)
+        self.pending = []
+        self.records_since_snapshot = 0
+        self.snapshot_needed = False
+        if previous is not None:
+            for old in (self.snapshot_path(previous), self.log_path(previous)):
+                if os.path.exists(old):
+                    os.remove(old)
+        logger.info(f"Wrote persona history snapshot {path}")
+
+    def open_log(self, generation: int) -> None:
+        if self.log_file is not None:
+            self.log_file.close()
+        path = self.log_path(generation)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # Cut a torn final record so the next one starts on its own line
+                    f.seek(0)
+                    content = f.read()
+                    f.truncate(content.rfind(b"\n") + 1)
+        self.log_file = open(path, "a", encoding="utf-8")
+
+    def sync(self, f: IO[str]) -> None:
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        """Write anything still pending and stop logging."""
+        if self.persona is not None and (self.pending or self.snapshot_needed):
+            self.flush()
+        self.persona = None
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import time
+import weakref
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Names of the personas whose spans enclose the current one, outermost first. Tasks copy it when they're created, so
+# a delegate called concurrently still knows who it's working for.
+PERSONA_PATH: contextvars.ContextVar[Tuple[str, ...]] = contextvars.ContextVar(
+    "PERSONA_PATH", default=()
+)
+
+
+class PersonaTracer:
+    """Collects timed spans of the persona stack as Chrome trace events, for chrome://tracing or Perfetto.
+
+    Every span is an "X" (complete) event, on a track of its own per asyncio task so concurrent delegates don't
+    tangle; within a task spans nest exactly like the calls they time. Each carries the persona path it ran under in
+    its args. Only the first `max_events` spans are kept, so a tracer left on can't eat all the memory.
+    """
+
+    def __init__(self, max_events: int = 1_000_000) -> None:
+        self.max_events = max_events
+        self.events: List[Dict[str, Any]] = []
+        self.dropped_events = 0
+        self.started_s = time.perf_counter()
+        self.pid = os.getpid()
+        self.tracks: weakref.WeakKeyDictionary[
+            "asyncio.Task[Any]", int
+        ] = weakref.WeakKeyDictionary()
+        self.next_track = 1
+
+    def track(self) -> int:
+        """The track of the current task; 0 for code not running in one."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return 0
+        track = self.tracks.get(task)
+        if track is None:
+            track = self.tracks[task] = self.next_track
+            self.next_track += 1
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": track,
+                    "args": {"name": task.get_name()},
+                }
+            )
+        return track
+
+    def record(
+        self, name: str, started_s: float, ended_s: float, args: Dict[str, Any]
+    ) -> None:
+        if len(self.events) >= self.max_events:
+            self.dropped_events += 1
+            return
+        path = PERSONA_PATH.get()
+        if path:
+            args["path"] = " > ".join(path)
+        self.events.append(
+            {
+                "name": name,
+                "cat": "persona",
+                "ph": "X",
+                "ts": (started_s - self.started_s) * 1_000_000,
+                "dur": (ended_s - started_s) * 1_000_000,
+                "pid": self.pid,
+                "tid": self.track(),
+                "args": args,
+            }
+        )
+
+    def export(self, path: str) -> None:
+        if self.dropped_events:
+            logger.warning(
+                f"Trace is missing the last {self.dropped_events} spans, past the limit of {self.max_events}"
+            )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "traceEvents": self.events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"dropped_events": self.dropped_events},
+                },
+                f,
+            )
+
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "persona", "started_s", "path_token")
+
+    def __init__(
+        self,
+        tracer: PersonaTracer,
+        name: str,
+        persona: Optional[str],
+        args: Dict[str, Any],
+    ) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.persona = persona
+        self.args = args
+        self.started_s = 0.0
+        self.path_token: Optional[contextvars.Token[Tuple[str, ...]]] = None
+
+    def __enter__(self) -> "Span":
+        if self.persona is not None:
+            self.path_token = PERSONA_PATH.set(PERSONA_PATH.get() + (self.persona,))
+        self.started_s = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.started_s, time.perf_counter(), self.args)
+        if self.path_token is not None:
+            PERSONA_PATH.reset(self.path_token)
+
+    def set(self, **args: Any) -> None:
+        self.args.update(args)
+
+    def mark(self, name: str, **args: Any) -> None:
+        """Record `name` as a span from the start of this one until now, e.g. the time to a stream's first token."""
+        self.tracer.record(name, self.started_s, time.perf_counter(), args)
+
+
+class NullSpan:
+    """What `span` hands out while tracing is off: does nothing, and is shared, so an untraced span costs a call."""
+
+    def __enter__(self) -> "NullSpan":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        pass
+
+    def set(self, **args: Any) -> None:
+        pass
+
+    def mark(self, name: str, **args: Any) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+TRACER: Optional[PersonaTracer] = None
+
+
+def set_tracer(tracer: Optional[PersonaTracer]) -> None:
+    global TRACER
+    TRACER = tracer
+
+
+def get_tracer() -> Optional[PersonaTracer]:
+    return TRACER
+
+
+def span(
+    name: str, persona: Optional[str] = None, **args: Any
+) -> Union[Span, NullSpan]:
+    """Time the block under `name`, with `args` attached. With `persona`, spans inside it get it added to their path.
+
+    Keep `args` cheap to compute: they're built whether or not tracing is on.
+    """
+    tracer = TRACER
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, persona, args)
+
+
+@contextlib.contextmanager
+def tracing_to(path: str, max_events: int = 1_000_000) -> Iterator[PersonaTracer]:
+    """Trace everything inside this block, then write it to `path` as a Chrome trace (even if the block fails)."""
+    tracer = PersonaTracer(max_events)
+    previous = TRACER
+    set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+        tracer.export(path)
+        logger.info(f"Wrote {len(tracer.events)} trace events to {path}")
@@ -0,0 +1,213 @@
+import abc
+import collections
+import dataclasses
+import json
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+from src.philipwilcox.lib.openai.request_key import request_key
+
+
+class ResponseCacheBackend(metaclass=abc.ABCMeta):
+    """Stores the streamed chunks of a response (not just the joined text) so a hit can be replayed as a stream."""
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[List[str]]:
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, chunks: List[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def clear(self) -> None:
+        pass
+
+
+class MemoryLruResponseCacheBackend(ResponseCacheBackend):
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_chars: int = 64 * 1024 * 1024,
+        ttl_s: Optional[float] = None,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.ttl_s = ttl_s
+        self.entries: collections.OrderedDict[
+            str, Tuple[float, List[str], int]
+        ] = collections.OrderedDict()
+        self.total_chars = 0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, chunks, _ = entry
+        if self.ttl_s is not None and time.time() - stored_at > self.ttl_s:
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return chunks
+
+    def put(self, key: str, chunks: List[str]) -> None:
+        if key in self.entries:
+            self._remove(key)
+        size = sum(len(c) for c in chunks)
+        self.entries[key] = (time.time(), chunks, size)
+        self.total_chars += size
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.total_chars > self.max_chars
+        ):
+            self._remove(next(iter(self.entries)))
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.total_chars = 0
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.total_chars -= size
+
+
+class SqliteResponseCacheBackend(ResponseCacheBackend):
+    """On-disk tier so regression runs and repeated demo sweeps survive across processes."""
+
+    def __init__(
+        self, path: str, max_entries: int = 100_000, ttl_s: Optional[float] = None
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self.connection.commit()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        row = self.connection.execute(
+            "SELECT chunks, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.ttl_s is not None and now - row[1] > self.ttl_s:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.connection.commit()
+            return None
+        self.connection.execute(
+            "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+        )
+        self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, chunks: List[str]) -> None:
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, chunks, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(chunks), now, now),
+        )
+        if self.ttl_s is not None:
+            self.connection.execute(
+                "DELETE FROM responses WHERE created < ?", (now - self.ttl_s,)
+            )
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def clear(self) -> None:
+        self.connection.execute("DELETE FROM responses")
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+@dataclasses.dataclass
+class ResponseCacheStats:
+    hits: int = 0
+    misses: int = 0
+    memory_hits: int = 0
+    disk_hits: int = 0
+    stores: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class ResponseCache:
+    """Content-addressed cache of LLM responses, keyed on model, temperature and a digest of the exact messages sent.
+
+    By default only temperature-0.0 requests are cached, since those are the only ones where replaying a previous
+    answer is indistinguishable from asking again.
+    """
+
+    def __init__(
+        self,
+        memory: Optional[ResponseCacheBackend] = None,
+        disk: Optional[ResponseCacheBackend] = None,
+        deterministic_only: bool = True,
+    ) -> None:
+        self.memory = memory if memory is not None else MemoryLruResponseCacheBackend()
+        self.disk = disk
+        self.deterministic_only = deterministic_only
+        self.stats = ResponseCacheStats()
+
+    @staticmethod
+    def key_for(model: str, temperature: float, messages_digest: str) -> str:
+        """`messages_digest` is a PersonaRequestBuffer digest, so the key costs O(1) to derive on every turn."""
+        return request_key(model, temperature, messages_digest)
+
+    def is_cacheable(self, temperature: float) -> bool:
+        return not self.deterministic_only or temperature == 0.0
+
+    def get(self, key: str) -> Optional[List[str]]:
+        chunks = self.memory.get(key)
+        if chunks is not None:
+            self.stats.hits += 1
+            self.stats.memory_hits += 1
+            return chunks
+        if self.disk is not None:
+            chunks = self.disk.get(key)
+            if chunks is not None:
+                self.stats.hits += 1
+                self.stats.disk_hits += 1
+                self.memory.put(key, chunks)
+                return chunks
+        self.stats.misses += 1
+        return None
+
+    def put(self, key: str, chunks: List[str]) -> None:
+        self.stats.stores += 1
+        self.memory.put(key, chunks)
+        if self.disk is not None:
+            self.disk.put(key, chunks)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+
+# Used by every PersonaMessenger that wasn't given its own cache; None means caching is off
+DEFAULT_RESPONSE_CACHE: Optional[ResponseCache] = None
+
+
+def set_default_response_cache(cache: Optional[ResponseCache]) -> None:
+    global DEFAULT_RESPONSE_CACHE
+    DEFAULT_RESPONSE_CACHE = cache
+
+
+def get_default_response_cache() -> Optional[ResponseCache]:
+    return DEFAULT_RESPONSE_CACHE
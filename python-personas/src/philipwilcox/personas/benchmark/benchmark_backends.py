@@ -0,0 +1,30 @@
+from typing import Any, AsyncGenerator, Dict, List
+
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+)
+from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
+
+
+class InstantTransport(ChatCompletionTransport):
+    """Answers every request immediately with a fixed response, so only our own overhead gets measured."""
+
+    needs_api_key = False
+
+    def __init__(self, response: str = "ok") -> None:
+        self.response = response
+        self.requests = 0
+
+    async def stream_chat_completion(
+        self, messages: List[Dict[str, str]], **kwargs: Any
+    ) -> AsyncGenerator[str, None]:
+        self.requests += 1
+        yield self.response
+
+
+class BenchmarkOpenAIWrapper(OpenAIWrapper):
+    """An OpenAIWrapper that never loads `.env.secret.json`, even for transports that send a key (e.g. a fake one)."""
+
+    def __init__(self, transport: ChatCompletionTransport) -> None:
+        super().__init__(transport)
+        self.api_key_loaded = True
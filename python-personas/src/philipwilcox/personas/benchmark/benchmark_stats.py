@@ -0,0 +1,50 @@
+import dataclasses
+import math
+from typing import Dict, List
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile; good enough for latency reporting and doesn't need numpy."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    name: str
+    operations: int
+    wall_seconds: float
+    latencies_s: List[float] = dataclasses.field(default_factory=list)
+    extra: Dict[str, float] = dataclasses.field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        return self.operations / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    @property
+    def p50_ms(self) -> float:
+        return percentile(self.latencies_s, 50) * 1000
+
+    @property
+    def p99_ms(self) -> float:
+        return percentile(self.latencies_s, 99) * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        """The summary numbers, as saved in a baseline."""
+        return {
+            "operations": self.operations,
+            "throughput": self.throughput,
+            "p50_ms": self.p50_ms,
+            "p99_ms": self.p99_ms,
+            **self.extra,
+        }
+
+    def format(self) -> str:
+        extras = "".join(f"  {k}={v:g}" for k, v in self.extra.items())
+        return (
+            f"{self.name:<48} ops={self.operations:<7} wall={self.wall_seconds:8.3f}s  "
+            f"throughput={self.throughput:10.1f}/s  p50={self.p50_ms:8.3f}ms  p99={self.p99_ms:8.3f}ms{extras}"
+        )
@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
+from src.philipwilcox.personas.api.model.response_driven_persona_flat_history import (
+    ResponseDrivenPersonaFlatHistory,
+)
+from src.philipwilcox.personas.api.util.persona_history_stream import (
+    load_persona_history,
+    save_persona_history,
+)
+from src.philipwilcox.personas.benchmark.benchmark_backends import (
+    BenchmarkOpenAIWrapper,
+)
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+from src.philipwilcox.personas.benchmark.history_codec_benchmark import (
+    SUBPERSONAS,
+    build_history,
+    legacy_load,
+    legacy_save,
+)
+from src.philipwilcox.personas.benchmark.messenger_request_benchmark import (
+    bench_messenger_turns,
+    bench_request_building,
+)
+from src.philipwilcox.personas.benchmark.persona_load_benchmark import (
+    build_persona,
+    run_fleet,
+    synthetic_transport,
+)
+
+logger = logging.getLogger(__name__)
+
+# Options that change what's measured; a baseline taken with different ones isn't comparable
+CONFIG_OPTIONS = [
+    "history_lengths",
+    "turns",
+    "delegation_personas",
+    "fleet_sizes",
+    "messages_per_persona",
+    "flat_history_messages",
+    "json_messages",
+    "repeats",
+    "tokens_per_second",
+    "time_to_first_token_s",
+    "chars_per_chunk",
+    "delegations_per_request",
+]
+
+
+def timed(name: str, fn: Callable[[], object], repeats: int) -> BenchmarkResult:
+    latencies = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started)
+    return BenchmarkResult(name, repeats, sum(latencies), latencies)
+
+
+async def fleet(
+    name: str, mode: str, personas: int, args: argparse.Namespace
+) -> BenchmarkResult:
+    transport = synthetic_transport(mode, args)
+    open_ai = BenchmarkOpenAIWrapper(transport)
+    result = await run_fleet(
+        name,
+        lambda: build_persona(mode, open_ai),
+        personas,
+        args.messages_per_persona,
+    )
+    result.extra["llm_requests"] = float(transport.requests)
+    await open_ai.close()
+    return result
+
+
+def suite_messenger(args: argparse.Namespace) -> List[BenchmarkResult]:
+    """Building each request as the history grows, alone and as part of a whole send."""
+    # The copy+serialize rows time the code request buffers replaced; they're for comparison, not regressions
+    results = [
+        r
+        for r in bench_request_building(args.history_lengths)
+        if r.name.startswith("request buffer")
+    ]
+    return results + asyncio.run(
+        bench_messenger_turns(args.turns, max(1, args.turns // 5))
+    )
+
+
+def suite_delegation(args: argparse.Namespace) -> List[BenchmarkResult]:
+    return [
+        asyncio.run(
+            fleet(
+                f"{mode} delegation, {args.delegation_personas} personas",
+                mode,
+                args.delegation_personas,
+                args,
+            )
+        )
+        for mode in ("agent", "linear")
+    ]
+
+
+def suite_flat_history(args: argparse.Namespace) -> List[BenchmarkResult]:
+    persona = build_persona(
+        "agent", BenchmarkOpenAIWrapper(synthetic_transport("agent", args))
+    )
+    assert isinstance(persona, DelegatingPersona)
+    names = list(persona.get_history().subhistories)
+    results = []
+    for n in args.flat_history_messages:
+        history = build_history(n // (len(names) + 1), names)
+        results.append(
+            timed(
+                f"flat history @ {n} msgs",
+                lambda: ResponseDrivenPersonaFlatHistory.from_nested_history(
+                    history, persona
+                ),
+                args.repeats,
+            )
+        )
+    return results
+
+
+def suite_json_history(args: argparse.Namespace) -> List[BenchmarkResult]:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "history.json")
+        stream_path = os.path.join(tmp, "history.jsonl")
+        for n in args.json_messages:
+            history = build_history(n // (len(SUBPERSONAS) + 1))
+            for name, fn in [
+                ("legacy JSON save", lambda: legacy_save(history, legacy_path)),
+                ("legacy JSON load", lambda: legacy_load(legacy_path)),
+                (
+                    "history stream save",
+                    lambda: save_persona_history(history, stream_path),
+                ),
+                ("history stream load", lambda: load_persona_history(stream_path)),
+            ]:
+                results.append(timed(f"{name} @ {n} msgs", fn, args.repeats))
+    return results
+
+
+def suite_fleets(args: argparse.Namespace) -> List[BenchmarkResult]:
+    return [
+        asyncio.run(fleet(f"{mode} fleet of {n}", mode, n, args))
+        for n in args.fleet_sizes
+        for mode in ("agent", "linear")
+    ]
+
+
+SUITES: Dict[str, Callable[[argparse.Namespace], List[BenchmarkResult]]] = {
+    "messenger": suite_messenger,
+    "delegation": suite_delegation,
+    "flat_history": suite_flat_history,
+    "json_history": suite_json_history,
+    "fleets": suite_fleets,
+}
+
+
+def save_baseline(
+    path: str, results: List[BenchmarkResult], args: argparse.Namespace
+) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "config": {o: getattr(args, o) for o in CONFIG_OPTIONS},
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "results": {r.name: r.as_dict() for r in results},
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare_to_baseline(
+    results: List[BenchmarkResult],
+    baseline: Dict[str, Any],
+    args: argparse.Namespace,
+) -> List[str]:
+    """Print each result against the baseline, and return the ones whose p50 or throughput got worse than tolerated.
+
+    p99 is printed too, but with a run's few samples it's too noisy to fail on. So are operations that take less than
+    the noise floor: they only count as regressed once p50 has grown by more than it.
+    """
+    config = {o: getattr(args, o) for o in CONFIG_OPTIONS}
+    if baseline.get("config") != config:
+        logger.warning(
+            f"Baseline was taken with different options ({baseline.get('config')}); results may not be comparable"
+        )
+    regressions = []
+    for r in results:
+        before = baseline["results"].get(r.name)
+        if before is None:
+            print(f"{r.name:<48} (not in baseline)")
+            continue
+        p50_change = r.p50_ms / before["p50_ms"] - 1 if before["p50_ms"] else 0.0
+        p99_change = r.p99_ms / before["p99_ms"] - 1 if before["p99_ms"] else 0.0
+        throughput_change = (
+            r.throughput / before["throughput"] - 1 if before["throughput"] else 0.0
+        )
+        regressed = (
+            p50_change > args.tolerance
+            and r.p50_ms - before["p50_ms"] > args.noise_floor_ms
+        ) or (throughput_change < -args.tolerance and r.p50_ms > args.noise_floor_ms)
+        print(
+            f"{r.name:<48} p50 {before['p50_ms']:9.3f} -> {r.p50_ms:9.3f}ms ({p50_change:+7.1%})  "
+            f"p99 {before['p99_ms']:9.3f} -> {r.p99_ms:9.3f}ms ({p99_change:+7.1%})  "
+            f"throughput {throughput_change:+7.1%}{'  REGRESSED' if regressed else ''}"
+        )
+        if regressed:
+            regressions.append(r.name)
+    return regressions
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(
+        description="The personas.api benchmark suite, against a synthetic LLM backend; save a baseline with "
+        "--save-baseline, then check later runs against it with --compare, which fails on regressions"
+    )
+    parser.add_argument(
+        "--suites", nargs="+", choices=list(SUITES), default=list(SUITES)
+    )
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="How much slower p50 (or lower throughput) can get, as a fraction, before it's a regression",
+    )
+    parser.add_argument("--noise-floor-ms", type=float, default=0.05)
+    parser.add_argument(
+        "--history-lengths", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--delegation-personas", type=int, default=20)
+    parser.add_argument("--fleet-sizes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--messages-per-persona", type=int, default=3)
+    parser.add_argument(
+        "--flat-history-messages", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument(
+        "--json-messages", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    # The synthetic backend; by default fast, so fleets measure our overhead more than the simulated model's
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=0.0, help="0 for no limit"
+    )
+    parser.add_argument("--time-to-first-token-s", type=float, default=0.02)
+    parser.add_argument("--chars-per-chunk", type=int, default=4)
+    parser.add_argument("--delegations-per-request", type=int, default=2)
+    args = parser.parse_args()
+
+    results: List[BenchmarkResult] = []
+    for suite in args.suites:
+        suite_results = SUITES[suite](args)
+        for r in suite_results:
+            print(r.format())
+        results += suite_results
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results, args)
+        print(f"Saved baseline of {len(results)} results to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
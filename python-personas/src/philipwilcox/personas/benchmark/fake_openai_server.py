@@ -0,0 +1,91 @@
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Set, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class FakeOpenAIServer:
+    """A local stand-in for the `/chat/completions` streaming endpoint.
+
+    It streams a fixed response as server-sent events and keeps track of how many distinct TCP connections it saw and
+    how many requests per model were in flight at once, which is what we care about when benchmarking transports.
+    """
+
+    def __init__(
+        self,
+        response_text: str = "This is a fake streamed response from the benchmark server.",
+        chunk_size: int = 4,
+        first_chunk_delay_s: float = 0.05,
+        chunk_delay_s: float = 0.002,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.response_text = response_text
+        self.chunk_size = chunk_size
+        self.first_chunk_delay_s = first_chunk_delay_s
+        self.chunk_delay_s = chunk_delay_s
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+        self.connections_seen: Set[Tuple[str, int]] = set()
+        self.requests_served = 0
+        self.in_flight_by_model: Dict[str, int] = {}
+        self.max_in_flight_by_model: Dict[str, int] = {}
+
+    async def start(self) -> str:
+        """Start serving and return the `api_base` to point a transport at."""
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completion)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        sockets = site._server.sockets  # type: ignore
+        self.port = sockets[0].getsockname()[1]
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_chat_completion(self, request: web.Request) -> web.StreamResponse:
+        peer = (
+            request.transport.get_extra_info("peername") if request.transport else None
+        )
+        if peer:
+            self.connections_seen.add((peer[0], peer[1]))
+        body = await request.json()
+        model = body.get("model", "gpt-4")
+        self.in_flight_by_model[model] = self.in_flight_by_model.get(model, 0) + 1
+        self.max_in_flight_by_model[model] = max(
+            self.max_in_flight_by_model.get(model, 0), self.in_flight_by_model[model]
+        )
+        try:
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await asyncio.sleep(self.first_chunk_delay_s)
+            for i in range(0, len(self.response_text), self.chunk_size):
+                chunk = {
+                    "choices": [
+                        {
+                            "delta": {
+                                "content": self.response_text[i : i + self.chunk_size]
+                            }
+                        }
+                    ]
+                }
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                if self.chunk_delay_s:
+                    await asyncio.sleep(self.chunk_delay_s)
+            await response.write(b'data: {"choices": [{"delta": {}}]}\n\n')
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            self.requests_served += 1
+            return response
+        finally:
+            self.in_flight_by_model[model] -= 1
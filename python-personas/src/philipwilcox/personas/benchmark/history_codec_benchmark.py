@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List, Sequence
+
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.response_driven_persona_history import (
+    ResponseDrivenPersonaHistory,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.util.persona_data_json import (
+    PersonaDataJsonDecoder,
+    PersonaDataJsonEncoder,
+)
+from src.philipwilcox.personas.api.util.persona_history_binary import (
+    DEFAULT_COMPRESSION,
+    load_persona_history_binary,
+    save_persona_history_binary,
+    string_table_stats,
+)
+from src.philipwilcox.personas.api.util.persona_history_stream import (
+    LazyPersonaHistoryView,
+    load_persona_history,
+    save_persona_history,
+)
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+
+SUBPERSONAS = ["Goals", "Mood", "Conversation", "Rewriter"]
+CONTENT = (
+    "A line of delegated dialogue, about as long as the ones our sessions save. " * 6
+)
+
+
+def build_history(
+    messages_per_persona: int, subpersonas: Sequence[str] = SUBPERSONAS
+) -> ResponseDrivenPersonaHistory:
+    """An agent-style session: a coordinator plus a few subpersonas, each with its own long history.
+
+    Like a real coordinator's, the root's user messages relay the subpersonas' replies verbatim.
+    """
+
+    def node(n: int, name: str) -> ResponseDrivenPersonaHistory:
+        messages = []
+        for i in range(n):
+            if i % 2:
+                m = PersonaMessage.create_assistant_message(f"{i} {name}: {CONTENT}")
+                m.usage = TokenUsage.for_call("gpt-4", 900, 80)
+            else:
+                m = PersonaMessage.create_user_message(f"{i} {name}: {CONTENT}")
+            m.token_count = 90
+            messages.append(m)
+        return ResponseDrivenPersonaHistory(messages, messages[::4], {})
+
+    root = node(messages_per_persona, "Coordinator")
+    root.subhistories = {name: node(messages_per_persona, name) for name in subpersonas}
+    for i in range(0, messages_per_persona - 1, 2):
+        name = subpersonas[i // 2 % len(subpersonas)]
+        reply = root.subhistories[name].messages[i + 1].content
+        root.messages[i].content = f"The response from {name} was:\n\n{reply}"
+    return root
+
+
+def measure(name: str, fn: Callable[[], object]) -> BenchmarkResult:
+    """Times one run, then measures peak allocations in a second run, since tracemalloc slows Python code down a lot."""
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return BenchmarkResult(
+        name, 1, elapsed, [elapsed], {"peak_mb": round(peak / 1024 / 1024, 1)}
+    )
+
+
+def legacy_save(history: ResponseDrivenPersonaHistory, path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(history, file, cls=PersonaDataJsonEncoder, indent=4)
+
+
+def legacy_load(path: str) -> ResponseDrivenPersonaHistory:
+    with open(path, "r") as file:
+        return json.load(file, cls=PersonaDataJsonDecoder)
+
+
+def bench_history_codecs(messages_per_persona: int) -> List[BenchmarkResult]:
+    history = build_history(messages_per_persona)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "history.json")
+        stream_path = os.path.join(tmp, "history.jsonl")
+        binary_path = os.path.join(tmp, "history.phb")
+        zlib_path = os.path.join(tmp, "history-zlib.phb")
+        compression = DEFAULT_COMPRESSION or "uncompressed"
+        for name, fn in [
+            ("legacy JSON save", lambda: legacy_save(history, legacy_path)),
+            ("history stream save", lambda: save_persona_history(history, stream_path)),
+            (
+                f"binary ({compression}) save",
+                lambda: save_persona_history_binary(history, binary_path),
+            ),
+            (
+                "binary (zlib) save",
+                lambda: save_persona_history_binary(history, zlib_path, "zlib"),
+            ),
+            ("legacy JSON load", lambda: legacy_load(legacy_path)),
+            ("history stream load", lambda: load_persona_history(stream_path)),
+            (
+                f"binary ({compression}) load",
+                lambda: load_persona_history_binary(binary_path),
+            ),
+            ("binary (zlib) load", lambda: load_persona_history_binary(zlib_path)),
+            (
+                "lazy view open + one subhistory",
+                lambda: LazyPersonaHistoryView(stream_path).load(["Mood"]),
+            ),
+        ]:
+            results.append(measure(f"{name} @ {messages_per_persona} msgs/persona", fn))
+        for path in (legacy_path, stream_path, binary_path, zlib_path):
+            print(f"{os.path.basename(path)}: {os.path.getsize(path) / 1024:.0f}KB")
+        distinct, references = string_table_stats(history)
+        print(f"string table: {distinct} distinct of {references} strings")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Saving and loading large persona histories: legacy JSON vs history streams vs binary"
+    )
+    parser.add_argument(
+        "--messages-per-persona", type=int, nargs="+", default=[1000, 10000]
+    )
+    args = parser.parse_args()
+    for n in args.messages_per_persona:
+        for r in bench_history_codecs(n):
+            print(r.format())
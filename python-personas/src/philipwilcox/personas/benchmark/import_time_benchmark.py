@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import pkgutil
+import subprocess
+import sys
+from typing import List
+
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+
+# Slow to import, and only needed once a persona renders a prompt or makes a request
+HEAVY_MODULES = ["openai", "aiohttp", "jinja2", "requests"]
+PACKAGE = "src.philipwilcox.personas.api"
+# Where `src` lives, so a fresh interpreter can import the package
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../.."))
+
+MEASURE_IMPORT = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - started, [m for m in {heavy!r} if m in sys.modules]]))
+"""
+
+
+def api_modules() -> List[str]:
+    # Imported here only to find its modules; each is measured in an interpreter of its own
+    import src.philipwilcox.personas.api as api
+
+    return [PACKAGE] + sorted(
+        m.name for m in pkgutil.walk_packages(api.__path__, prefix=f"{PACKAGE}.")
+    )
+
+
+def measure(module: str, repeats: int) -> BenchmarkResult:
+    """Import `module` into a fresh interpreter `repeats` times; `heavy` counts the heavy modules it pulled in."""
+    latencies = []
+    heavy: List[str] = []
+    for _ in range(repeats):
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                MEASURE_IMPORT.format(module=module, heavy=HEAVY_MODULES),
+            ],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        seconds, heavy = json.loads(out.splitlines()[-1])
+        latencies.append(seconds)
+    result = BenchmarkResult(
+        module.removeprefix("src.philipwilcox.personas."),
+        repeats,
+        sum(latencies),
+        latencies,
+        {"heavy": float(len(heavy))},
+    )
+    if heavy:
+        result.name += f" (imports {', '.join(heavy)})"
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time to import each personas.api module into a fresh interpreter, and whether it pulls in "
+        "openai, aiohttp or Jinja"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--modules", nargs="+", help="Modules to measure instead of all of api"
+    )
+    args = parser.parse_args()
+    for module in args.modules or api_modules():
+        print(measure(module, args.repeats).format())
@@ -0,0 +1,123 @@
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+from typing import Callable, List, Optional
+
+from src.philipwilcox.personas.api.model.persona_message import (
+    MessageRole,
+    PersonaMessage,
+)
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+
+CHARACTERS = ["Joe", "Ann", "Mia", "Sam"]
+SYSTEM_PROMPT = (
+    "You are {character}, a character in an ongoing dialogue. Stay in character, keep your replies short, and "
+    "respond only with what {character} would say next. " * 4
+)
+LINE = (
+    "A line of dialogue, about as long as the ones our characters trade back and forth."
+)
+
+
+class LegacyPersonaMessage:
+    """PersonaMessage as it was before it was slotted: a __dict__ per message, a datetime per timestamp."""
+
+    def __init__(
+        self,
+        role: MessageRole,
+        content: str,
+        timestamp: Optional[datetime.datetime] = None,
+        token_count: Optional[int] = None,
+        usage: Optional[TokenUsage] = None,
+        inbound_usage: Optional[TokenUsage] = None,
+    ):
+        self.role = role
+        self.content = content
+        if timestamp is not None:
+            self.timestamp = timestamp
+        else:
+            self.timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.token_count = token_count
+        self.usage = usage
+        self.inbound_usage = inbound_usage
+
+
+def build_fleet(
+    message_class: Callable[..., object], personas: int, turns: int
+) -> List[List[object]]:
+    """Personas in pairs talking to each other, each with its own copy of its character's system prompt.
+
+    Like real sessions, every string is built separately, even where it's equal to one another persona holds: one
+    persona's reply arrives as its partner's user message.
+    """
+    fleet = []
+    for p in range(personas):
+        character = CHARACTERS[p % len(CHARACTERS)]
+        pair = p // 2
+        messages = [
+            message_class(MessageRole.SYSTEM, SYSTEM_PROMPT.format(character=character))
+        ]
+        for t in range(turns):
+            # Even personas speak on even turns, odd ones answer on odd turns
+            speaker = pair * 2 + t % 2
+            content = f"{speaker} turn {t}: {LINE}"
+            if speaker == p:
+                messages.append(
+                    message_class(
+                        MessageRole.ASSISTANT,
+                        content,
+                        None,
+                        90,
+                        TokenUsage.for_call("gpt-4", 900, 80),
+                    )
+                )
+            else:
+                messages.append(message_class(MessageRole.USER, content, None, 90))
+        fleet.append(messages)
+    return fleet
+
+
+def measure(
+    name: str, message_class: Callable[..., object], personas: int, turns: int
+) -> BenchmarkResult:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    fleet = build_fleet(message_class, personas, turns)
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    messages = sum(len(m) for m in fleet)
+    del fleet
+    return BenchmarkResult(
+        name,
+        messages,
+        elapsed,
+        [],
+        {
+            "live_mb": round(current / 1024 / 1024, 1),
+            "bytes_per_message": round(current / messages),
+        },
+    )
+
+
+def bench_message_memory(personas: int, turns: int) -> List[BenchmarkResult]:
+    label = f"{personas} personas x {turns} turns"
+    return [
+        measure(f"legacy messages, {label}", LegacyPersonaMessage, personas, turns),
+        measure(f"PersonaMessage, {label}", PersonaMessage, personas, turns),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Memory held by a fleet of live personas' histories: dict-based vs slotted messages"
+    )
+    parser.add_argument("--personas", type=int, default=10_000)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    for r in bench_message_memory(args.personas, args.turns):
+        print(r.format())
@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import time
+from typing import Dict, List
+
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
+    PersonaModelInitPromptTemplate,
+)
+from src.philipwilcox.personas.api.model.persona_request_buffer import (
+    PersonaRequestBuffer,
+)
+from src.philipwilcox.personas.api.persona_messenger import PersonaMessenger
+from src.philipwilcox.personas.benchmark.benchmark_backends import (
+    BenchmarkOpenAIWrapper,
+    InstantTransport,
+)
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+
+PROMPT = PersonaModelInitPromptTemplate(
+    [
+        PersonaMessage.create_system_message("You are a benchmark persona."),
+        PersonaMessage.create_user_message("Respond to {{ topic }} " * 200),
+    ],
+    keep_compiled=True,
+)
+TURN_CONTENT = "This is a fairly ordinary line of dialogue for a benchmark turn. " * 4
+
+
+def copy_and_serialize_every_turn(
+    prompt_messages: List[PersonaMessage], history: List[PersonaMessage]
+) -> List[Dict[str, str]]:
+    """What PersonaMessenger used to do per turn: copy prompt + history, then `as_dict()` and hash all of it."""
+    messages_to_send = copy.copy(prompt_messages)
+    messages_to_send += copy.copy(history)
+    dicts = [m.as_dict() for m in messages_to_send]
+    hashlib.sha256(json.dumps(dicts).encode("utf-8")).hexdigest()
+    return dicts
+
+
+def bench_request_building(history_lengths: List[int]) -> List[BenchmarkResult]:
+    prompt_messages = PROMPT.render({"topic": "benchmarks"})
+    results = []
+    for length in history_lengths:
+        history: List[PersonaMessage] = []
+        buffer = PersonaRequestBuffer(prompt_messages)
+        for i in range(length):
+            m = PersonaMessage.create_user_message(f"{i} {TURN_CONTENT}")
+            history.append(m)
+            buffer.append(m)
+        new_message = PersonaMessage.create_user_message(TURN_CONTENT)
+
+        samples = []
+        for _ in range(20):
+            started = time.perf_counter()
+            copy_and_serialize_every_turn(prompt_messages, history + [new_message])
+            samples.append(time.perf_counter() - started)
+        results.append(
+            BenchmarkResult(
+                f"copy+serialize per turn @ {length} msgs",
+                len(samples),
+                sum(samples),
+                samples,
+            )
+        )
+
+        samples = []
+        for _ in range(20):
+            started = time.perf_counter()
+            buffer.append(new_message)
+            buffer.digest()
+            samples.append(time.perf_counter() - started)
+        results.append(
+            BenchmarkResult(
+                f"request buffer append per turn @ {length} msgs",
+                len(samples),
+                sum(samples),
+                samples,
+            )
+        )
+    return results
+
+
+async def bench_messenger_turns(turns: int, report_every: int) -> List[BenchmarkResult]:
+    """Drive a real PersonaMessenger against an instant transport and report per-turn send cost as history grows."""
+    messenger = PersonaMessenger(
+        PROMPT,
+        {"topic": "benchmarks"},
+        BenchmarkOpenAIWrapper(InstantTransport()),
+        resend_conversation_history=True,
+    )
+    results = []
+    window: List[float] = []
+    for i in range(turns):
+        started = time.perf_counter()
+        await messenger.send(PersonaMessage.create_user_message(TURN_CONTENT))
+        window.append(time.perf_counter() - started)
+        if (i + 1) % report_every == 0:
+            results.append(
+                BenchmarkResult(
+                    f"PersonaMessenger.send @ {len(messenger.history)} msgs",
+                    len(window),
+                    sum(window),
+                    window,
+                )
+            )
+            window = []
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Per-turn request building cost as conversation history grows"
+    )
+    parser.add_argument(
+        "--history-lengths", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument("--turns", type=int, default=5000)
+    args = parser.parse_args()
+    for r in bench_request_building(args.history_lengths):
+        print(r.format())
+    for r in asyncio.run(bench_messenger_turns(args.turns, max(1, args.turns // 5))):
+        print(r.format())
@@ -0,0 +1,91 @@
+import argparse
+import time
+from typing import Callable, List
+
+from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
+    PROMPT_TEMPLATE_STATS,
+)
+from src.philipwilcox.personas.api.persona_pool import PersonaPool
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+from src.philipwilcox.personas.benchmark.benchmark_backends import (
+    BenchmarkOpenAIWrapper,
+    InstantTransport,
+)
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+from src.philipwilcox.personas.fiction.character_dialogue_agent_orchestration_persona import (
+    CharacterDialogueAgentOrchestrationPersona,
+)
+from src.philipwilcox.personas.fiction.character_dialogue_linear_orchestration_persona import (
+    CharacterDialogueLinearOrchestrationPersona,
+)
+
+OPEN_AI = BenchmarkOpenAIWrapper(InstantTransport())
+CHARACTER_ONELINER = (
+    "You are Jon Johns. You live for making money. If people aren't helping you make money, you don't have time "
+    "for them. You work in a hedge fund and often berate your coworkers for not working hard enough."
+)
+
+
+def build_agent() -> ResponseDrivenPersona:
+    return CharacterDialogueAgentOrchestrationPersona(
+        OPEN_AI,
+        "Jon Johns",
+        CHARACTER_ONELINER,
+        "Impatient",
+        ["Figure out if I need anything from this person"],
+        ["Time is money.", "What's in it for me?"] * 5,
+    )
+
+
+def build_linear() -> ResponseDrivenPersona:
+    return CharacterDialogueLinearOrchestrationPersona(
+        OPEN_AI,
+        "Jon Johns",
+        CHARACTER_ONELINER,
+        "Impatient",
+        ["Figure out if I need anything from this person"],
+        ["Time is money.", "What's in it for me?"] * 5,
+    )
+
+
+def measure(
+    name: str, make: Callable[[], ResponseDrivenPersona], count: int
+) -> BenchmarkResult:
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        make()
+        latencies.append(time.perf_counter() - t)
+    return BenchmarkResult(name, count, time.perf_counter() - started, latencies)
+
+
+def bench_persona_construction(count: int) -> List[BenchmarkResult]:
+    pool = PersonaPool()
+    results = []
+    for mode, build in [("agent", build_agent), ("linear", build_linear)]:
+        results.append(measure(f"{mode} persona, constructed", build, count))
+        results.append(
+            measure(
+                f"{mode} persona, cloned from pool",
+                lambda: pool.get(mode, build),
+                count,
+            )
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Cost of getting a fresh orchestration persona: constructing it vs cloning a pooled prototype"
+    )
+    parser.add_argument("--count", type=int, default=500)
+    args = parser.parse_args()
+    for r in bench_persona_construction(args.count):
+        print(r.format())
+    stats = PROMPT_TEMPLATE_STATS
+    print(
+        f"prompt templates: {stats.renders} renders in {stats.render_seconds * 1000:.1f}ms, "
+        f"{stats.compiles} compiles in {stats.compile_seconds * 1000:.1f}ms, "
+        f"{stats.hit_rate:.1%} cache hit rate"
+    )
@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Callable, List
+
+from src.philipwilcox.lib.openai.cassette_transport import (
+    Cassette,
+    RecordingTransport,
+    ReplayTransport,
+)
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+    OpenAILibraryTransport,
+)
+from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
+from src.philipwilcox.lib.openai.synthetic_transport import (
+    SyntheticTransport,
+    is_not_delegated,
+)
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+from src.philipwilcox.personas.api.util.persona_tracing import tracing_to
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+from src.philipwilcox.personas.fiction.character_dialogue_agent_orchestration_persona import (
+    CharacterDialogueAgentOrchestrationPersona,
+)
+from src.philipwilcox.personas.fiction.character_dialogue_linear_orchestration_persona import (
+    CharacterDialogueLinearOrchestrationPersona,
+)
+
+logger = logging.getLogger(__name__)
+
+CHARACTER_NAME = "Jon Johns"
+CHARACTER_ONELINER = (
+    "You are Jon Johns. You live for making money. If people aren't helping you make money, you don't have time "
+    "for them. You work in a hedge fund and often berate your coworkers for not working hard enough."
+)
+
+
+def build_persona(mode: str, open_ai: OpenAIWrapper) -> ResponseDrivenPersona:
+    persona_class = (
+        CharacterDialogueAgentOrchestrationPersona
+        if mode == "agent"
+        else CharacterDialogueLinearOrchestrationPersona
+    )
+    return persona_class(
+        open_ai,
+        CHARACTER_NAME,
+        CHARACTER_ONELINER,
+        "Impatient",
+        ["Figure out if I need anything from this person"],
+        ["Time is money.", "What's in it for me?"],
+    )
+
+
+def synthetic_transport(mode: str, args: argparse.Namespace) -> SyntheticTransport:
+    transport = SyntheticTransport(
+        tokens_per_second=args.tokens_per_second or None,
+        time_to_first_token_s=args.time_to_first_token_s,
+        chars_per_chunk=args.chars_per_chunk,
+        delegations_per_request=args.delegations_per_request,
+    )
+    if mode == "agent":
+        # The character coordinator's prompt is the conversation persona's, without the format instructions or the
+        # list of delegates, so tell the transport both
+        transport.is_coordinator = is_not_delegated
+        transport.recipients = list(
+            build_persona(mode, OpenAIWrapper(transport)).get_history().subhistories
+        )
+    return transport
+
+
+def transport_for(mode: str, args: argparse.Namespace) -> ChatCompletionTransport:
+    if args.backend == "synthetic":
+        return synthetic_transport(mode, args)
+    cassette = Cassette(f"{args.cassette}.{mode}.jsonl")
+    if args.backend == "replay":
+        return ReplayTransport(cassette, speed=args.replay_speed)
+    # Recording a synthetic run makes a cassette to try replay with, offline
+    source: ChatCompletionTransport = (
+        synthetic_transport(mode, args)
+        if args.record_synthetic
+        else OpenAILibraryTransport()
+    )
+    return RecordingTransport(source, cassette)
+
+
+async def run_fleet(
+    name: str,
+    make: Callable[[], ResponseDrivenPersona],
+    personas: int,
+    messages_per_persona: int,
+) -> BenchmarkResult:
+    """Every persona talks at once, each sending its messages one after another like a user would."""
+    fleet = [make() for _ in range(personas)]
+    latencies: List[float] = []
+
+    async def conversation(persona: ResponseDrivenPersona, i: int) -> None:
+        for j in range(messages_per_persona):
+            started = time.perf_counter()
+            await persona.send_message_and_process_autonomously(
+                f'{{"name": "Visitor {i}", "line": "Hello, message {j}", "mood": "curious"}}'
+            )
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[conversation(p, i) for i, p in enumerate(fleet)])
+    return BenchmarkResult(
+        name, len(latencies), time.perf_counter() - started, latencies
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    results = []
+    for mode in args.modes:
+        transport = transport_for(mode, args)
+        open_ai = OpenAIWrapper(transport)
+        result = await run_fleet(
+            f"{mode} fleet of {args.personas} ({args.backend})",
+            lambda: build_persona(mode, open_ai),
+            args.personas,
+            args.messages_per_persona,
+        )
+        if isinstance(transport, SyntheticTransport):
+            result.extra["llm_requests"] = float(transport.requests)
+            result.extra["chunks_per_s"] = round(
+                transport.chunks_sent / result.wall_seconds, 1
+            )
+        elif isinstance(transport, ReplayTransport):
+            result.extra["replayed"] = float(transport.hits)
+        await open_ai.close()
+        results.append(result)
+    for r in results:
+        print(r.format())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(
+        description="Throughput of whole orchestration personas against an offline LLM backend"
+    )
+    parser.add_argument(
+        "--backend", choices=["synthetic", "record", "replay"], default="synthetic"
+    )
+    parser.add_argument(
+        "--cassette",
+        default="persona-load",
+        help="Cassette path prefix for record/replay; each mode gets its own file",
+    )
+    parser.add_argument(
+        "--record-synthetic",
+        action="store_true",
+        help="Record the synthetic backend instead of OpenAI",
+    )
+    parser.add_argument("--replay-speed", type=float, default=1.0)
+    parser.add_argument("--modes", nargs="+", default=["agent", "linear"])
+    parser.add_argument("--personas", type=int, default=50)
+    parser.add_argument("--messages-per-persona", type=int, default=3)
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=50.0, help="0 for no limit"
+    )
+    parser.add_argument("--time-to-first-token-s", type=float, default=0.3)
+    parser.add_argument("--chars-per-chunk", type=int, default=4)
+    parser.add_argument("--delegations-per-request", type=int, default=2)
+    parser.add_argument(
+        "--trace",
+        help="Write a Chrome trace of every persona hop to this file, for chrome://tracing or Perfetto",
+    )
+    args = parser.parse_args()
+    with tracing_to(args.trace) if args.trace else contextlib.nullcontext():
+        asyncio.run(main(args))
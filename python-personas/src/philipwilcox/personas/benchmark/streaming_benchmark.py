@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import time
+from typing import List, Optional
+
+from src.philipwilcox.lib.openai.synthetic_transport import SyntheticTransport
+from src.philipwilcox.personas.api.basic_persona import BasicPersona
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
+    PersonaModelInitPromptTemplate,
+)
+from src.philipwilcox.personas.benchmark.benchmark_backends import (
+    BenchmarkOpenAIWrapper,
+)
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+
+PROMPT = PersonaModelInitPromptTemplate(
+    [PersonaMessage.create_system_message("You are {{ name }}. Reply in JSON.")]
+)
+
+
+async def run(
+    personas: int, messages_per_persona: int, transport: SyntheticTransport
+) -> List[BenchmarkResult]:
+    """How long callers wait for something to show: the first chunk from `stream_message`, vs a whole `send_message`."""
+    open_ai = BenchmarkOpenAIWrapper(transport)
+    template = BasicPersona(PROMPT, {"name": "Streamer"}, open_ai, "Streamer")
+    fleet = [template.clone() for _ in range(personas)]
+    first_chunk_s: List[float] = []
+    complete_s: List[float] = []
+
+    async def conversation(persona: BasicPersona) -> None:
+        for i in range(messages_per_persona):
+            started = time.perf_counter()
+            first: Optional[float] = None
+            async for _ in persona.stream_message(f"Hello, message {i}"):
+                if first is None:
+                    first = time.perf_counter() - started
+            complete_s.append(time.perf_counter() - started)
+            if first is not None:
+                first_chunk_s.append(first)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[conversation(p) for p in fleet])
+    wall_s = time.perf_counter() - started
+    await open_ai.close()
+    return [
+        BenchmarkResult(
+            "stream_message, first chunk", len(first_chunk_s), wall_s, first_chunk_s
+        ),
+        BenchmarkResult(
+            "stream_message, complete response", len(complete_s), wall_s, complete_s
+        ),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time to first token through BasicPersona.stream_message against a synthetic backend"
+    )
+    parser.add_argument("--personas", type=int, default=50)
+    parser.add_argument("--messages-per-persona", type=int, default=3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--time-to-first-token-s", type=float, default=0.3)
+    args = parser.parse_args()
+    synthetic = SyntheticTransport(
+        tokens_per_second=args.tokens_per_second,
+        time_to_first_token_s=args.time_to_first_token_s,
+    )
+    for result in asyncio.run(run(args.personas, args.messages_per_persona, synthetic)):
+        print(result.format())
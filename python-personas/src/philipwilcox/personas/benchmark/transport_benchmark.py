@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import logging
+import time
+from typing import List
+
+from src.philipwilcox.lib.openai.chat_completion_transport import (
+    ChatCompletionTransport,
+    OpenAILibraryTransport,
+)
+from src.philipwilcox.lib.openai.pooled_http_transport import PooledHttpTransport
+from src.philipwilcox.personas.benchmark.benchmark_stats import BenchmarkResult
+from src.philipwilcox.personas.benchmark.fake_openai_server import FakeOpenAIServer
+
+logger = logging.getLogger(__name__)
+
+MODELS = ["gpt-4", "gpt-3.5-turbo"]
+
+
+async def run_fleet(
+    name: str,
+    transport: ChatCompletionTransport,
+    server: FakeOpenAIServer,
+    personas: int,
+    messages_per_persona: int,
+) -> BenchmarkResult:
+    server.connections_seen.clear()
+    server.max_in_flight_by_model.clear()
+    latencies: List[float] = []
+
+    async def persona_loop(i: int) -> None:
+        model = MODELS[i % len(MODELS)]
+        for j in range(messages_per_persona):
+            started = time.perf_counter()
+            async for _ in transport.stream_chat_completion(
+                [{"role": "user", "content": f"persona {i} message {j}"}],
+                model=model,
+                stream=True,
+            ):
+                pass
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[persona_loop(i) for i in range(personas)])
+    wall = time.perf_counter() - started
+    await transport.close()
+    extra = {"connections": float(len(server.connections_seen))}
+    for model, count in server.max_in_flight_by_model.items():
+        extra[f"max_in_flight[{model}]"] = float(count)
+    return BenchmarkResult(name, len(latencies), wall, latencies, extra)
+
+
+async def main(personas: int, messages_per_persona: int, concurrency: int) -> None:
+    server = FakeOpenAIServer()
+    api_base = await server.start()
+    try:
+        results = [
+            await run_fleet(
+                "openai library (new session per request)",
+                OpenAILibraryTransport(api_base=api_base, api_key="fake"),
+                server,
+                personas,
+                messages_per_persona,
+            ),
+            await run_fleet(
+                f"pooled transport (per-model limit {concurrency})",
+                PooledHttpTransport(
+                    api_base=api_base,
+                    api_key="fake",
+                    default_model_concurrency=concurrency,
+                ),
+                server,
+                personas,
+                messages_per_persona,
+            ),
+        ]
+    finally:
+        await server.stop()
+    for r in results:
+        print(r.format())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description="Compare chat completion transports against a local fake server"
+    )
+    parser.add_argument("--personas", type=int, default=200)
+    parser.add_argument("--messages-per-persona", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(main(args.personas, args.messages_per_persona, args.concurrency))
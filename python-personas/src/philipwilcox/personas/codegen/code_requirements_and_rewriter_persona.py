@@ -1,12 +1,16 @@
 import json
 import logging
-from typing import List
+from typing import List, Optional
 
 from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
 from src.philipwilcox.personas.api.basic_persona import BasicPersona
 from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
 from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.persona_model_init_prompt import PersonaModelInitPromptTemplate
+from src.philipwilcox.personas.api.persona_context_strategy import (
+    PersonaContextStrategy,
+    PinnedSystemPromptContextStrategy,
+)
 from src.philipwilcox.personas.api.persona_message_delegator_agent import (
     PersonaDelegationInfoAgent,
     PersonaMessageDelegatorAgent,
@@ -33,6 +37,8 @@ class CodeRequirementsAndRewriterPersona(DelegatingPersona, ConsolePersonaMixin)
         primitives: List[MethodSummary],
         open_ai: OpenAIWrapper,
         streaming_console_mode: bool = False,
+        context_strategy: Optional[PersonaContextStrategy] = None,
+        speculative_delegation: bool = False,
     ):
         self.name = "Code Writer"
         pm_persona = CodegenPersonas.create_product_manager(
@@ -84,16 +90,25 @@ null
                     p.get_llm_facing_info().format_for_prompt(p.name)
                     for p in persona_list
                 ],
-                "response_format": self.get_response_format_instructions(),
+                "response_format": self.get_speculative_response_format_instructions()
+                if speculative_delegation
+                else self.get_response_format_instructions(),
             },
             open_ai=open_ai,
             # TODO: make this persona name (rewriter vs writer, etc) consistent everywhere
             name=self.name + " (Coordinator)",
             resend_conversation_history=True,
             streaming_console_mode=streaming_console_mode,
+            # The coordinator resends its whole history, so long sessions would otherwise hit the context limit
+            context_strategy=context_strategy
+            if context_strategy is not None
+            else PinnedSystemPromptContextStrategy(),
         )
         delegation_info = PersonaDelegationInfoAgent(
-            persona_list, coordinating_persona, self
+            persona_list,
+            coordinating_persona,
+            self,
+            speculative_delegation=speculative_delegation,
         )
         DelegatingPersona.__init__(self, PersonaMessageDelegatorAgent(delegation_info))
 
@@ -0,0 +1,121 @@
+import asyncio
+import dataclasses
+import logging
+import sys
+import threading
+from typing import IO, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ConsoleInput:
+    """Lines typed on the console, read on a daemon thread so the event loop keeps running while the user types.
+
+    There's one per process (CONSOLE_INPUT), since two readers would race for the same lines; it follows whichever
+    event loop last started reading.
+    """
+
+    def __init__(self, stream: IO[str] = sys.stdin) -> None:
+        self.stream = stream
+        self.thread: Optional[threading.Thread] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lines: Optional[asyncio.Queue[Optional[str]]] = None
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.lines = asyncio.Queue()
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.read_lines, name="console-input", daemon=True
+            )
+            self.thread.start()
+
+    def read_lines(self) -> None:
+        for line in iter(self.stream.readline, ""):
+            self.deliver(line.rstrip("\n"))
+        self.deliver(None)
+
+    def deliver(self, line: Optional[str]) -> None:
+        loop, lines = self.loop, self.lines
+        assert loop is not None and lines is not None
+        try:
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        except RuntimeError:
+            logger.debug("Dropped a console line read after its event loop closed")
+
+    async def readline(self) -> Optional[str]:
+        """The next line, without its line ending; None once the input is closed."""
+        self.start()
+        assert self.lines is not None
+        line = await self.lines.get()
+        if line is None:
+            # Stay closed for later readers
+            self.lines.put_nowait(None)
+        return line
+
+
+CONSOLE_INPUT = ConsoleInput()
+
+
+@dataclasses.dataclass
+class ConsoleOutput:
+    pane: str
+    text: str
+    # Start on a line of its own, even if the pane's last output didn't end its line
+    own_line: bool = False
+
+
+class ConsoleRenderer:
+    """Writes everything shown on the console from a single task, in the order it was queued.
+
+    Panes (one per persona) write to the queue without waiting on the terminal. With `label_panes`, output switching
+    from one pane to another starts on a new line under the name of the pane it comes from.
+    """
+
+    def __init__(self, stream: IO[str] = sys.stdout, label_panes: bool = False) -> None:
+        self.stream = stream
+        self.label_panes = label_panes
+        self.queue: asyncio.Queue[Optional[ConsoleOutput]] = asyncio.Queue()
+        self.current_pane: Optional[str] = None
+        self.at_line_start = True
+        self.task: Optional[asyncio.Task] = None
+
+    def write(self, pane: str, text: str) -> None:
+        self.queue.put_nowait(ConsoleOutput(pane, text))
+
+    def print(self, pane: str, text: str = "") -> None:
+        self.write(pane, f"{text}\n")
+
+    def notice(self, pane: str, text: str) -> None:
+        """A line about the console itself, kept apart from whatever the pane is streaming."""
+        self.queue.put_nowait(ConsoleOutput(pane, f"{text}\n", own_line=True))
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+        while (output := await self.queue.get()) is not None:
+            self.render(output)
+
+    def render(self, output: ConsoleOutput) -> None:
+        if self.label_panes and output.pane != self.current_pane:
+            if not self.at_line_start:
+                self.stream.write("\n")
+            self.stream.write(f"=== {output.pane} ===\n")
+            self.at_line_start = True
+        elif output.own_line and not self.at_line_start:
+            self.stream.write("\n")
+        self.current_pane = output.pane
+        if output.text:
+            self.stream.write(output.text)
+            self.at_line_start = output.text.endswith("\n")
+        self.stream.flush()
+
+    async def close(self) -> None:
+        """Render everything queued so far, then stop."""
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
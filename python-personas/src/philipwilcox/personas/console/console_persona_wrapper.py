@@ -1,93 +1,295 @@
+import asyncio
 import copy
-from typing import Any, Optional, List
+import logging
+import signal
+import sys
+from typing import IO, Any, Dict, List, Optional
 
 from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
-from src.philipwilcox.personas.api.model.response_driven_persona_flat_history import (
-    ResponseDrivenPersonaFlatHistory,
+from src.philipwilcox.personas.api.model.proposed_persona_response import (
+    ProposedPersonaResponse,
 )
-from src.philipwilcox.personas.api.response_driven_persona import (
-    ResponseDrivenPersona,
+from src.philipwilcox.personas.api.persona_messenger import console_chunk_writer
+from src.philipwilcox.personas.console.async_console import (
+    CONSOLE_INPUT,
+    ConsoleInput,
+    ConsoleRenderer,
 )
 from src.philipwilcox.personas.console.console_persona_mixin import (
     ConsolePersonaMixin,
 )
 
+logger = logging.getLogger(__name__)
+
+CANCEL_COMMAND = "/cancel"
+
 
 class ConsolePersonaWrapper:
+    """A conversation with one persona on the console, in its own pane; see ConsolePersonaPanes.
+
+    Responses are generated in a task of their own, so the event loop (and any other pane) keeps going while this
+    one waits on the LLM or the user types, and "/cancel" or Ctrl-C can stop a response partway.
+    """
+
     def __init__(
-        self, persona: ConsolePersonaMixin, forced_messages: Optional[List[str]] = None
+        self,
+        persona: ConsolePersonaMixin,
+        forced_messages: Optional[List[str]] = None,
+        pane_name: Optional[str] = None,
     ) -> None:
         self.persona = persona
         if forced_messages:
             self.forced_messages = forced_messages
         else:
             self.forced_messages = []
+        self.pane_name = pane_name if pane_name is not None else persona.get_name()
+        self.remaining_messages: List[str] = []
+        self.renderer: Optional[ConsoleRenderer] = None
+        self.last_response: Optional[ProposedPersonaResponse] = None
+        self.generation: Optional[asyncio.Task] = None
+        self.finished = False
+        self.result: Any = None
+
+    async def console(self, console_input: Optional[ConsoleInput] = None) -> Any:
+        await ConsolePersonaPanes([self], console_input).run()
+        return self.result
 
-    async def console(self) -> Any:
+    def print(self, text: str = "") -> None:
+        assert self.renderer is not None
+        self.renderer.print(self.pane_name, text)
+
+    def notice(self, text: str) -> None:
+        assert self.renderer is not None
+        self.renderer.notice(self.pane_name, text)
+
+    def start(self, renderer: ConsoleRenderer) -> None:
+        """Show the conversation so far and prompt for the first message."""
+        self.renderer = renderer
         if isinstance(self.persona, DelegatingPersona):
-            flat_history = ResponseDrivenPersonaFlatHistory.from_nested_history(
-                self.persona.get_history(), self.persona
-            )
+            timeline = self.persona.get_timeline()
             # TODO: create the ability to distinguish between "hidden" init messages for full audit history dumps
-            for m in flat_history.messages:
+            for m in timeline.messages():
                 # TODO: get stack displayed in here too in the user messages
-                print(f"[{m.message.role}]\n{m.message.content}")
-                print()
-            if len(flat_history.messages) > 0:
-                last_message_stack = flat_history.messages[-1].stack
-                last_message = flat_history.messages[-1].message
-            else:
-                last_message_stack = []
-                last_message = None
+                self.print(f"[{m.message.role}]\n{m.message.content}")
+                self.print()
+            last_timeline_message = timeline.last_message()
+            last_message = (
+                last_timeline_message.message
+                if last_timeline_message is not None
+                else None
+            )
         else:
             message_history = self.persona.get_history().messages
-            last_message_stack = []
             if len(message_history) > 0:
                 last_message = message_history[-1]
             else:
                 last_message = None
 
         if last_message:
-            # TODO: do something with last_message_stack here to indicate who we're talking to?
-            last_response = self.persona.get_last_assistant_response()
+            # TODO: do something with the last message's stack here to indicate who we're talking to?
+            self.last_response = self.persona.get_last_assistant_response()
         else:
-            last_response = None
-            print(f"{self.persona.get_agent_name_display()}")
-            print(self.persona.get_user_prompt())
-        remaining_messages = copy.deepcopy(self.forced_messages)
-        while True:
-            agent_name = self.persona.get_agent_name_display()
-            print(f"[ user - speaking to {agent_name} ]")
-            if len(remaining_messages) > 0:
-                user_input = remaining_messages.pop()
-            else:
-                user_input = input()
-            if isinstance(self.persona, DelegatingPersona):
-                if last_response:
-                    accepted = self.proposal_accepted(user_input)
-                    try_to_execute = self.try_to_execute(user_input)
+            self.last_response = None
+            self.print(f"{self.persona.get_agent_name_display()}")
+            self.print(self.persona.get_user_prompt())
+        self.remaining_messages = copy.deepcopy(self.forced_messages)
+        self.prompt()
+
+    def prompt(self) -> None:
+        self.print(f"[ user - speaking to {self.persona.get_agent_name_display()} ]")
+
+    def is_generating(self) -> bool:
+        return self.generation is not None and not self.generation.done()
+
+    async def wait_until_idle(self) -> None:
+        if self.generation is not None:
+            await asyncio.wait([self.generation])
+
+    def cancel(self) -> bool:
+        if not self.is_generating():
+            return False
+        assert self.generation is not None
+        self.generation.cancel()
+        return True
+
+    def handle_input(self, user_input: str) -> None:
+        if user_input == CANCEL_COMMAND:
+            if not self.cancel():
+                self.notice("[ nothing to cancel ]")
+        elif self.is_generating():
+            self.notice(f"[ still responding; {CANCEL_COMMAND} to stop it ]")
+        else:
+            self.generation = asyncio.create_task(self.respond(user_input))
+
+    async def respond(self, user_input: str) -> None:
+        assert self.renderer is not None
+        renderer = self.renderer
+        with console_chunk_writer(lambda chunk: renderer.write(self.pane_name, chunk)):
+            try:
+                if isinstance(self.persona, DelegatingPersona) and self.last_response:
                     # TODO: possibly add a "get next agent name" hook in Persona for when about to do a "process_proposed_response" call...
-                    print("[ assistant ]")
-                    if accepted:
-                        last_response = await self.persona.process_proposed_response(
-                            last_response
+                    self.print("[ assistant ]")
+                    if self.proposal_accepted(user_input):
+                        self.last_response = (
+                            await self.persona.process_proposed_response(
+                                self.last_response
+                            )
+                        )
+                    elif self.try_to_execute(user_input):
+                        self.result = await self.persona.process_final_response(
+                            self.last_response
                         )
-                    elif try_to_execute:
-                        r = await self.persona.process_final_response(last_response)
-                        print(
-                            f"We finalized the session, with response {r}, returning now."
+                        self.finished = True
+                        self.print(
+                            f"We finalized the session, with response {self.result}, returning now."
                         )
-                        return r
+                        return
                     else:
-                        last_response = await self.persona.send_message(user_input)
+                        self.last_response = await self.persona.send_message(user_input)
                 else:
-                    last_response = await self.persona.send_message(user_input)
-            else:
-                last_response = await self.persona.send_message(user_input)
-            print()
+                    self.last_response = await self.persona.send_message(user_input)
+            except asyncio.CancelledError:
+                # The messenger dropped the message it was waiting on, so the conversation carries on from before it
+                self.notice("[ cancelled ]")
+        self.print()
+        self.prompt()
 
     def proposal_accepted(self, user_input: str) -> bool:
         return user_input.lower() in {"done", "ok", "sounds good", "yes"}
 
     def try_to_execute(self, user_input: str) -> bool:
         return user_input.lower() in {"execute", "finalize", "do it"}
+
+
+class ConsolePersonaPanes:
+    """Conversations with several personas on one console at once, each in its own labelled pane.
+
+    Typed lines go to the active pane, the first one to start with; "@name" switches to the pane called `name` and
+    "@name message" sends `message` there. While one pane is responding, the others take input as usual. Forced
+    messages are sent before reading any input, each once its pane is free. Runs until every pane is finalized or
+    the input is closed.
+    """
+
+    def __init__(
+        self,
+        panes: List[ConsolePersonaWrapper],
+        console_input: Optional[ConsoleInput] = None,
+        output: IO[str] = sys.stdout,
+    ) -> None:
+        self.panes = panes
+        self.console_input = (
+            console_input if console_input is not None else CONSOLE_INPUT
+        )
+        self.output = output
+        self.active = panes[0]
+        self.interrupted = asyncio.Event()
+
+    def pane_named(self, name: str) -> Optional[ConsolePersonaWrapper]:
+        return next(
+            (p for p in self.panes if p.pane_name.lower() == name.lower()), None
+        )
+
+    def route(self, line: str) -> None:
+        if line.startswith("@"):
+            name, _, message = line[1:].partition(" ")
+            pane = self.pane_named(name)
+            if pane is None:
+                self.active.notice(
+                    f"[ no pane called {name}; panes are {', '.join(p.pane_name for p in self.panes)} ]"
+                )
+                return
+            self.active = pane
+            if not message:
+                pane.prompt()
+                return
+            line = message
+        if self.active.finished:
+            self.active.notice("[ this conversation is finalized ]")
+        else:
+            self.active.handle_input(line)
+
+    def interrupt(self) -> None:
+        """Ctrl-C: cancel the active pane's response, or stop the console if it has none."""
+        if not self.active.cancel():
+            self.interrupted.set()
+
+    def unfinished_panes(self) -> List[ConsolePersonaWrapper]:
+        return [p for p in self.panes if not p.finished]
+
+    def generations(self) -> List[asyncio.Task]:
+        return [p.generation for p in self.panes if p.generation is not None]
+
+    def raise_failures(self) -> None:
+        """Re-raise the first error any pane hit while responding, as the console has always done."""
+        for generation in self.generations():
+            if generation.done() and not generation.cancelled():
+                error = generation.exception()
+                if error is not None:
+                    raise error
+
+    async def next_line(self, reading: asyncio.Task) -> bool:
+        """Wait for `reading` to finish, unless every pane is finalized or Ctrl-C is pressed first."""
+        interrupted = asyncio.create_task(self.interrupted.wait())
+        try:
+            while not reading.done() and not interrupted.done():
+                if not self.unfinished_panes():
+                    return False
+                running = [g for g in self.generations() if not g.done()]
+                await asyncio.wait(
+                    [reading, interrupted, *running],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+            return reading.done()
+        finally:
+            interrupted.cancel()
+
+    async def run(self) -> Dict[str, Any]:
+        """The results of the panes that were finalized, by pane name."""
+        renderer = ConsoleRenderer(self.output, label_panes=len(self.panes) > 1)
+        renderer.start()
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.interrupt)
+            handling_sigint = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Not the main thread, or a platform without signal handlers in the loop
+            handling_sigint = False
+        reading: Optional[asyncio.Task] = None
+        try:
+            for pane in self.panes:
+                pane.start(renderer)
+            while self.unfinished_panes() and not self.interrupted.is_set():
+                self.raise_failures()
+                forced = next(
+                    (p for p in self.unfinished_panes() if p.remaining_messages), None
+                )
+                if forced is not None:
+                    await forced.wait_until_idle()
+                    if not forced.finished:
+                        message = forced.remaining_messages.pop()
+                        forced.print(message)
+                        forced.handle_input(message)
+                    continue
+                if reading is None:
+                    reading = asyncio.create_task(self.console_input.readline())
+                if not await self.next_line(reading):
+                    continue
+                line = reading.result()
+                reading = None
+                if line is None:
+                    # Input closed; let responses in progress finish
+                    for pane in self.panes:
+                        await pane.wait_until_idle()
+                    break
+                self.route(line)
+            self.raise_failures()
+        finally:
+            if reading is not None:
+                reading.cancel()
+            for pane in self.panes:
+                pane.cancel()
+                await pane.wait_until_idle()
+            if handling_sigint:
+                loop.remove_signal_handler(signal.SIGINT)
+            await renderer.close()
+        return {p.pane_name: p.result for p in self.panes if p.finished}
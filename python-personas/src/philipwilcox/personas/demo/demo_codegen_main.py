@@ -6,9 +6,10 @@ import os
 import sys
 
 from src.philipwilcox.lib.openai.openai_wrapper import OPENAIWRAPPER
-from src.philipwilcox.personas.api.util.persona_data_json import (
-    PersonaDataJsonEncoder,
+from src.philipwilcox.personas.api.util.persona_history_stream import (
+    save_persona_history,
 )
+from src.philipwilcox.personas.api.util.persona_session_log import PersonaSessionLog
 from src.philipwilcox.personas.codegen.code_requirements_and_rewriter_persona import (
     CodeRequirementsAndRewriterPersona,
 )
@@ -35,7 +36,7 @@ PRIMITIVES_PATH = os.path.dirname(
 PRIMITIVES_DESCRIPTIONS_FILENAME = f"{PRIMITIVES_PATH}/primitives_descriptions.json"
 
 
-async def main(history_file: str, mode: str) -> None:
+async def main(history_file: str, mode: str, session_dir: str = "") -> None:
     # Lets load our primitives and write code
     primitives = []
     with open(PRIMITIVES_DESCRIPTIONS_FILENAME, "r") as f:
@@ -48,8 +49,11 @@ async def main(history_file: str, mode: str) -> None:
             persona = CodeRequirementsAndRewriterPersona(
                 primitives, OPENAIWRAPPER, streaming_console_mode=True
             )
+            if session_dir:
+                # Saved after every step, and picked back up where it left off if the session was interrupted
+                PersonaSessionLog(session_dir).resume(persona)
             console_persona = ConsolePersonaWrapper(persona)
-            r = await console_persona.console()  # TODO: add hooks to save to history
+            r = await console_persona.console()
         case "refactor-demo":
             my_request = """
         can you modify the method called func() in target.py to take an integer argument x and return its factorial?
@@ -74,8 +78,7 @@ async def main(history_file: str, mode: str) -> None:
             logger.info(f"Old code was {old_code}; new code is {new_code}")
 
             history = persona.get_history()
-            with open(history_file, "w") as file:
-                json.dump(history, file, cls=PersonaDataJsonEncoder, indent=4)
+            save_persona_history(history, history_file)
         case "refactor-demo-autonomous":
             my_request = """
 can you modify the method called func() in target.py to take an integer argument x and return its factorial?
@@ -89,8 +92,7 @@ can you modify the method called func() in target.py to take an integer argument
             logger.info(f"Old code was {old_code}; new code is {new_code}")
 
             history = persona.get_history()
-            with open(history_file, "w") as file:
-                json.dump(history, file, cls=PersonaDataJsonEncoder, indent=4)
+            save_persona_history(history, history_file)
 
 
 
@@ -100,9 +102,15 @@ if __name__ == "__main__":
     parser.add_argument(
         "--history-file",
         type=str,
-        default="history.json",
+        default="history.jsonl",
         help="a history file to save/load from, if not an empty string",
     )
+    parser.add_argument(
+        "--session-dir",
+        type=str,
+        default="",
+        help="a directory to log the console session to after every step, and resume it from, if not an empty string",
+    )
     parser.add_argument(
         "--mode",
         type=str,
@@ -116,5 +124,6 @@ if __name__ == "__main__":
         main(
             history_file=args.history_file,
             mode=args.mode,
+            session_dir=args.session_dir,
         )
     )
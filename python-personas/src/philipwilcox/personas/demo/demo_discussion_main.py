@@ -1,11 +1,23 @@
 import asyncio
+import contextlib
 import logging
 import os
 from os import makedirs
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional
 
 from src.philipwilcox.personas.api.persona_messenger import MESSENGER_OVERRIDES
+from src.philipwilcox.personas.api.util.persona_tracing import tracing_to
+from src.philipwilcox.personas.api.util.response_cache import (
+    ResponseCache,
+    SqliteResponseCacheBackend,
+    set_default_response_cache,
+)
 from src.philipwilcox.personas.demo.demo_characters import DemoCharacters
+from src.philipwilcox.personas.demo.dialogue_batch_runner import (
+    CHARACTER_FACTORIES,
+    DialogueBatchRunner,
+    expand_matrix,
+)
 from src.philipwilcox.personas.fiction.character_dialogue_agent_orchestration_persona import (
     CharacterDialogueAgentOrchestrationPersona,
 )
@@ -19,6 +31,22 @@ from src.philipwilcox.personas.fiction.character_dialogue_linear_orchestration_p
 logger = logging.getLogger(__name__)
 
 CHARACTERS_STREAM_TO_CONSOLE = True
+# Temperature-0.0 runs replay from here instead of paying for the same calls again
+RESPONSE_CACHE_FILENAME = "response_cache.sqlite"
+# Set to e.g. "trace.json" to write a Chrome trace of every persona hop next to the convos, to see which ones are slow
+TRACE_FILENAME: Optional[str] = None
+
+# The sweep's jobs run concurrently, held under these per-model limits; set them to your account's
+SWEEP_REQUESTS_PER_MINUTE = {"gpt-3.5-turbo": 3500.0, "gpt-4": 200.0}
+SWEEP_TOKENS_PER_MINUTE = {"gpt-3.5-turbo": 90000.0, "gpt-4": 40000.0}
+
+QUESTIONS = [
+    "I am Joe. Who are you? I haven't met you before.",
+    "Tell me more about yourself. What is your greatest ambition?",
+    "I have much on my mind, let's talk about AI first. AI is a huge existential danger to humanity.",
+    "I think you are a fool.",
+    "Maybe we'll agree more on sports. I think football is more fun than basketball.",
+]
 
 
 async def multi_temp_loop() -> None:
@@ -33,27 +61,19 @@ async def multi_temp_loop() -> None:
     models = ["gpt-3.5-turbo", "gpt-4"]
     char_modes = ["basic", "agent", "code"]
 
-    to_skip: List[Tuple[float, str, str]] = []
-
-    for temperature in temperatures:
-        for model in models:
-            for char_mode in char_modes:
-                if model == "gpt-3.5-turbo" and char_mode == "agent":
-                    # NOTE: 3.5 goes off the rails entirely in the agent world right now, lol
-                    continue
-                if (
-                    model == "gpt-3.5-turbo"
-                    and char_mode == "code"
-                    and temperature > 1.0
-                ):
-                    # 3.5 tends to get off-script with my prompt return format for these
-                    continue
-                if (temperature, model, char_mode) in to_skip:
-                    print(
-                        f"Skipping {(temperature, model, char_mode)} from previous run"
-                    )
-                    continue
-                await run_dialogues(temperature, model, char_mode)
+    # Characters run concurrently, so nothing streams to the console; finished jobs are checkpointed in the batch
+    # directory and skipped if this is re-run after an interruption
+    jobs = expand_matrix(
+        temperatures, models, char_modes, list(CHARACTER_FACTORIES), QUESTIONS
+    )
+    root_dir = os.path.dirname(__file__)
+    results_path = await DialogueBatchRunner(
+        jobs,
+        f"{root_dir}/convos/batch",
+        requests_per_minute=SWEEP_REQUESTS_PER_MINUTE,
+        tokens_per_minute=SWEEP_TOKENS_PER_MINUTE,
+    ).run()
+    print(f"Results written to {results_path}")
 
 
 async def run_dialogues(temperature: float, model: str, char_mode: str) -> None:
@@ -70,13 +90,6 @@ async def run_dialogues(temperature: float, model: str, char_mode: str) -> None:
         raise Exception(f"Unknown character mode {char_mode}")
 
     FILENAME_SUFFIX = f"temp{temperature}-{char_mode}-{model}"
-    questions = [
-        "I am Joe. Who are you? I haven't met you before.",
-        "Tell me more about yourself. What is your greatest ambition?",
-        "I have much on my mind, let's talk about AI first. AI is a huge existential danger to humanity.",
-        "I think you are a fool.",
-        "Maybe we'll agree more on sports. I think football is more fun than basketball.",
-    ]
 
     responses: Dict[str, List[str]] = {
         "Hamlet": [],
@@ -101,14 +114,14 @@ async def run_dialogues(temperature: float, model: str, char_mode: str) -> None:
             )
         else:
             raise Exception("Unknown character")
-        for q in questions:
+        for q in QUESTIONS:
             response = await c.send_message_and_process_autonomously(q)
             responses[char].append(response["line"])  # type: ignore   # mypy hackery to support monkey-patched BasicPersona
         makedirs(f"{root_dir}/convos", exist_ok=True)
 
         response_string = ""
         for i, r in enumerate(responses[char]):
-            this_exchange = questions[i] + "\n\n     " + r + "\n\n"
+            this_exchange = QUESTIONS[i] + "\n\n     " + r + "\n\n"
             response_string += this_exchange
 
         with open(
@@ -122,6 +135,18 @@ async def run_dialogues(temperature: float, model: str, char_mode: str) -> None:
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-
-    # asyncio.run(multi_temp_loop())
-    asyncio.run(run_dialogues(0.0, "gpt-4", "code"))
+    convos_dir = f"{os.path.dirname(__file__)}/convos"
+    makedirs(convos_dir, exist_ok=True)
+    set_default_response_cache(
+        ResponseCache(
+            disk=SqliteResponseCacheBackend(f"{convos_dir}/{RESPONSE_CACHE_FILENAME}")
+        )
+    )
+
+    with (
+        tracing_to(f"{convos_dir}/{TRACE_FILENAME}")
+        if TRACE_FILENAME
+        else contextlib.nullcontext()
+    ):
+        # asyncio.run(multi_temp_loop())
+        asyncio.run(run_dialogues(0.0, "gpt-4", "code"))
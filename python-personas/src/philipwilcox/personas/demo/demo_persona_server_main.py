@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import functools
+import logging
+from typing import Callable, Dict
+
+from src.philipwilcox.personas.api.persona_pool import PersonaPool
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+from src.philipwilcox.personas.demo.dialogue_batch_runner import (
+    CHARACTER_CREATORS,
+    CHARACTER_FACTORIES,
+)
+from src.philipwilcox.personas.server.persona_session_manager import (
+    PersonaSessionManager,
+)
+from src.philipwilcox.personas.server.persona_session_server import (
+    PersonaSessionServer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def demo_persona_factories(
+    pool: PersonaPool,
+) -> Dict[str, Callable[[], ResponseDrivenPersona]]:
+    """Every demo character in every mode, e.g. "Hamlet (agent)"; each is built once and cloned for every session."""
+    factories: Dict[str, Callable[[], ResponseDrivenPersona]] = {}
+    for character, create in CHARACTER_FACTORIES.items():
+        for mode, creator in CHARACTER_CREATORS.items():
+            kind = f"{character} ({mode})"
+            factories[kind] = functools.partial(
+                pool.get, kind, functools.partial(create, creator, False)
+            )
+    return factories
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve the demo characters to many concurrent clients over HTTP and WebSocket"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--store-directory", default="persona-sessions")
+    parser.add_argument("--idle-timeout-s", type=float, default=15 * 60)
+    parser.add_argument("--max-live-sessions", type=int, default=None)
+    args = parser.parse_args()
+
+    manager = PersonaSessionManager(
+        demo_persona_factories(PersonaPool()),
+        args.store_directory,
+        idle_timeout_s=args.idle_timeout_s,
+        max_live_sessions=args.max_live_sessions,
+    )
+    server = PersonaSessionServer(manager, args.host, args.port)
+    url = await server.start()
+    logger.info(f"Serving {', '.join(manager.persona_factories)} at {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
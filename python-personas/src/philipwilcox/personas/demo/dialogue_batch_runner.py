@@ -0,0 +1,264 @@
+import asyncio
+import csv
+import dataclasses
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from src.philipwilcox.lib.openai.rate_limiter import RATE_LIMITER
+from src.philipwilcox.personas.api.model.token_usage import TokenUsage
+from src.philipwilcox.personas.api.persona_messenger import messenger_overrides
+from src.philipwilcox.personas.api.persona_pool import PersonaPool
+from src.philipwilcox.personas.api.response_driven_persona import (
+    ResponseDrivenPersona,
+)
+from src.philipwilcox.personas.demo.demo_characters import DemoCharacters
+from src.philipwilcox.personas.fiction.character_dialogue_agent_orchestration_persona import (
+    CharacterDialogueAgentOrchestrationPersona,
+)
+from src.philipwilcox.personas.fiction.character_dialogue_basic_persona import (
+    create_character_dialogue_basic_persona,
+)
+from src.philipwilcox.personas.fiction.character_dialogue_linear_orchestration_persona import (
+    CharacterDialogueLinearOrchestrationPersona,
+)
+
+logger = logging.getLogger(__name__)
+
+CHARACTER_CREATORS: Dict[str, Callable] = {
+    "basic": create_character_dialogue_basic_persona,
+    "agent": CharacterDialogueAgentOrchestrationPersona,
+    "code": CharacterDialogueLinearOrchestrationPersona,
+}
+
+CHARACTER_FACTORIES: Dict[str, Callable[..., ResponseDrivenPersona]] = {
+    "Hamlet": DemoCharacters.create_hamlet,
+    "Lady Macbeth": DemoCharacters.create_lady_macbeth,
+    "Jon Johns": DemoCharacters.create_jon_johns,
+}
+
+CHECKPOINT_FILENAME = "checkpoint.jsonl"
+
+
+@dataclasses.dataclass(frozen=True)
+class DialogueJob:
+    """One cell of the sweep: a single character answering every question, in order, under one configuration."""
+
+    temperature: float
+    model: str
+    char_mode: str
+    character: str
+    questions: tuple
+
+    @property
+    def key(self) -> str:
+        return f"temp{self.temperature}-{self.char_mode}-{self.model}-{self.character}"
+
+
+def default_skip(temperature: float, model: str, char_mode: str) -> bool:
+    if model == "gpt-3.5-turbo" and char_mode == "agent":
+        # NOTE: 3.5 goes off the rails entirely in the agent world right now, lol
+        return True
+    if model == "gpt-3.5-turbo" and char_mode == "code" and temperature > 1.0:
+        # 3.5 tends to get off-script with my prompt return format for these
+        return True
+    return False
+
+
+def expand_matrix(
+    temperatures: Iterable[float],
+    models: Iterable[str],
+    char_modes: Iterable[str],
+    characters: Iterable[str],
+    questions: Iterable[str],
+    skip: Callable[[float, str, str], bool] = default_skip,
+) -> List[DialogueJob]:
+    questions = tuple(questions)
+    return [
+        DialogueJob(temperature, model, char_mode, character, questions)
+        for temperature in temperatures
+        for model in models
+        for char_mode in char_modes
+        if not skip(temperature, model, char_mode)
+        for character in characters
+    ]
+
+
+class DialogueBatchRunner:
+    """Runs a matrix of dialogue jobs concurrently, checkpointing each finished job so an interrupted sweep resumes.
+
+    Every finished job appends its rows to `checkpoint.jsonl` in `output_dir`; on restart those jobs are skipped.
+    Calls from all jobs go through the shared RateLimiter, which is given `requests_per_minute` and
+    `tokens_per_minute` (per model) before any job starts, so `max_concurrent_jobs` mainly bounds memory and how much
+    work is lost in a crash. A model without configured limits only gets them once responses report them, so its
+    first requests go out unthrottled. When done, all rows are written to `results.parquet` (if pyarrow is installed)
+    or `results.csv`.
+    """
+
+    def __init__(
+        self,
+        jobs: List[DialogueJob],
+        output_dir: str,
+        max_concurrent_jobs: int = 8,
+        requests_per_minute: Optional[Dict[str, float]] = None,
+        tokens_per_minute: Optional[Dict[str, float]] = None,
+    ) -> None:
+        self.jobs = jobs
+        self.output_dir = output_dir
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.requests_per_minute = requests_per_minute or {}
+        self.tokens_per_minute = tokens_per_minute or {}
+        self.checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILENAME)
+        # Jobs differing only in model or temperature share one prototype per character and mode
+        self.persona_pool = PersonaPool()
+
+    async def run(self) -> str:
+        """Returns the path of the results file."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.terminate_torn_checkpoint_line()
+        done = self.load_finished_job_keys()
+        pending = [j for j in self.jobs if j.key not in done]
+        logger.info(
+            f"{len(self.jobs)} jobs, {len(self.jobs) - len(pending)} already checkpointed, running {len(pending)}"
+        )
+        self.configure_rate_limits(pending)
+        semaphore = asyncio.Semaphore(self.max_concurrent_jobs)
+
+        async def run_limited(job: DialogueJob) -> None:
+            async with semaphore:
+                rows = await self.run_job(job)
+                self.checkpoint(rows)
+                logger.info(f"Finished {job.key}")
+
+        results = await asyncio.gather(
+            *(run_limited(j) for j in pending), return_exceptions=True
+        )
+        failures = [
+            (job, r) for job, r in zip(pending, results) if isinstance(r, BaseException)
+        ]
+        for job, e in failures:
+            logger.error(
+                f"Job {job.key} failed and will be retried on the next run: {e!r}"
+            )
+        return self.write_results()
+
+    def configure_rate_limits(self, jobs: List[DialogueJob]) -> None:
+        for model in sorted({j.model for j in jobs}):
+            rpm = self.requests_per_minute.get(model)
+            tpm = self.tokens_per_minute.get(model)
+            if rpm is None or tpm is None:
+                logger.warning(
+                    f"No requests and tokens per minute configured for {model}; up to {self.max_concurrent_jobs} "
+                    f"jobs will send requests before its limits are learned from responses"
+                )
+            RATE_LIMITER.set_limits(model, rpm, tpm)
+
+    async def run_job(self, job: DialogueJob) -> List[Dict[str, Any]]:
+        with messenger_overrides(model=job.model, temperature=job.temperature):
+            # Concurrent jobs would interleave their streamed output, so never stream to the console here
+            persona = self.persona_pool.get(
+                (job.character, job.char_mode),
+                lambda: CHARACTER_FACTORIES[job.character](
+                    CHARACTER_CREATORS[job.char_mode], False
+                ),
+            )
+        rows = []
+        for i, question in enumerate(job.questions):
+            usage_before = persona.total_usage()
+            started = time.perf_counter()
+            response = await persona.send_message_and_process_autonomously(question)
+            usage = persona.total_usage() - usage_before
+            rows.append(
+                self.row_for(
+                    job, i, question, response, time.perf_counter() - started, usage
+                )
+            )
+        return rows
+
+    @staticmethod
+    def row_for(
+        job: DialogueJob,
+        question_index: int,
+        question: str,
+        response: Dict[str, str],
+        elapsed_s: float,
+        usage: TokenUsage,
+    ) -> Dict[str, Any]:
+        return {
+            "job": job.key,
+            "temperature": job.temperature,
+            "model": job.model,
+            "char_mode": job.char_mode,
+            "character": job.character,
+            "question_index": question_index,
+            "question": question,
+            "line": response.get("line"),
+            "mood": response.get("mood"),
+            "elapsed_s": elapsed_s,
+            "calls": usage.calls,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cost_usd": usage.cost_usd,
+        }
+
+    def checkpoint(self, rows: List[Dict[str, Any]]) -> None:
+        # One line per job, flushed and synced, so a crash can lose at most the job being written
+        with open(self.checkpoint_path, "a") as f:
+            f.write(json.dumps(rows) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def terminate_torn_checkpoint_line(self) -> None:
+        """End a line left half-written by a crash, so the next job's line doesn't get glued onto it."""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def load_checkpointed_rows(self) -> List[List[Dict[str, Any]]]:
+        if not os.path.exists(self.checkpoint_path):
+            return []
+        jobs_rows = []
+        with open(self.checkpoint_path) as f:
+            for line in f:
+                try:
+                    jobs_rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write; that job simply runs again
+                    logger.warning("Ignoring a partially written checkpoint line")
+        return jobs_rows
+
+    def load_finished_job_keys(self) -> Set[str]:
+        return {rows[0]["job"] for rows in self.load_checkpointed_rows() if rows}
+
+    def write_results(self) -> str:
+        rows = [row for rows in self.load_checkpointed_rows() for row in rows]
+        if pyarrow is not None:
+            path = os.path.join(self.output_dir, "results.parquet")
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+        else:
+            path = os.path.join(self.output_dir, "results.csv")
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(
+                    f,
+                    fieldnames=list(rows[0].keys())
+                    if rows
+                    else ["job", "question_index"],
+                )
+                writer.writeheader()
+                writer.writerows(rows)
+        logger.info(f"Wrote {len(rows)} rows to {path}")
+        return path
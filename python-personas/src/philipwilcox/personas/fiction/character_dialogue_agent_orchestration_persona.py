@@ -1,6 +1,6 @@
 import json
 import logging
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
 from src.philipwilcox.personas.api.basic_persona import (
@@ -11,6 +11,10 @@ from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
 from src.philipwilcox.personas.api.model.persona_model_init_prompt import (
     PersonaModelInitPromptTemplate,
 )
+from src.philipwilcox.personas.api.persona_context_strategy import (
+    PersonaContextStrategy,
+    PinnedSystemPromptContextStrategy,
+)
 from src.philipwilcox.personas.api.persona_message_delegator_agent import (
     PersonaDelegationInfoAgent,
     PersonaMessageDelegatorAgent,
@@ -24,6 +28,7 @@ from src.philipwilcox.personas.api.response_driven_persona import (
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
+from src.philipwilcox.personas.api.util.persona_tracing import span
 from src.philipwilcox.personas.fiction.character_dialogue_personas import (
     CharacterDialoguePersonas,
 )
@@ -51,7 +56,8 @@ Input lines will come in the form of a JSON string representing a dictionary wit
 
 Your response should take into account your current mood with this other person. Your response should be inside of a multi-line markdown code block, starting on the first line after the opening ```. It should be formatted as a JSON string representing a dictionary with three keys: "name", the name of the person you are addressing (or null or "" if unknown); "line", with the text of what you want to say to them; and "mood", your current mood.'''
             ),
-        ]
+        ],
+        keep_compiled=True,
     )
 
     def __init__(
@@ -63,6 +69,8 @@ Your response should take into account your current mood with this other person.
         current_goals: List[str],
         dialogue_examples: List[str],
         streaming_console_mode: bool = False,
+        context_strategy: Optional[PersonaContextStrategy] = None,
+        speculative_delegation: bool = False,
     ) -> None:
         self.name = name
         self.initial_mood = current_mood
@@ -97,15 +105,24 @@ Your response should take into account your current mood with this other person.
                     for p in persona_list
                 ],
                 "mood": current_mood,
-                "response_format": self.get_response_format_instructions(),
+                "response_format": self.get_speculative_response_format_instructions()
+                if speculative_delegation
+                else self.get_response_format_instructions(),
             },
             open_ai=open_ai,
             name=name + "(Coordinator)",
             resend_conversation_history=True,
             streaming_console_mode=streaming_console_mode,
+            # The coordinator resends its whole history, so long sessions would otherwise hit the context limit
+            context_strategy=context_strategy
+            if context_strategy is not None
+            else PinnedSystemPromptContextStrategy(),
         )
         delegation_info = PersonaDelegationInfoAgent(
-            persona_list, coordinating_persona, self
+            persona_list,
+            coordinating_persona,
+            self,
+            speculative_delegation=speculative_delegation,
         )
         DelegatingPersona.__init__(self, PersonaMessageDelegatorAgent(delegation_info))
 
@@ -124,7 +141,12 @@ Your response should take into account your current mood with this other person.
         return self.delegator.get_history()
 
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
-        self.delegator.set_history(history)
+        with span(
+            f"{type(self).__name__}.set_history",
+            persona=self.get_name(),
+            messages=len(history.messages),
+        ):
+            self.delegator.set_history(history)
 
     async def process_final_response(
         self, proposed_response: ProposedPersonaResponse
@@ -134,8 +156,9 @@ Your response should take into account your current mood with this other person.
     async def send_message_and_process_autonomously(
         self, message: str
     ) -> Dict[str, str]:
-        pr = await self.send_message(message)
-        while self.delegator.is_in_processing_loop():
-            pr = await self.process_proposed_response(pr)
+        with span("inbound message", persona=self.get_name()):
+            pr = await self.send_message(message)
+            while self.delegator.is_in_processing_loop():
+                pr = await self.process_proposed_response(pr)
         logger.warning(f"PR message is:\n\n{pr.message}")
         return await self.process_final_response(pr)
@@ -1,7 +1,8 @@
+import copy
 import dataclasses
 import json
 import logging
-from typing import List, Dict, Optional, Callable
+from typing import List, Dict, Optional, Callable, Tuple
 
 from src.philipwilcox.lib.openai.openai_wrapper import OpenAIWrapper
 from src.philipwilcox.lib.util.md import extract_code_block
@@ -15,6 +16,7 @@ from src.philipwilcox.personas.api.model.persona_exception import (
 from src.philipwilcox.personas.api.persona_message_delegator_linear import (
     PersonaMessageDelegatorLinear,
     PersonaDelegationInfoLinear,
+    PersonaDelegationStep,
 )
 from src.philipwilcox.personas.api.model.response_driven_persona_history import (
     ResponseDrivenPersonaHistory,
@@ -25,6 +27,7 @@ from src.philipwilcox.personas.api.response_driven_persona import (
 from src.philipwilcox.personas.api.model.proposed_persona_response import (
     ProposedPersonaResponse,
 )
+from src.philipwilcox.personas.api.util.persona_tracing import span
 from src.philipwilcox.personas.fiction.character_dialogue_agent_orchestration_persona import (
     CharacterDialogueAgentOrchestrationPersona,
 )
@@ -54,6 +57,7 @@ class CharacterDialogueLinearOrchestrationPersona(DelegatingPersona):
         current_goals: List[str],
         dialogue_examples: List[str],
         streaming_console_mode: bool = False,
+        fan_out: bool = False,
     ) -> None:
         self.name = name
         self.initial_mood = current_mood
@@ -73,27 +77,72 @@ class CharacterDialogueLinearOrchestrationPersona(DelegatingPersona):
             open_ai,
             streaming_console_mode,
         )
-        ordered_persona_list = [
+        self.fan_out = fan_out
+        self.subpersonas = [
             goals_persona,
             mood_persona,
             conversation_persona,
             rewriter_persona,
         ]
+        self.delegation_info = (
+            CharacterDialogueLinearOrchestrationPersona.create_delegation_info(
+                current_mood, self.subpersonas, fan_out
+            )
+        )
+        DelegatingPersona.__init__(
+            self, PersonaMessageDelegatorLinear(self.delegation_info)
+        )
+
+    def clone(self) -> "CharacterDialogueLinearOrchestrationPersona":
+        # The message builders close over the subpersonas (and per-conversation state), so build new ones
+        clone = copy.copy(self)
+        clone.timeline = None
+        clone.subpersonas = [p.clone() for p in self.subpersonas]
+        clone.delegation_info = (
+            CharacterDialogueLinearOrchestrationPersona.create_delegation_info(
+                self.initial_mood, clone.subpersonas, self.fan_out
+            )
+        )
+        DelegatingPersona.__init__(
+            clone, PersonaMessageDelegatorLinear(clone.delegation_info)
+        )
+        return clone
+
+    @staticmethod
+    def create_delegation_info(
+        initial_mood: str, subpersonas: List[BasicPersona], fan_out: bool = False
+    ) -> PersonaDelegationInfoLinear:
+        """`subpersonas` are the goals, mood, conversation and rewriter personas, in that order."""
+        (
+            goals_persona,
+            mood_persona,
+            conversation_persona,
+            rewriter_persona,
+        ) = subpersonas
+        if fan_out:
+            # Drafts the reply from the starting mood while goals are evaluated, then lets the rewriter apply the
+            # new mood: 3 rounds of LLM calls per line instead of 4
+            (
+                steps,
+                final_message_builder,
+            ) = CharacterDialogueLinearOrchestrationPersona.create_fan_out_steps(
+                initial_mood,
+                goals_persona,
+                mood_persona,
+                conversation_persona,
+                rewriter_persona,
+            )
+            return PersonaDelegationInfoLinear.from_steps(steps, final_message_builder)
         next_message_closure = (
             CharacterDialogueLinearOrchestrationPersona.create_message_builder_closure(
-                current_mood,
+                initial_mood,
                 goals_persona,
                 mood_persona,
                 conversation_persona,
                 rewriter_persona,
             )
         )
-        self.delegation_info = PersonaDelegationInfoLinear(
-            ordered_persona_list, next_message_closure
-        )
-        DelegatingPersona.__init__(
-            self, PersonaMessageDelegatorLinear(self.delegation_info)
-        )
+        return PersonaDelegationInfoLinear(list(subpersonas), next_message_closure)
 
     def get_name(self) -> str:
         return self.name
@@ -110,14 +159,20 @@ class CharacterDialogueLinearOrchestrationPersona(DelegatingPersona):
         return self.delegator.get_history()
 
     def set_history(self, history: ResponseDrivenPersonaHistory) -> None:
-        self.delegator.set_history(history)
+        with span(
+            f"{type(self).__name__}.set_history",
+            persona=self.get_name(),
+            messages=len(history.messages),
+        ):
+            self.delegator.set_history(history)
 
     async def send_message_and_process_autonomously(
         self, message: str
     ) -> Dict[str, str]:
-        pr = await self.send_message(message)
-        while self.delegator.is_in_processing_loop():
-            pr = await self.process_proposed_response(pr)
+        with span("inbound message", persona=self.get_name()):
+            pr = await self.send_message(message)
+            while self.delegator.is_in_processing_loop():
+                pr = await self.process_proposed_response(pr)
         # TODO: call out to a provided "final conversion method" instead, here, too
         return await self.process_final_response(pr)
 
@@ -199,3 +254,82 @@ class CharacterDialogueLinearOrchestrationPersona(DelegatingPersona):
             )
 
         return message_builder
+
+    @staticmethod
+    def create_fan_out_steps(
+        initial_mood: str,
+        goals_persona: BasicPersona,
+        mood_persona: BasicPersona,
+        conversation_persona: BasicPersona,
+        rewriter_persona: BasicPersona,
+    ) -> Tuple[List[PersonaDelegationStep], Callable[[str, Dict[str, str]], str]]:
+        """The same four personas as `create_message_builder_closure`, as a graph: goals and a first-draft reply
+        (from the starting mood) run together, then the mood update, then the rewrite. Like the sequential builder,
+        every line's mood update starts from `initial_mood`.
+        """
+        response_state_history: List[CharacterDialogueOrchestrationResponseState] = []
+
+        def conversation_message(inbound_message: str, _: Dict[str, str]) -> str:
+            # Runs before this line's state is recorded, so the last state is still the previous line's
+            last_state = response_state_history[-1] if response_state_history else None
+            return json.dumps(
+                {
+                    "name": last_state.other_person_name if last_state else None,
+                    "line": inbound_message,
+                    "mood": initial_mood,
+                }
+            )
+
+        def mood_message(inbound_message: str, responses: Dict[str, str]) -> str:
+            alignment = json.loads(
+                extract_code_block(responses[goals_persona.get_name()])
+            )
+            response_state_history.append(
+                CharacterDialogueOrchestrationResponseState(
+                    alignment=alignment, mood=initial_mood
+                )
+            )
+            response_alignment_history = [x.alignment for x in response_state_history][
+                -5:
+            ]
+            return f"Your current mood is {initial_mood}.\n\nYou are having a conversation, and the last few responses (up to five, if the conversation has contained that many or more) from the other party have either aligned with your goals, or not, as represented by a list of boolean variables, where true means the response was aligned: {response_alignment_history}.\n\nGiven the following line of dialogue, respond with your mood after processing that dialogue from the other party - either your original mood, or a new one if you have shifted your position due to the history, statement, and its tone and contents: {inbound_message}"
+
+        def rewriter_message(_: str, responses: Dict[str, str]) -> str:
+            state = response_state_history[-1]
+            state.mood = json.loads(
+                extract_code_block(responses[mood_persona.get_name()])
+            )["mood"]
+            state.proposed_response_dict = json.loads(
+                extract_code_block(responses[conversation_persona.get_name()])
+            )
+            assert state.proposed_response_dict
+            state.other_person_name = state.proposed_response_dict["name"]
+            return json.dumps(
+                {"mood": state.mood, "line": state.proposed_response_dict["line"]}
+            )
+
+        def final_message(_: str, responses: Dict[str, str]) -> str:
+            proposed_response_dict = response_state_history[-1].proposed_response_dict
+            assert proposed_response_dict
+            proposed_response_dict["line"] = extract_code_block(
+                responses[rewriter_persona.get_name()]
+            )
+            return json.dumps(proposed_response_dict)
+
+        steps = [
+            PersonaDelegationStep(goals_persona),
+            PersonaDelegationStep(
+                conversation_persona, message_builder=conversation_message
+            ),
+            PersonaDelegationStep(
+                mood_persona,
+                inputs=[goals_persona.get_name()],
+                message_builder=mood_message,
+            ),
+            PersonaDelegationStep(
+                rewriter_persona,
+                inputs=[mood_persona.get_name(), conversation_persona.get_name()],
+                message_builder=rewriter_message,
+            ),
+        ]
+        return steps, final_message
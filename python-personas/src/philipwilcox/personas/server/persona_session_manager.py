@@ -0,0 +1,336 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from src.philipwilcox.personas.api.delegating_persona import DelegatingPersona
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.model.persona_history_listener import (
+    HistoryPath,
+    HistoryRecordKind,
+    PersonaHistoryListener,
+)
+from src.philipwilcox.personas.api.model.persona_message import PersonaMessage
+from src.philipwilcox.personas.api.model.proposed_persona_response import (
+    ProposedPersonaResponse,
+)
+from src.philipwilcox.personas.api.persona_deadline import persona_deadline
+from src.philipwilcox.personas.api.persona_messenger import streaming_chunks
+from src.philipwilcox.personas.api.response_driven_persona import ResponseDrivenPersona
+from src.philipwilcox.personas.api.util.persona_session_log import PersonaSessionLog
+
+logger = logging.getLogger(__name__)
+
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+SESSION_INFO_FILENAME = "session.json"
+
+# A JSON-able dict sent to the client: "chunk", "message", "response", "final" or "error"
+SessionEvent = Dict[str, Any]
+
+
+def response_event(
+    persona: ResponseDrivenPersona, response: ProposedPersonaResponse
+) -> SessionEvent:
+    return {
+        "type": "response",
+        "message": response.message,
+        "recipient": response.recipient,
+        "reasoning": response.reasoning,
+        # Whether the response is a step the user can accept (`process_proposed_response`) rather than an answer
+        "in_processing_loop": isinstance(persona, DelegatingPersona)
+        and persona.delegator.is_in_processing_loop(),
+    }
+
+
+class SessionEventListener(PersonaHistoryListener):
+    """Forwards every message added anywhere in a session's persona tree to whoever is running the current turn."""
+
+    def __init__(self) -> None:
+        self.queue: Optional[asyncio.Queue[Optional[SessionEvent]]] = None
+
+    def on_message_appended(
+        self, path: HistoryPath, kind: HistoryRecordKind, message: PersonaMessage
+    ) -> None:
+        # Final messages are copies of messages we've already sent
+        if self.queue is None or kind == HistoryRecordKind.FINAL_MESSAGE:
+            return
+        self.queue.put_nowait(
+            {
+                "type": "message",
+                "path": list(path),
+                "role": message.role.value,
+                "content": message.content,
+            }
+        )
+
+    def on_history_replaced(self, path: HistoryPath) -> None:
+        pass
+
+    def on_step_finished(self, path: HistoryPath) -> None:
+        pass
+
+
+class PersonaSession:
+    """One client conversation with one persona; turns are run one at a time."""
+
+    def __init__(
+        self,
+        session_id: str,
+        persona_kind: str,
+        persona: ResponseDrivenPersona,
+        log: PersonaSessionLog,
+    ) -> None:
+        self.session_id = session_id
+        self.persona_kind = persona_kind
+        self.persona = persona
+        self.log = log
+        self.events = SessionEventListener()
+        persona.add_history_listener(self.events)
+        self.lock = asyncio.Lock()
+        # Turns running or waiting for the lock; a session with any is never evicted
+        self.active_turns = 0
+        self.last_active = time.monotonic()
+        self.last_response: Optional[ProposedPersonaResponse] = (
+            persona.get_last_assistant_response()
+            if persona.get_history().messages
+            else None
+        )
+
+    async def run_turn(
+        self,
+        turn: Callable[[], Awaitable[Any]],
+        emit: Callable[[SessionEvent], Awaitable[None]],
+        timeout_s: Optional[float] = None,
+    ) -> None:
+        """Run `turn` against the persona, emitting its chunks, messages and result as they happen.
+
+        A client that goes away mid-turn doesn't stop the turn; it finishes and is logged, to be picked up from history.
+        A turn that takes longer than `timeout_s` (not counting time queued behind other turns) is rolled back and
+        reported as an error. Callers must not await between getting the session from the manager and calling this, or
+        it may be evicted.
+        """
+        self.active_turns += 1
+        try:
+            async with self.lock:
+                await self.run_turn_locked(turn, emit, timeout_s)
+        finally:
+            self.active_turns -= 1
+
+    async def run_turn_locked(
+        self,
+        turn: Callable[[], Awaitable[Any]],
+        emit: Callable[[SessionEvent], Awaitable[None]],
+        timeout_s: Optional[float] = None,
+    ) -> None:
+        self.last_active = time.monotonic()
+        queue: asyncio.Queue[Optional[SessionEvent]] = asyncio.Queue()
+        self.events.queue = queue
+
+        async def run() -> None:
+            with streaming_chunks(
+                lambda chunk: queue.put_nowait({"type": "chunk", "chunk": chunk})
+            ):
+                try:
+                    async with persona_deadline(timeout_s):
+                        result = await turn()
+                    if isinstance(result, ProposedPersonaResponse):
+                        self.last_response = result
+                        queue.put_nowait(response_event(self.persona, result))
+                    else:
+                        self.last_response = None
+                        queue.put_nowait({"type": "final", "result": result})
+                except Exception as e:
+                    logger.exception(f"Turn failed in session {self.session_id}")
+                    queue.put_nowait({"type": "error", "error": str(e)})
+                finally:
+                    queue.put_nowait(None)
+
+        task = asyncio.create_task(run())
+        client_connected = True
+        try:
+            while (event := await queue.get()) is not None:
+                if not client_connected:
+                    continue
+                try:
+                    await emit(event)
+                except ConnectionResetError:
+                    logger.info(
+                        f"Client of session {self.session_id} went away mid-turn"
+                    )
+                    client_connected = False
+            await task
+        finally:
+            self.events.queue = None
+            self.last_active = time.monotonic()
+
+    def send_message(self, message: str) -> Callable[[], Awaitable[Any]]:
+        return lambda: self.persona.send_message(message)
+
+    def process_proposed_response(self) -> Callable[[], Awaitable[Any]]:
+        # Checked now so callers can reject the request, and again once the turn runs, since a turn queued ahead of
+        # this one may change the last response
+        self.delegating_persona_and_last_response()
+
+        async def turn() -> Any:
+            persona, proposed_response = self.delegating_persona_and_last_response()
+            return await persona.process_proposed_response(proposed_response)
+
+        return turn
+
+    def process_final_response(self) -> Callable[[], Awaitable[Any]]:
+        self.delegating_persona_and_last_response()
+
+        async def turn() -> Any:
+            persona, proposed_response = self.delegating_persona_and_last_response()
+            return await persona.process_final_response(proposed_response)
+
+        return turn
+
+    def delegating_persona_and_last_response(
+        self,
+    ) -> Tuple[DelegatingPersona, ProposedPersonaResponse]:
+        if not isinstance(self.persona, DelegatingPersona):
+            raise PersonaException(
+                f"{self.persona.get_name()} doesn't delegate, so there's no proposed response to process"
+            )
+        if self.last_response is None:
+            raise PersonaException(
+                f"Session {self.session_id} has no proposed response to process"
+            )
+        return self.persona, self.last_response
+
+    def close(self) -> None:
+        self.log.close()
+
+
+class PersonaSessionManager:
+    """Maps session IDs to live personas, keeping each session's history in `store_directory` as it goes.
+
+    Every session is logged with a PersonaSessionLog in its own directory, so evicting one only closes its log.
+    Sessions idle for `idle_timeout_s`, or the least recently active beyond `max_live_sessions`, are evicted; the
+    next request for one builds a fresh persona of the same kind and restores it through `set_history`.
+
+    `persona_factories` builds a persona of each kind a client may ask for, e.g. `lambda: pool.get(kind, build)`
+    with a PersonaPool. The personas must support history listeners.
+    """
+
+    def __init__(
+        self,
+        persona_factories: Dict[str, Callable[[], ResponseDrivenPersona]],
+        store_directory: str,
+        idle_timeout_s: float = 15 * 60,
+        max_live_sessions: Optional[int] = None,
+        fsync: bool = True,
+    ) -> None:
+        self.persona_factories = persona_factories
+        self.store_directory = store_directory
+        self.idle_timeout_s = idle_timeout_s
+        self.max_live_sessions = max_live_sessions
+        self.fsync = fsync
+        os.makedirs(store_directory, exist_ok=True)
+        # Least recently active first
+        self.sessions: collections.OrderedDict[
+            str, PersonaSession
+        ] = collections.OrderedDict()
+        self.evictions = 0
+        self.rehydrations = 0
+        self.eviction_task: Optional[asyncio.Task] = None
+
+    def session_directory(self, session_id: str) -> str:
+        return os.path.join(self.store_directory, session_id)
+
+    def create(
+        self, persona_kind: str, session_id: Optional[str] = None
+    ) -> PersonaSession:
+        if persona_kind not in self.persona_factories:
+            raise PersonaException(f"Unknown persona kind {persona_kind}")
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+        elif not SESSION_ID_PATTERN.match(session_id):
+            raise PersonaException(f"Invalid session ID {session_id}")
+        directory = self.session_directory(session_id)
+        if os.path.exists(directory):
+            raise PersonaException(f"Session {session_id} already exists")
+        os.makedirs(directory)
+        with open(
+            os.path.join(directory, SESSION_INFO_FILENAME), "w", encoding="utf-8"
+        ) as f:
+            json.dump({"persona_kind": persona_kind}, f)
+        persona = self.persona_factories[persona_kind]()
+        log = PersonaSessionLog(directory, fsync=self.fsync)
+        log.attach(persona)
+        return self.add(PersonaSession(session_id, persona_kind, persona, log))
+
+    def get(self, session_id: str) -> Optional[PersonaSession]:
+        """The live session, rehydrated from the store if it was evicted; None if there's no such session."""
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+            return session
+        if not SESSION_ID_PATTERN.match(session_id):
+            return None
+        directory = self.session_directory(session_id)
+        info_path = os.path.join(directory, SESSION_INFO_FILENAME)
+        if not os.path.exists(info_path):
+            return None
+        with open(info_path, "r", encoding="utf-8") as f:
+            persona_kind = json.load(f)["persona_kind"]
+        if persona_kind not in self.persona_factories:
+            raise PersonaException(
+                f"Session {session_id} is for persona kind {persona_kind}, which this server doesn't serve"
+            )
+        persona = self.persona_factories[persona_kind]()
+        log = PersonaSessionLog(directory, fsync=self.fsync)
+        log.resume(persona)
+        self.rehydrations += 1
+        logger.info(f"Rehydrated session {session_id} from {directory}")
+        return self.add(PersonaSession(session_id, persona_kind, persona, log))
+
+    def add(self, session: PersonaSession) -> PersonaSession:
+        self.sessions[session.session_id] = session
+        if self.max_live_sessions is not None:
+            for session_id in list(self.sessions)[: -self.max_live_sessions]:
+                self.evict(session_id)
+        return session
+
+    def evict(self, session_id: str) -> bool:
+        """Drop the live persona of a session that isn't mid-turn; its history is already in the store."""
+        session = self.sessions.get(session_id)
+        if session is None or session.active_turns:
+            return False
+        del self.sessions[session_id]
+        session.close()
+        self.evictions += 1
+        logger.info(f"Evicted session {session_id}")
+        return True
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_timeout_s
+        return sum(
+            self.evict(session_id)
+            for session_id, session in list(self.sessions.items())
+            if session.last_active < cutoff
+        )
+
+    async def evict_idle_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.idle_timeout_s / 4)
+            self.evict_idle()
+
+    def start(self) -> None:
+        self.eviction_task = asyncio.create_task(self.evict_idle_forever())
+
+    async def stop(self) -> None:
+        if self.eviction_task is not None:
+            self.eviction_task.cancel()
+            self.eviction_task = None
+        for session_id in list(self.sessions):
+            session = self.sessions.pop(session_id)
+            # Let a turn in progress finish so it gets logged
+            async with session.lock:
+                session.close()
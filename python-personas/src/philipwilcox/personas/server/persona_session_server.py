@@ -0,0 +1,243 @@
+import dataclasses
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiohttp import WSMsgType, web
+
+from src.philipwilcox.personas.api.model.persona_exception import PersonaException
+from src.philipwilcox.personas.api.util.persona_data_json import (
+    PersonaDataJsonEncoder,
+)
+from src.philipwilcox.personas.server.persona_session_manager import (
+    PersonaSession,
+    PersonaSessionManager,
+    SessionEvent,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(value: Any) -> str:
+    return json.dumps(value, cls=PersonaDataJsonEncoder)
+
+
+def timeout_from(body: Dict[str, Any]) -> Optional[float]:
+    timeout_s = body.get("timeout_s")
+    if timeout_s is None:
+        return None
+    if isinstance(timeout_s, bool) or not isinstance(timeout_s, (int, float)):
+        raise PersonaException(f"Expected timeout_s to be a number, got {timeout_s!r}")
+    return float(timeout_s)
+
+
+class PersonaSessionServer:
+    """Serves the sessions of a PersonaSessionManager over HTTP and WebSocket.
+
+    HTTP:
+        POST /sessions {"persona_kind": ..., "session_id": optional}  -> {"session_id": ...}
+        GET  /sessions/{id}                                           -> the session and its last proposed response
+        GET  /sessions/{id}/history                                   -> the whole persona history
+        POST /sessions/{id}/messages {"message": ...}                 -> `send_message`, as server-sent events
+        POST /sessions/{id}/proposed-response                         -> `process_proposed_response`, as events
+        POST /sessions/{id}/final-response                            -> `process_final_response`, as events
+        POST /sessions/{id}/evict                                     -> drop the live persona, keeping its history
+
+    The turn endpoints take an optional "timeout_s" in their JSON body; a turn that runs longer is rolled back and
+    ends in an "error" event.
+
+    WebSocket, GET /sessions/{id}/ws: send {"type": "send_message", "message": ...}, {"type":
+    "process_proposed_response"} or {"type": "process_final_response"}, each with an optional "timeout_s", and get the
+    same events back as JSON messages.
+
+    Events are "chunk"s of any persona's response as they stream in, each "message" added to the history (with the
+    path of subpersonas to the one it was added to), then one "response" (a proposed response), "final" (the result
+    of processing a final response) or "error".
+    """
+
+    def __init__(
+        self, manager: PersonaSessionManager, host: str = "127.0.0.1", port: int = 8080
+    ) -> None:
+        self.manager = manager
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/sessions", self.handle_create_session)
+        app.router.add_get("/sessions/{session_id}", self.handle_get_session)
+        app.router.add_get("/sessions/{session_id}/history", self.handle_get_history)
+        app.router.add_post("/sessions/{session_id}/messages", self.handle_send_message)
+        app.router.add_post(
+            "/sessions/{session_id}/proposed-response",
+            self.handle_process_proposed_response,
+        )
+        app.router.add_post(
+            "/sessions/{session_id}/final-response",
+            self.handle_process_final_response,
+        )
+        app.router.add_post("/sessions/{session_id}/evict", self.handle_evict)
+        app.router.add_get("/sessions/{session_id}/ws", self.handle_websocket)
+        return app
+
+    async def start(self) -> str:
+        """Start serving and return the base URL."""
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        sockets = site._server.sockets  # type: ignore
+        self.port = sockets[0].getsockname()[1]
+        self.manager.start()
+        return f"http://{self.host}:{self.port}"
+
+    async def stop(self) -> None:
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        await self.manager.stop()
+
+    def session_for(self, request: web.Request) -> PersonaSession:
+        session_id = request.match_info["session_id"]
+        try:
+            session = self.manager.get(session_id)
+        except PersonaException as e:
+            raise web.HTTPBadRequest(text=str(e))
+        if session is None:
+            raise web.HTTPNotFound(text=f"No session {session_id}")
+        return session
+
+    @staticmethod
+    async def json_object_body(request: web.Request) -> Dict[str, Any]:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="Expected a JSON object")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Expected a JSON object")
+        return body
+
+    async def handle_create_session(self, request: web.Request) -> web.Response:
+        body = await self.json_object_body(request)
+        if not isinstance(body.get("persona_kind"), str):
+            raise web.HTTPBadRequest(text="Expected a JSON body with a persona_kind")
+        try:
+            session = self.manager.create(body["persona_kind"], body.get("session_id"))
+        except (KeyError, PersonaException) as e:
+            raise web.HTTPBadRequest(text=str(e))
+        return web.json_response({"session_id": session.session_id})
+
+    async def handle_get_session(self, request: web.Request) -> web.Response:
+        session = self.session_for(request)
+        return web.json_response(
+            {
+                "session_id": session.session_id,
+                "persona_kind": session.persona_kind,
+                "last_response": dataclasses.asdict(session.last_response)
+                if session.last_response is not None
+                else None,
+            }
+        )
+
+    async def handle_get_history(self, request: web.Request) -> web.Response:
+        session = self.session_for(request)
+        return web.json_response(session.persona.get_history(), dumps=dumps)
+
+    async def turn_options(
+        self, request: web.Request
+    ) -> Tuple[Dict[str, Any], Optional[float]]:
+        """The request's JSON body, which is optional for some turns, and the timeout it asks for."""
+        body = await self.json_object_body(request) if request.can_read_body else {}
+        try:
+            return body, timeout_from(body)
+        except PersonaException as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+    async def handle_send_message(self, request: web.Request) -> web.StreamResponse:
+        body, timeout_s = await self.turn_options(request)
+        session = self.session_for(request)
+        if not isinstance(body.get("message"), str):
+            raise web.HTTPBadRequest(text="Expected a JSON body with a message")
+        return await self.stream_turn(
+            request, session, session.send_message(body["message"]), timeout_s
+        )
+
+    async def handle_process_proposed_response(
+        self, request: web.Request
+    ) -> web.StreamResponse:
+        _, timeout_s = await self.turn_options(request)
+        session = self.session_for(request)
+        try:
+            turn = session.process_proposed_response()
+        except PersonaException as e:
+            raise web.HTTPConflict(text=str(e))
+        return await self.stream_turn(request, session, turn, timeout_s)
+
+    async def handle_process_final_response(
+        self, request: web.Request
+    ) -> web.StreamResponse:
+        _, timeout_s = await self.turn_options(request)
+        session = self.session_for(request)
+        try:
+            turn = session.process_final_response()
+        except PersonaException as e:
+            raise web.HTTPConflict(text=str(e))
+        return await self.stream_turn(request, session, turn, timeout_s)
+
+    async def handle_evict(self, request: web.Request) -> web.Response:
+        session_id = request.match_info["session_id"]
+        return web.json_response({"evicted": self.manager.evict(session_id)})
+
+    async def stream_turn(
+        self,
+        request: web.Request,
+        session: PersonaSession,
+        turn: Callable[[], Awaitable[Any]],
+        timeout_s: Optional[float] = None,
+    ) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+
+        async def emit(event: SessionEvent) -> None:
+            # Prepared here rather than up front so there's no await before the turn is registered with the session
+            if not response.prepared:
+                await response.prepare(request)
+            await response.write(f"data: {dumps(event)}\n\n".encode())
+
+        await session.run_turn(turn, emit, timeout_s)
+        await response.write_eof()
+        return response
+
+    async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        session = self.session_for(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def emit(event: SessionEvent) -> None:
+            await ws.send_str(dumps(event))
+
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            # Evicted since the last command? Carry on with the rehydrated session
+            if self.manager.sessions.get(session.session_id) is not session:
+                refreshed = self.manager.get(session.session_id)
+                if refreshed is None:
+                    break
+                session = refreshed
+            try:
+                command: Dict[str, Any] = json.loads(msg.data)
+                timeout_s = timeout_from(command)
+                if command.get("type") == "send_message":
+                    turn = session.send_message(command["message"])
+                elif command.get("type") == "process_proposed_response":
+                    turn = session.process_proposed_response()
+                elif command.get("type") == "process_final_response":
+                    turn = session.process_final_response()
+                else:
+                    raise PersonaException(f"Unknown command {command.get('type')}")
+            except (ValueError, KeyError, PersonaException) as e:
+                await emit({"type": "error", "error": str(e)})
+                continue
+            await session.run_turn(turn, emit, timeout_s)
+        return ws